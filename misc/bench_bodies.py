@@ -0,0 +1,40 @@
+"""Measure the cost of encoding large message bodies into JSON frames.
+
+Every message a client adds is sent to each listener on its mailbox (and
+replayed to late joiners), so the outbound encoding is paid several times
+per message. Bodies are hex strings, which never need escaping, so the JSON
+framing splices large ones into the frame directly instead of letting
+json.dumps() scan them character by character. This compares the two.
+
+Usage: python misc/bench_bodies.py [BODY_BYTES] [ITERATIONS]
+"""
+
+import sys, os, timeit
+from wormhole_mailbox_server.framing import JSON
+from wormhole_mailbox_server.util import dict_to_bytes, bytes_to_dict
+
+def main(size=64*1024, iterations=1000):
+    body = os.urandom(size).hex()
+    msg = {"type": "message", "side": "abcd1234", "phase": "pake",
+           "body": body, "id": "1a2b", "server_rx": 1700000000.123,
+           "seq": 17}
+    encoded = dict_to_bytes(msg)
+    assert bytes_to_dict(JSON.encode(msg)) == msg
+
+    def per_call(f):
+        return min(timeit.repeat(f, number=iterations, repeat=3)) / iterations
+
+    decode = per_call(lambda: JSON.decode(encoded))
+    plain = per_call(lambda: dict_to_bytes(msg))
+    spliced = per_call(lambda: JSON.encode(msg))
+    print("%d-byte body (%d hex characters), %d iterations:"
+          % (size, len(body), iterations))
+    print("  decode inbound frame:   %8.1f us" % (decode * 1e6))
+    print("  encode with json.dumps: %8.1f us" % (plain * 1e6))
+    print("  encode with splice:     %8.1f us (%.1fx faster)"
+          % (spliced * 1e6, plain / spliced))
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64*1024
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    main(size, iterations)
@@ -0,0 +1,120 @@
+"""Count the frames, send() calls, and bytes a wormhole setup costs.
+
+This runs a Mailbox Server in-process, then has pairs of clients go through
+the usual sequence (bind, allocate/claim, open, add PAKE and VERSION
+messages, release, close), and reports the server-side costs per setup:
+
+* frames: WebSocket messages sent by the server
+* writes: calls to transport.write() (one per frame, from autobahn)
+* sends: send() syscalls actually made by the server's TCP transport
+
+Twisted's TCP transport buffers everything written during one reactor turn
+and flushes it with a single send(), so all the frames provoked by one
+inbound command ("ack", "claimed", replayed "message"s, ...) leave together.
+With TCP_NODELAY (which autobahn sets), each small send() is one packet, so
+"sends" is also the packet count.
+
+Usage: python misc/bench_frames.py [SETUPS] [--batch]
+
+With --batch, clients send their commands in "batch" frames and ask for
+"batch-responses" and "no-acks", which also reduces the frame count.
+"""
+
+import sys
+from unittest import mock
+from twisted.internet import reactor, endpoints, tcp, defer, task
+from autobahn.twisted.websocket import WebSocketServerProtocol
+from wormhole_mailbox_server.database import create_channel_db
+from wormhole_mailbox_server.server import make_server
+from wormhole_mailbox_server.web import make_web_server
+from wormhole_mailbox_server.test.ws_client import WSFactory
+
+counts = {"frames": 0, "writes": 0, "sends": 0, "bytes": 0}
+
+def counting(name, orig, measure=None):
+    def wrapper(self, data, *args, **kwargs):
+        counts[name] += 1
+        if measure:
+            counts[measure] += len(data)
+        return orig(self, data, *args, **kwargs)
+    return wrapper
+
+@defer.inlineCallbacks
+def connect(url, port):
+    f = WSFactory(url)
+    f.d = defer.Deferred()
+    reactor.connectTCP("127.0.0.1", port, f)
+    c = yield f.d
+    yield c.next_non_ack() # welcome
+    return c
+
+@defer.inlineCallbacks
+def drain(c, mtype):
+    while True:
+        m = yield c.next_non_ack()
+        if m["type"] == mtype:
+            return m
+
+@defer.inlineCallbacks
+def setup_pair(url, port, i, batch):
+    a = yield connect(url, port)
+    b = yield connect(url, port)
+    features = ["batch-responses", "no-acks"] if batch else []
+    nameplate = str(i + 1)
+
+    def run(c, commands):
+        if batch:
+            c.send("batch", commands=[dict(cmd, type=t) for (t, cmd) in commands])
+        else:
+            for (t, cmd) in commands:
+                c.send(t, **cmd)
+
+    for (c, side) in [(a, "a"), (b, "b")]:
+        run(c, [("bind", dict(appid="bench", side=side, features=features)),
+                ("claim-open", dict(nameplate=nameplate)),
+                ("add", dict(phase="pake", body="00"*32, id=side+"1")),
+                ("add", dict(phase="version", body="00"*100, id=side+"2"))])
+    # each side sees its own two messages and its peer's two
+    for c in (a, b):
+        seen = 0
+        while seen < 4:
+            m = yield c.next_non_ack()
+            if m["type"] == "batch":
+                seen += len([x for x in m["messages"] if x["type"] == "message"])
+            elif m["type"] == "message":
+                seen += 1
+    for c in (a, b):
+        run(c, [("release", {}), ("close", dict(mood="happy"))])
+    for c in (a, b):
+        yield drain(c, "batch" if batch else "closed")
+        yield c.close()
+
+@defer.inlineCallbacks
+def main(reactor, setups=100, batch=False):
+    server = make_server(create_channel_db(":memory:"))
+    site = make_web_server(server, log_requests=False)
+    ep = endpoints.TCP4ServerEndpoint(reactor, 0, interface="127.0.0.1")
+    lp = yield ep.listen(site)
+    port = lp.getHost().port
+    url = "ws://127.0.0.1:%d/v1" % port
+
+    with mock.patch.object(tcp.Server, "writeSomeData",
+                           counting("sends", tcp.Server.writeSomeData,
+                                    "bytes")), \
+         mock.patch.object(tcp.Server, "write",
+                           counting("writes", tcp.Server.write)), \
+         mock.patch.object(WebSocketServerProtocol, "sendMessage",
+                           counting("frames",
+                                    WebSocketServerProtocol.sendMessage)):
+        for i in range(setups):
+            yield setup_pair(url, port, i, batch)
+    yield lp.stopListening()
+
+    print("%d setups (%s):" % (setups, "batched" if batch else "unbatched"))
+    for name in ["frames", "writes", "sends", "bytes"]:
+        print("  %-7s %8.1f per setup" % (name, counts[name] / setups))
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    setups = int(args[0]) if args else 100
+    task.react(main, (setups, "--batch" in sys.argv))
@@ -0,0 +1,53 @@
+"""Measure how fast each channel store runs complete wormholes.
+
+For each store (SQLite in a temporary file, SQLite split across three
+files, and the in-memory store), this runs WORMHOLES wormholes through a
+server, with IN_PROGRESS of them open at once (see run_wormholes() in
+test/test_storage.py), after a warm-up of a tenth as many. The report
+gives wormholes per second for both runs, and how much slower each
+wormhole was in the larger run. That ratio should stay close to 1: if it
+grows with WORMHOLES, some store operation is scanning rows it should be
+looking up.
+
+Usage: python misc/bench_storage.py [WORMHOLES] [IN_PROGRESS]
+"""
+
+import os, sys, tempfile, time
+from wormhole_mailbox_server.database import create_channel_db
+from wormhole_mailbox_server.shards import shard_path
+from wormhole_mailbox_server.sqlite_storage import SQLiteChannelStore
+from wormhole_mailbox_server.memory_storage import MemoryChannelStore
+from wormhole_mailbox_server.server import make_server
+from wormhole_mailbox_server.test.test_storage import run_wormholes
+
+def sqlite_store(tmpdir, shards):
+    dbfile = os.path.join(tmpdir, "relay-%d.sqlite" % shards)
+    return SQLiteChannelStore([create_channel_db(shard_path(dbfile, i))
+                               for i in range(shards)])
+
+def timed(server, count, in_progress, first=0):
+    started = time.perf_counter()
+    run_wormholes(server, count, in_progress, first)
+    return time.perf_counter() - started
+
+def main():
+    wormholes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    in_progress = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    warmup = max(wormholes // 10, 1)
+    print(f"{wormholes} wormholes, {in_progress} in progress,"
+          f" after {warmup} to warm up")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stores = [("sqlite", lambda: sqlite_store(tmpdir, 1)),
+                  ("sqlite, 3 shards", lambda: sqlite_store(tmpdir, 3)),
+                  ("memory", MemoryChannelStore)]
+        for (name, make_store) in stores:
+            server = make_server(None, store=make_store())
+            small = timed(server, warmup, in_progress)
+            large = timed(server, wormholes, in_progress, first=warmup)
+            growth = (large / wormholes) / (small / warmup)
+            print(f"{name:>18}: {warmup / small:8.0f}/s,"
+                  f" then {wormholes / large:8.0f}/s"
+                  f" ({growth:.2f}x the time per wormhole)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Measure wormhole setups per second with --workers=1 and --workers=N.
+
+This starts the Mailbox Server as a separate process (with twist), then
+runs several client processes at once, each completing SETUPS wormhole
+setups (two clients: bind, claim-open, add PAKE and VERSION messages,
+release, close). Nameplates are spread over the whole range, so with
+several workers most setups involve forwarding between them. The report
+gives the total setups per second for each worker count.
+
+The server can only go faster with more workers if it has more cores to
+run them on (and the client processes need cores too), so compare the
+results with the number of CPUs reported at the top.
+
+Usage: python misc/bench_workers.py [WORKERS] [CLIENTS] [SETUPS]
+"""
+
+import os, sys, socket, subprocess, tempfile, time
+from twisted.internet import defer, task
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for_port(port, timeout=20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+@defer.inlineCallbacks
+def connect(reactor, port):
+    from wormhole_mailbox_server.test.ws_client import WSFactory
+    f = WSFactory("ws://127.0.0.1:%d/v1" % port)
+    f.d = defer.Deferred()
+    reactor.connectTCP("127.0.0.1", port, f)
+    c = yield f.d
+    yield c.next_non_ack() # welcome
+    return c
+
+@defer.inlineCallbacks
+def drain(c, mtype):
+    while True:
+        m = yield c.next_non_ack()
+        if m["type"] == mtype:
+            return m
+
+@defer.inlineCallbacks
+def setup_pair(reactor, port, nameplate):
+    a = yield connect(reactor, port)
+    b = yield connect(reactor, port)
+    # sides must be unique, like the random ones real clients use
+    for (c, side) in [(a, nameplate + "a"), (b, nameplate + "b")]:
+        c.send("bind", appid="bench", side=side)
+        c.send("claim-open", nameplate=nameplate)
+        c.send("add", phase="pake", body="00"*32, id=side+"1")
+        c.send("add", phase="version", body="00"*100, id=side+"2")
+    for c in (a, b):
+        seen = 0
+        while seen < 4: # our two messages, and our peer's two
+            m = yield c.next_non_ack()
+            if m["type"] == "message":
+                seen += 1
+    for c in (a, b):
+        c.send("release")
+        c.send("close", mood="happy")
+    for c in (a, b):
+        yield drain(c, "closed")
+        yield c.close()
+
+@defer.inlineCallbacks
+def client(reactor, port, first, setups):
+    # run 10 setups at a time
+    for i in range(0, setups, 10):
+        yield defer.gatherResults([
+            setup_pair(reactor, port, str(first + j))
+            for j in range(i, min(i + 10, setups))])
+
+def run(workers, clients, setups):
+    with tempfile.TemporaryDirectory() as d:
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "twisted", "wormhole-mailbox",
+             "--workers=%d" % workers,
+             "--port=tcp:%d:interface=127.0.0.1" % port,
+             "--channel-db=%s" % os.path.join(d, "relay.sqlite"),
+             "--worker-socket-dir=%s" % d],
+            cwd=d, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            time.sleep(1.0 * workers) # let the other workers start too
+            start = time.time()
+            procs = [subprocess.Popen([sys.executable, __file__, "--client",
+                                       str(port), str(1 + i * setups),
+                                       str(setups)])
+                     for i in range(clients)]
+            for p in procs:
+                if p.wait() != 0:
+                    raise RuntimeError("client failed")
+            elapsed = time.time() - start
+        finally:
+            server.terminate()
+            server.wait()
+    total = clients * setups
+    print("  workers=%d: %d setups in %.2fs, %.1f setups/s"
+          % (workers, total, elapsed, total / elapsed))
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--client"]:
+        port, first, setups = map(int, sys.argv[2:5])
+        task.react(client, (port, first, setups))
+    args = list(map(int, sys.argv[1:]))
+    workers = args[0] if len(args) > 0 else os.cpu_count()
+    clients = args[1] if len(args) > 1 else 4
+    setups = args[2] if len(args) > 2 else 200
+    print("%d CPUs, %d client processes, %d setups each:"
+          % (os.cpu_count(), clients, setups))
+    run(1, clients, setups)
+    if workers > 1:
+        run(workers, clients, setups)
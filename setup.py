@@ -38,7 +38,8 @@ setup(name="magic-wormhole-mailbox-server",
       ],
       extras_require={
           ':sys_platform=="win32"': ["pywin32"],
-          "dev": ["treq", "tox", "pyflakes"],
+          "binary": ["cbor2", "msgpack"],
+          "dev": ["treq", "tox", "pyflakes", "cbor2", "msgpack"],
           "release": ["dulwich", "docutils", "wheel"],
       },
       test_suite="wormhole_mailbox_server.test",
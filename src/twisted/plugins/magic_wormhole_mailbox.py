@@ -6,3 +6,10 @@ Mailbox = ServiceMaker(
     "Provide the Mailbox server for Magic-Wormhole clients.", # desc
     "wormhole-mailbox", # tapname
     )
+
+Broker = ServiceMaker(
+    "Magic-Wormhole Mailbox Broker", # name
+    "wormhole_mailbox_server.broker_tap", # module
+    "Let several Mailbox servers share one channel database.", # desc
+    "wormhole-mailbox-broker", # tapname
+    )
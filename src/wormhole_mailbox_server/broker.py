@@ -0,0 +1,214 @@
+import json
+from collections import deque, OrderedDict
+from zope.interface import implementer
+from twisted.internet import protocol, endpoints
+from twisted.internet.interfaces import IPushProducer
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.application import service
+from twisted.application.internet import ClientService, backoffPolicy
+from twisted.python import log
+
+# Several server processes can share one channel DB (for example behind a
+# load balancer, with the DB in WAL mode), but each one only knows about
+# the listeners of its own clients. With --broker=PATH, they tell each other
+# about new messages through a broker process listening on the UNIX socket
+# PATH (twist wormhole-mailbox-broker --socket=PATH). Each server subscribes
+# to the mailboxes its clients are listening to, and publishes the seq of
+# every message it adds. The broker passes that on to the other subscribers
+# of the mailbox, which read the new messages from the DB (with
+# Mailbox.catch_up()) and deliver them to their listeners.
+#
+# Notifications only say "look again", so a lost one costs nothing but
+# latency: whenever a server (re)connects to the broker, it looks again at
+# every mailbox it subscribes to. The broker disconnects subscribers which
+# fall too far behind (they reconnect and catch up), and servers hold a
+# limited number of unsent notifications while the broker is unreachable.
+#
+# The protocol is one JSON object per line:
+#  server -> broker: {"subscribe": [app_id, mailbox_id]}
+#                    {"unsubscribe": [app_id, mailbox_id]}
+#                    {"publish": [app_id, mailbox_id], "seq": int}
+#  broker -> server: {"message": [app_id, mailbox_id], "seq": int}
+
+MAX_QUEUE = 1000 # notifications waiting for one slow subscriber
+MAX_PENDING = 10000 # notifications waiting for the broker to come back
+
+def _topic(value):
+    # a JSON [app_id, mailbox_id] pair, or None if it isn't one
+    if (isinstance(value, list) and len(value) == 2
+        and all(isinstance(v, str) for v in value)):
+        return tuple(value)
+    return None
+
+@implementer(IPushProducer)
+class BrokerProtocol(LineOnlyReceiver):
+    delimiter = b"\n"
+
+    def connectionMade(self):
+        self._topics = set()
+        self._paused = False
+        self._queue = deque()
+        # we're told when the kernel buffer is full, so we can notice
+        # subscribers which stop reading
+        self.transport.registerProducer(self, True)
+
+    def lineReceived(self, line):
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            msg = None
+        if not isinstance(msg, dict):
+            log.msg("broker: bad line, disconnecting")
+            self.transport.loseConnection()
+            return
+        if _topic(msg.get("subscribe")):
+            topic = _topic(msg["subscribe"])
+            self._topics.add(topic)
+            self.factory.subscribe(topic, self)
+        elif _topic(msg.get("unsubscribe")):
+            topic = _topic(msg["unsubscribe"])
+            self._topics.discard(topic)
+            self.factory.unsubscribe(topic, self)
+        elif _topic(msg.get("publish")) and isinstance(msg.get("seq"), int):
+            self.factory.publish(_topic(msg["publish"]), msg["seq"], self)
+
+    def deliver(self, topic, seq):
+        line = json.dumps({"message": list(topic), "seq": seq}).encode("utf-8")
+        if not self._paused:
+            self.sendLine(line)
+            return
+        self._queue.append(line)
+        if len(self._queue) > self.factory.max_queue:
+            log.msg("broker: subscriber is too far behind, disconnecting")
+            self._queue.clear()
+            self.transport.abortConnection()
+
+    def pauseProducing(self):
+        self._paused = True
+    def resumeProducing(self):
+        self._paused = False
+        while self._queue and not self._paused:
+            self.sendLine(self._queue.popleft())
+    def stopProducing(self):
+        self._queue.clear()
+
+    def connectionLost(self, reason):
+        for topic in self._topics:
+            self.factory.unsubscribe(topic, self)
+        self._topics = set()
+
+
+class Broker(protocol.ServerFactory):
+    """I pass notifications of new messages between the server processes
+    subscribed to each mailbox."""
+    protocol = BrokerProtocol
+
+    def __init__(self, max_queue=MAX_QUEUE):
+        self.max_queue = max_queue
+        self._subscribers = {} # (app_id, mailbox_id) -> set(BrokerProtocol)
+        self.published = 0
+
+    def subscribe(self, topic, p):
+        self._subscribers.setdefault(topic, set()).add(p)
+
+    def unsubscribe(self, topic, p):
+        subscribers = self._subscribers.get(topic, set())
+        subscribers.discard(p)
+        if not subscribers:
+            self._subscribers.pop(topic, None)
+
+    def publish(self, topic, seq, publisher):
+        self.published += 1
+        for p in list(self._subscribers.get(topic, ())):
+            if p is not publisher:
+                p.deliver(topic, seq)
+
+    def count_topics(self):
+        return len(self._subscribers)
+
+
+class _BrokerClientProtocol(LineOnlyReceiver):
+    delimiter = b"\n"
+
+    def connectionMade(self):
+        self.factory.client._connected(self)
+
+    def lineReceived(self, line):
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            return
+        topic = _topic(msg.get("message")) if isinstance(msg, dict) else None
+        if topic and isinstance(msg.get("seq"), int):
+            self.factory.client._received(topic, msg["seq"])
+
+    def send(self, **kwargs):
+        self.sendLine(json.dumps(kwargs).encode("utf-8"))
+
+    def connectionLost(self, reason):
+        self.factory.client._disconnected(self)
+
+
+class BrokerClient(service.MultiService):
+    """I keep a server connected to the broker, subscribed to the mailboxes
+    its clients are listening to, and tell it when another process has
+    added messages to one of them."""
+    def __init__(self, reactor, server, path, retry_delay=1.0,
+                 max_pending=MAX_PENDING):
+        service.MultiService.__init__(self)
+        self._server = server
+        self._max_pending = max_pending
+        self._topics = set()
+        self._pending = OrderedDict() # topic -> seq, unsent publications
+        self._p = None
+        f = protocol.Factory.forProtocol(_BrokerClientProtocol)
+        f.client = self
+        ep = endpoints.UNIXClientEndpoint(reactor, path)
+        ClientService(ep, f, retryPolicy=backoffPolicy(retry_delay,
+                                                       maxDelay=30.0),
+                      clock=reactor).setServiceParent(self)
+
+    def subscribe(self, app_id, mailbox_id):
+        topic = (app_id, mailbox_id)
+        if topic not in self._topics:
+            self._topics.add(topic)
+            if self._p:
+                self._p.send(subscribe=list(topic))
+
+    def unsubscribe(self, app_id, mailbox_id):
+        topic = (app_id, mailbox_id)
+        if topic in self._topics:
+            self._topics.discard(topic)
+            if self._p:
+                self._p.send(unsubscribe=list(topic))
+
+    def publish(self, app_id, mailbox_id, seq):
+        topic = (app_id, mailbox_id)
+        if self._p:
+            self._p.send(publish=list(topic), seq=seq)
+            return
+        self._pending.pop(topic, None)
+        self._pending[topic] = seq
+        if len(self._pending) > self._max_pending:
+            self._pending.popitem(last=False)
+            self._server.count("broker_dropped")
+
+    def _connected(self, p):
+        log.msg("connected to the broker")
+        self._p = p
+        for topic in self._topics:
+            p.send(subscribe=list(topic))
+        while self._pending:
+            topic, seq = self._pending.popitem(last=False)
+            p.send(publish=list(topic), seq=seq)
+        # we may have missed notifications while we were away
+        for topic in list(self._topics):
+            self._server.mailbox_changed(*topic)
+
+    def _disconnected(self, p):
+        if self._p is p:
+            log.msg("lost connection to the broker")
+            self._p = None
+
+    def _received(self, topic, seq):
+        self._server.mailbox_changed(*topic, seq=seq)
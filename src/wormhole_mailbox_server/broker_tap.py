@@ -0,0 +1,26 @@
+from twisted.internet import reactor, endpoints
+from twisted.python import usage
+from twisted.application.internet import StreamServerEndpointService
+from .broker import Broker, MAX_QUEUE
+
+LONGDESC = """This plugin runs the broker which lets several Mailbox servers,
+sharing one channel database, tell each other about new messages (see
+--broker= in the wormhole-mailbox plugin)."""
+
+class Options(usage.Options):
+    synopsis = "[--socket=]"
+    longdesc = LONGDESC
+
+    optParameters = [
+        ("socket", None, "broker.sock", "UNIX socket to listen on"),
+        ("max-queue", None, MAX_QUEUE, "disconnect servers which fall this many notifications behind", int),
+        ]
+
+    def postOptions(self):
+        if self["max-queue"] < 1:
+            raise usage.UsageError("--max-queue= must be at least 1")
+
+def makeService(config, reactor=reactor):
+    # wantPID replaces the socket left behind by a broker which crashed
+    ep = endpoints.UNIXServerEndpoint(reactor, config["socket"], wantPID=True)
+    return StreamServerEndpointService(ep, Broker(config["max-queue"]))
@@ -0,0 +1,90 @@
+import time
+import attr
+from autobahn.websocket.compress import (PerMessageDeflateOffer,
+                                         PerMessageDeflateOfferAccept)
+
+# --permessage-deflate= choices. "no-context-takeover" resets the
+# compressor after each message: worse compression, but we don't have to
+# keep a deflate window alive for every idle connection.
+DEFLATE_POLICIES = ("off", "on", "no-context-takeover")
+
+def deflate_policy(arg):
+    if arg not in DEFLATE_POLICIES:
+        raise ValueError("--permessage-deflate must be one of: %s"
+                         % ", ".join(DEFLATE_POLICIES))
+    return arg
+
+def deflate_window_bits(arg):
+    bits = int(arg)
+    if bits not in PerMessageDeflateOfferAccept.WINDOW_SIZE_PERMISSIBLE_VALUES:
+        raise ValueError("window bits must be between 9 and 15")
+    return bits
+
+def deflate_mem_level(arg):
+    level = int(arg)
+    if level not in PerMessageDeflateOfferAccept.MEM_LEVEL_PERMISSIBLE_VALUES:
+        raise ValueError("memory level must be between 1 and 9")
+    return level
+
+@attr.s(frozen=True)
+class Compression(object):
+    """I decide whether to accept a client's permessage-deflate offer, and
+    with which parameters. Messages shorter than 'min_size' are sent
+    uncompressed even on a compressed connection: deflate framing overhead
+    makes small messages (like acks) bigger, not smaller.
+    """
+    policy = attr.ib(default="off")
+    window_bits = attr.ib(default=None)
+    mem_level = attr.ib(default=None)
+    min_size = attr.ib(default=0)
+
+    def enabled(self):
+        return self.policy != "off"
+
+    def accept(self, offers):
+        for offer in offers:
+            if not isinstance(offer, PerMessageDeflateOffer):
+                continue
+            window_bits = self.window_bits
+            if window_bits and offer.request_max_window_bits:
+                # the client gets to set a lower limit
+                window_bits = min(window_bits, offer.request_max_window_bits)
+            no_context_takeover = None
+            if (self.policy == "no-context-takeover"
+                or offer.request_no_context_takeover):
+                no_context_takeover = True
+            return PerMessageDeflateOfferAccept(
+                offer, no_context_takeover=no_context_takeover,
+                window_bits=window_bits, mem_level=self.mem_level)
+        return None
+
+class TimedDeflate(object):
+    """I wrap a connection's PerMessageDeflate object, and record how much
+    CPU time its (de)compression calls take."""
+    def __init__(self, pmd):
+        self._pmd = pmd
+        self.cpu = 0.0
+
+    def _timed(self, f, *args, **kwargs):
+        start = time.process_time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.cpu += time.process_time() - start
+
+    def start_compress_message(self, *args, **kwargs):
+        return self._timed(self._pmd.start_compress_message, *args, **kwargs)
+    def compress_message_data(self, *args, **kwargs):
+        return self._timed(self._pmd.compress_message_data, *args, **kwargs)
+    def end_compress_message(self, *args, **kwargs):
+        return self._timed(self._pmd.end_compress_message, *args, **kwargs)
+    def start_decompress_message(self, *args, **kwargs):
+        return self._timed(self._pmd.start_decompress_message, *args, **kwargs)
+    def decompress_message_data(self, *args, **kwargs):
+        return self._timed(self._pmd.decompress_message_data, *args, **kwargs)
+    def end_decompress_message(self, *args, **kwargs):
+        return self._timed(self._pmd.end_decompress_message, *args, **kwargs)
+
+    def __getattr__(self, name):
+        # EXTENSION_NAME, get_extension_string(), etc
+        return getattr(self._pmd, name)
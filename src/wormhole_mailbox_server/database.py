@@ -22,8 +22,8 @@ def get_upgrader(name, new_version):
         raise ValueError("no upgrader for %d" % new_version)
 
 
-CHANNELDB_TARGET_VERSION = 2
-USAGEDB_TARGET_VERSION = 2
+CHANNELDB_TARGET_VERSION = 3
+USAGEDB_TARGET_VERSION = 3
 ADDRIDDB_TARGET_VERSION = 1
 
 def dict_factory(cursor, row):
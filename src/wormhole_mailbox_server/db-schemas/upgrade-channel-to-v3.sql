@@ -0,0 +1,28 @@
+-- add `messages`.`id`, for "open {since:}". SQLite cannot add a PRIMARY KEY
+-- column in place, so copy the messages into a new table, preserving their
+-- insertion order
+
+ALTER TABLE `messages` RENAME TO `messages_v2`;
+DROP INDEX `messages_idx`;
+CREATE TABLE `messages`
+(
+ -- `id` increases with each message, so clients can resume with "open
+ -- {since:}" instead of having every message replayed
+ `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+ `app_id` VARCHAR,
+ `mailbox_id` VARCHAR,
+ `side` VARCHAR,
+ `phase` VARCHAR, -- numeric or string
+ `body` VARCHAR,
+ `server_rx` INTEGER,
+ `msg_id` VARCHAR
+);
+CREATE INDEX `messages_idx` ON `messages` (`app_id`, `mailbox_id`);
+INSERT INTO `messages`
+ (`app_id`, `mailbox_id`, `side`, `phase`, `body`, `server_rx`, `msg_id`)
+ SELECT `app_id`, `mailbox_id`, `side`, `phase`, `body`, `server_rx`, `msg_id`
+ FROM `messages_v2` ORDER BY `rowid`;
+DROP TABLE `messages_v2`;
+
+DELETE FROM `version`;
+INSERT INTO `version` (`version`) VALUES (3);
@@ -0,0 +1,11 @@
+
+-- runtime counters (connections shed, commands rate-limited, etc), rewritten
+-- each time `current` is updated
+CREATE TABLE `counters`
+(
+ `name` VARCHAR,
+ `value` INTEGER -- some counters (like reactor lag, in seconds) are floats
+);
+
+DELETE FROM `version`;
+INSERT INTO `version` (`version`) VALUES (3);
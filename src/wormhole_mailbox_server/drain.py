@@ -0,0 +1,89 @@
+import signal
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.application import service
+from twisted.python import log
+
+# Before a planned restart, the operator can put the server into drain mode
+# with SIGUSR1 (and take it out again with SIGUSR2), if it was started with
+# --drain-signals. twistd rotates its log file on SIGUSR1, so if something
+# else already handles that signal, we leave both signals alone. While draining, new
+# connections are told to go away, and existing ones can't start new
+# wormholes, but can finish the ones they have. The server logs how many
+# live mailboxes (ones that a connected client is listening to) are left,
+# and when there are none, so the operator knows it can be restarted.
+
+DRAIN_CHECK_PERIOD = 5.0
+
+class DrainService(service.Service):
+    """I switch the server in and out of drain mode when signalled, and
+    report its progress."""
+    def __init__(self, server, redirect=None, forward=None,
+                 interval=DRAIN_CHECK_PERIOD, reactor=reactor):
+        self._server = server
+        self._redirect = redirect
+        # called with the signal number, to pass it on to worker processes
+        self._forward = forward
+        self._interval = interval
+        self._reactor = reactor
+        self._old_handlers = {}
+        self._checker = LoopingCall(self._check)
+        self._checker.clock = reactor
+        self._remaining = None
+
+    def startService(self):
+        service.Service.startService(self)
+        if signal.getsignal(signal.SIGUSR1) != signal.SIG_DFL:
+            log.msg("SIGUSR1 is already handled (twistd log rotation?),"
+                    " so draining cannot be started by signal")
+            return
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            self._old_handlers[signum] = signal.signal(signum,
+                                                       self._signalled)
+
+    def stopService(self):
+        for signum, handler in self._old_handlers.items():
+            signal.signal(signum, handler)
+        self._old_handlers = {}
+        if self._checker.running:
+            self._checker.stop()
+        return service.Service.stopService(self)
+
+    def _signalled(self, signum, frame):
+        # signal handlers run between Python bytecodes, so the real work is
+        # done from the reactor
+        self._reactor.callFromThread(self._received, signum)
+
+    def _received(self, signum):
+        if self._forward:
+            self._forward(signum)
+        if signum == signal.SIGUSR1:
+            self.start_draining()
+        else:
+            self.stop_draining()
+
+    def start_draining(self):
+        if self._server.is_draining():
+            return
+        log.msg("draining: refusing new connections and wormholes")
+        self._server.start_draining(self._redirect)
+        self._remaining = None
+        self._checker.start(self._interval)
+
+    def stop_draining(self):
+        if not self._server.is_draining():
+            return
+        log.msg("no longer draining")
+        self._server.stop_draining()
+        if self._checker.running:
+            self._checker.stop()
+
+    def _check(self):
+        remaining = self._server.count_live_mailboxes()
+        if remaining == self._remaining:
+            return
+        self._remaining = remaining
+        if remaining:
+            log.msg(f"draining: {remaining} live mailboxes left")
+        else:
+            log.msg("drained: no live mailboxes left, ready to restart")
@@ -0,0 +1,130 @@
+from binascii import Error as HexError
+from .util import dict_to_bytes, bytes_to_dict, hexstr_to_bytes
+
+# Clients which don't ask for a subprotocol get JSON, with message bodies as
+# hex strings. These optional subprotocols carry the same messages as binary
+# CBOR or msgpack frames, with bodies as raw bytes. Each is only offered if
+# its library can be imported (pip install magic-wormhole-mailbox-server[binary]).
+CBOR_SUBPROTOCOL = "wormhole.cbor"
+MSGPACK_SUBPROTOCOL = "wormhole.msgpack"
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class FrameError(Exception):
+    """An inbound frame could not be decoded into a command. 'reason' is a
+    short name for the problem, used in the rejection counters."""
+    def __init__(self, reason, message):
+        Exception.__init__(self, message)
+        self.reason = reason
+
+class Framing(object):
+    def __init__(self, subprotocol, dumps, loads, is_binary, looks_like_map):
+        self.subprotocol = subprotocol # None for JSON
+        self.is_binary = is_binary
+        self._dumps = dumps
+        self._loads = loads
+        self._looks_like_map = looks_like_map
+
+    def encode(self, d):
+        assert isinstance(d, dict)
+        return self._dumps(d)
+
+    def decode(self, payload):
+        # every command is a map, which each encoding announces in its first
+        # byte, so most garbage can be turned away without parsing it
+        if not self._looks_like_map(payload):
+            raise FrameError("not_object", "frame is not an object")
+        try:
+            d = self._loads(payload)
+        except Exception: # each library has its own exceptions
+            raise FrameError("malformed", "frame could not be decoded")
+        if not isinstance(d, dict):
+            raise FrameError("not_object", "frame is not an object")
+        return d
+
+    def body_to_client(self, body):
+        # bodies are stored as hex, which binary clients get as raw bytes
+        if not self.is_binary:
+            return body
+        try:
+            return hexstr_to_bytes(body)
+        except (HexError, ValueError, AssertionError):
+            return body # not hex: pass it through unchanged
+
+# Message bodies can be large (a file-transfer offer, or a whole text
+# message), and json.dumps() spends most of its time scanning them for
+# characters to escape. Hex never needs escaping, so hex bodies above this
+# size are spliced into the encoded frame as-is.
+SPLICE_MIN = 1024
+HEXDIGITS = b"0123456789abcdefABCDEF"
+
+def _hex_ascii(body):
+    # returns the body as ASCII bytes, or None if it isn't plain hex
+    if not body.isascii(): # O(1)
+        return None
+    raw = body.encode("ascii")
+    if raw.translate(None, HEXDIGITS):
+        return None
+    return raw
+
+def json_dumps(d):
+    body = d.get("body")
+    if isinstance(body, str) and len(body) >= SPLICE_MIN:
+        raw = _hex_ascii(body)
+        if raw is not None:
+            rest = dict(d)
+            del rest["body"]
+            head = dict_to_bytes(rest)[:-1] # without the closing brace
+            sep = b", " if rest else b""
+            return b"".join([head, sep, b'"body": "', raw, b'"}'])
+    return dict_to_bytes(d)
+
+JSON_WHITESPACE = b" \t\n\r"
+
+def _json_object(payload):
+    # find the first and last non-whitespace bytes by index: strip() would
+    # copy the whole frame, which may be up to --max-message-size= long
+    start, end = 0, len(payload)
+    while start < end and payload[start] in JSON_WHITESPACE:
+        start += 1
+    while end > start and payload[end-1] in JSON_WHITESPACE:
+        end -= 1
+    return (end - start >= 2 and payload[start:start+1] == b"{"
+            and payload[end-1:end] == b"}")
+
+def _cbor_map(payload):
+    return payload[:1] != b"" and 0xa0 <= payload[0] <= 0xbf # major type 5
+
+def _msgpack_map(payload):
+    # fixmap, map16, map32
+    return payload[:1] != b"" and (0x80 <= payload[0] <= 0x8f
+                                   or payload[0] in (0xde, 0xdf))
+
+JSON = Framing(None, json_dumps, bytes_to_dict, False, _json_object)
+
+FRAMINGS = {} # subprotocol name -> Framing
+if cbor2:
+    FRAMINGS[CBOR_SUBPROTOCOL] = Framing(CBOR_SUBPROTOCOL,
+                                         cbor2.dumps, cbor2.loads, True,
+                                         _cbor_map)
+if msgpack:
+    FRAMINGS[MSGPACK_SUBPROTOCOL] = Framing(
+        MSGPACK_SUBPROTOCOL,
+        lambda d: msgpack.packb(d, use_bin_type=True),
+        lambda b: msgpack.unpackb(b, raw=False),
+        True, _msgpack_map)
+
+def choose_framing(offered):
+    """Return the Framing for the first of the client's offered
+    subprotocols that we support, or JSON if none are."""
+    for subprotocol in offered:
+        if subprotocol in FRAMINGS:
+            return FRAMINGS[subprotocol]
+    return JSON
@@ -0,0 +1,190 @@
+import os, socket
+from twisted.internet import defer, protocol
+from twisted.internet.task import LoopingCall
+from twisted.application import service
+from twisted.python import log
+
+# With --handoff-socket=PATH, a new server process can replace a running
+# one without ever refusing a connection. The running server listens on
+# PATH. When the new one starts (with the same --handoff-socket= and the
+# same --channel-db=), it connects to PATH, and the old server passes it
+# the listening socket (SCM_RIGHTS). From then on, new connections go to
+# the new process. The old one stops accepting, and keeps serving its
+# existing connections until they finish (or --handoff-drain= runs out),
+# then exits. While both are running they share the channel database, and
+# each polls it for messages the other has added to mailboxes its own
+# clients are listening to. The new process takes over PATH, ready for the
+# next deploy.
+
+REQUEST = b"handoff\n"
+SENT = b"sent\n"
+RECEIVED = b"received\n"
+DRAIN_CHECK_PERIOD = 1.0
+POLL_INTERVAL = 0.25 # how often to look for the other process's messages
+
+def take_over(path):
+    """If a server is listening on 'path', take its listening socket.
+    Returns (fd, family, connection), where 'connection' is a socket which
+    stays open until the old server exits, or None if there is no old
+    server. This blocks, and is meant to be called before the reactor
+    starts."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        s.close()
+        return None
+    s.sendall(REQUEST)
+    # the descriptor arrives along with the first byte of the response
+    data, fds = b"", []
+    while len(data) < len(SENT):
+        more, more_fds, flags, addr = socket.recv_fds(s, len(SENT) - len(data),
+                                                      1)
+        if not more:
+            break
+        data += more
+        fds.extend(more_fds)
+    if data != SENT or len(fds) != 1:
+        s.close()
+        for fd in fds:
+            os.close(fd)
+        raise ValueError(f"bad handoff response from {path}")
+    s.sendall(RECEIVED)
+    with socket.socket(fileno=os.dup(fds[0])) as listener:
+        family = listener.family
+    return (fds[0], family, s)
+
+
+class _OldServerProtocol(protocol.Protocol):
+    # our connection to the server we took over from
+    def connectionLost(self, reason):
+        self.factory.service._old_server_exited()
+
+class _HandoffProtocol(protocol.Protocol):
+    # a new server, asking for our listening socket
+    def connectionMade(self):
+        self._buffer = b""
+    def dataReceived(self, data):
+        self._buffer += data
+        if self._buffer == REQUEST:
+            self.factory.service._send_port(self)
+        elif self._buffer == REQUEST + RECEIVED:
+            self.factory.service._handed_off()
+        elif not (REQUEST + RECEIVED).startswith(self._buffer):
+            self.transport.loseConnection()
+
+
+class HandoffService(service.Service):
+    """I listen for clients on 'endpoint' (or on the socket inherited from
+    an older server), and hand that socket over to a newer server."""
+    def __init__(self, reactor, endpoint, site, server, path, drain_timeout,
+                 inherited=None):
+        self._reactor = reactor
+        self._endpoint = endpoint
+        self._site = site
+        self._server = server
+        self._path = path
+        self._drain_timeout = drain_timeout
+        self._inherited = inherited
+        self._port = None
+        self._handoff_port = None
+        self._old_server = None
+        self._draining = None
+        self._poller = LoopingCall(self._server.poll_shared_mailboxes)
+        self._poller.clock = reactor
+
+    def startService(self):
+        service.Service.startService(self)
+        if self._inherited:
+            (fd, family, old_server) = self._inherited
+            self._inherited = None
+            os.set_blocking(fd, False)
+            self._port = self._reactor.adoptStreamPort(fd, family, self._site)
+            os.close(fd)
+            log.msg("took over the listening socket from the old server")
+            # until it exits, it may add messages to our mailboxes
+            self._share(True)
+            f = protocol.Factory.forProtocol(_OldServerProtocol)
+            f.service = self
+            old_server.setblocking(False)
+            self._old_server = self._reactor.adoptStreamConnection(
+                old_server.fileno(), socket.AF_UNIX, f)
+            old_server.close()
+            d = defer.succeed(None)
+        else:
+            d = self._endpoint.listen(self._site)
+            d.addCallback(self._listening)
+        d.addCallback(lambda _: self._listen_for_handoff())
+        d.addErrback(log.err)
+
+    def _listening(self, port):
+        self._port = port
+
+    def _listen_for_handoff(self):
+        if os.path.exists(self._path):
+            os.unlink(self._path) # stale, or the old server's (now unused)
+        f = protocol.Factory.forProtocol(_HandoffProtocol)
+        f.service = self
+        self._handoff_port = self._reactor.listenUNIX(self._path, f)
+
+    def _share(self, sharing):
+        self._server.set_sharing(sharing)
+        if sharing and not self._poller.running:
+            self._poller.start(POLL_INTERVAL, now=False)
+        if not sharing and self._poller.running:
+            self._poller.stop()
+
+    def _old_server_exited(self):
+        log.msg("the old server has exited")
+        self._old_server = None
+        self._share(False)
+
+    def _send_port(self, p):
+        if self._port is None or self._draining:
+            p.transport.loseConnection()
+            return
+        # stop listening first, because that deletes our PATH, and the new
+        # server is about to create its own
+        self._handoff_port.stopListening()
+        self._handoff_port = None
+        # and the new server may start adding messages right away
+        self._share(True)
+        p.transport.sendFileDescriptor(self._port.fileno())
+        p.transport.write(SENT)
+
+    def _handed_off(self):
+        # the new server has the socket now, so ours can be closed without
+        # refusing anybody. But not shut down, which would stop it
+        # accepting in the new server too (adopted ports already skip this).
+        self._port._shouldShutdown = False
+        self._port.stopListening()
+        self._port = None
+        log.msg("handed off the listening socket, draining connections")
+        self._drain_started = self._reactor.seconds()
+        self._draining = LoopingCall(self._check_drained)
+        self._draining.clock = self._reactor
+        self._draining.start(DRAIN_CHECK_PERIOD)
+
+    def _check_drained(self):
+        remaining = self._site.ws_factory.getConnectionCount()
+        elapsed = self._reactor.seconds() - self._drain_started
+        if remaining and elapsed < self._drain_timeout:
+            return
+        log.msg(f"drained ({remaining} connections left), exiting")
+        self._draining.stop()
+        self._reactor.stop()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        ds = []
+        if self._draining and self._draining.running:
+            self._draining.stop()
+        if self._poller.running:
+            self._poller.stop()
+        if self._handoff_port:
+            ds.append(defer.maybeDeferred(self._handoff_port.stopListening))
+        if self._port:
+            ds.append(defer.maybeDeferred(self._port.stopListening))
+        if self._old_server:
+            self._old_server.loseConnection()
+        return defer.DeferredList(ds)
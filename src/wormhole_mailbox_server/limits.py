@@ -0,0 +1,104 @@
+import attr
+
+class QuotaError(Exception):
+    pass
+
+@attr.s(frozen=True)
+class Limits(object):
+    """Storage limits, None meaning unlimited. Message bodies are measured
+    in bytes after hex-decoding, so JSON and binary clients see the same
+    limits. The max_app_* limits apply to each app_id separately, and can
+    be changed for individual apps (see for_app()).
+    """
+    max_body = attr.ib(default=None)
+    max_mailbox_messages = attr.ib(default=None)
+    max_mailbox_bytes = attr.ib(default=None)
+    max_app_mailboxes = attr.ib(default=None)
+    max_field_length = attr.ib(default=None)
+    max_channels = attr.ib(default=None)
+    max_app_nameplates = attr.ib(default=None)
+    max_app_connections = attr.ib(default=None)
+    max_app_command_rate = attr.ib(default=None) # commands per second
+
+    def active(self):
+        return any(v is not None for v in attr.astuple(self))
+
+    def app_active(self):
+        return any(v is not None for v in (self.max_app_nameplates,
+                                           self.max_app_mailboxes,
+                                           self.max_app_connections,
+                                           self.max_app_command_rate))
+
+    def for_app(self, overrides):
+        # 'overrides' is a dict like {"nameplates": 100}, from --app-limit=
+        return attr.evolve(self, **{APP_LIMITS[name]: value
+                                    for name, value in overrides.items()})
+
+    def check_field(self, name, value):
+        if (self.max_field_length is not None and isinstance(value, str)
+            and len(value) > self.max_field_length):
+            raise QuotaError(f"'{name}' is too long"
+                             f" (max {self.max_field_length} characters)")
+
+    def check_message(self, body, mailbox_messages, mailbox_bytes):
+        # 'mailbox_messages' and 'mailbox_bytes' describe the mailbox
+        # before this message is added
+        size = body_size(body)
+        if self.max_body is not None and size > self.max_body:
+            raise QuotaError(f"body is too large (max {self.max_body} bytes)")
+        if (self.max_mailbox_messages is not None
+            and mailbox_messages + 1 > self.max_mailbox_messages):
+            raise QuotaError("mailbox is full (too many messages)")
+        if (self.max_mailbox_bytes is not None
+            and mailbox_bytes + size > self.max_mailbox_bytes):
+            raise QuotaError("mailbox is full (too many bytes)")
+
+    def check_app_mailboxes(self, app_mailboxes):
+        # 'app_mailboxes' does not include the one being created
+        if (self.max_app_mailboxes is not None
+            and app_mailboxes + 1 > self.max_app_mailboxes):
+            raise QuotaError("too many mailboxes for this app")
+
+    def check_app_nameplates(self, app_nameplates):
+        # 'app_nameplates' does not include the one being created
+        if (self.max_app_nameplates is not None
+            and app_nameplates + 1 > self.max_app_nameplates):
+            raise QuotaError("too many nameplates for this app")
+
+    def check_app_connections(self, app_connections):
+        # 'app_connections' does not include the one being bound
+        if (self.max_app_connections is not None
+            and app_connections + 1 > self.max_app_connections):
+            raise QuotaError("too many connections for this app")
+
+    def check_channels(self, channels):
+        # 'channels' does not include the connection's default channel, or
+        # the one being created
+        if (self.max_channels is not None
+            and channels + 1 > self.max_channels):
+            raise QuotaError("too many channels on this connection")
+
+# --app-limit=APP_ID:NAME=VALUE names, and the Limits field each one sets
+APP_LIMITS = {
+    "nameplates": "max_app_nameplates",
+    "mailboxes": "max_app_mailboxes",
+    "connections": "max_app_connections",
+    "command-rate": "max_app_command_rate",
+}
+
+def parse_app_limit(arg):
+    # APP_ID:NAME=VALUE -> (app_id, name, value). App ids may contain ':'.
+    target, sep, value = arg.rpartition("=")
+    app_id, sep2, name = target.rpartition(":")
+    if not sep or not sep2 or not app_id:
+        raise ValueError("format app limits as APP_ID:NAME=VALUE")
+    if name not in APP_LIMITS:
+        raise ValueError(f"unknown app limit {name!r}")
+    value = float(value) if name == "command-rate" else int(value)
+    if value <= 0:
+        raise ValueError("app limits must be positive")
+    return (app_id, name, value)
+
+def body_size(body):
+    # bodies are stored as hex strings
+    return len(str(body)) // 2
@@ -0,0 +1,279 @@
+from collections import Counter
+from zope.interface import implementer
+from .storage import IChannelStore, IAddressIDStore
+
+# Stores which keep everything in dicts: nothing survives a restart, and
+# nothing can be shared with another process. Useful for tests, and as a
+# baseline when measuring other stores.
+
+@implementer(IChannelStore)
+class MemoryChannelStore(object):
+    def __init__(self):
+        self._nameplates = {} # app_id -> name -> {mailbox_id, sides}
+        self._mailboxes = {} # app_id -> mailbox_id -> {for_nameplate,
+                             #                updated, sides, messages}
+        self._next_seq = 1
+        self._connections = {} # id -> row, with "messages"
+        self._next_connection_id = 1
+        self._addrid_generation = None
+
+    def commit(self):
+        pass
+
+    # nameplates
+
+    def _nameplate(self, app_id, name):
+        return self._nameplates.get(app_id, {}).get(name)
+
+    def get_nameplates(self, app_id):
+        return {name: np["mailbox_id"]
+                for (name, np) in self._nameplates.get(app_id, {}).items()}
+
+    def get_nameplate(self, app_id, name):
+        np = self._nameplate(app_id, name)
+        return np["mailbox_id"] if np else None
+
+    def accepts_mailbox_id(self, app_id, name, mailbox_id):
+        return True
+
+    def add_nameplate(self, app_id, name, mailbox_id):
+        self._nameplates.setdefault(app_id, {})[name] = {
+            "mailbox_id": mailbox_id, "sides": []}
+
+    def get_nameplate_sides(self, app_id, name):
+        np = self._nameplate(app_id, name)
+        return [dict(side) for side in np["sides"]] if np else []
+
+    def add_nameplate_side(self, app_id, name, side, when):
+        np = self._nameplate(app_id, name)
+        if np:
+            np["sides"].append({"side": side, "claimed": True,
+                                "added": when})
+
+    def release_nameplate_side(self, app_id, name, side):
+        np = self._nameplate(app_id, name)
+        for row in (np["sides"] if np else []):
+            if row["side"] == side:
+                row["claimed"] = False
+
+    def delete_nameplate(self, app_id, name):
+        nameplates = self._nameplates.get(app_id, {})
+        nameplates.pop(name, None)
+        if not nameplates:
+            self._nameplates.pop(app_id, None)
+
+    def count_nameplates(self, app_id):
+        return len(self._nameplates.get(app_id, {}))
+
+    # mailboxes
+
+    def _mailbox(self, app_id, mailbox_id):
+        return self._mailboxes.get(app_id, {}).get(mailbox_id)
+
+    def get_mailboxes(self, app_id):
+        return {mailbox_id: mb["updated"]
+                for (mailbox_id, mb) in self._mailboxes.get(app_id, {}).items()}
+
+    def get_mailbox(self, app_id, mailbox_id):
+        mb = self._mailbox(app_id, mailbox_id)
+        if not mb:
+            return None
+        return {"for_nameplate": mb["for_nameplate"],
+                "updated": mb["updated"]}
+
+    def add_mailbox(self, app_id, mailbox_id, for_nameplate, when):
+        self._mailboxes.setdefault(app_id, {})[mailbox_id] = {
+            "for_nameplate": for_nameplate,
+            "updated": when,
+            "sides": [],
+            "messages": []}
+
+    def touch_mailbox(self, app_id, mailbox_id, when):
+        mb = self._mailbox(app_id, mailbox_id)
+        if mb:
+            mb["updated"] = when
+
+    def get_mailbox_sides(self, app_id, mailbox_id):
+        mb = self._mailbox(app_id, mailbox_id)
+        return [dict(side) for side in mb["sides"]] if mb else []
+
+    def add_mailbox_side(self, app_id, mailbox_id, side, when):
+        mb = self._mailbox(app_id, mailbox_id)
+        if mb:
+            mb["sides"].append({"side": side, "opened": True,
+                                "added": when, "mood": None})
+
+    def close_mailbox_side(self, app_id, mailbox_id, side, mood):
+        mb = self._mailbox(app_id, mailbox_id)
+        for row in (mb["sides"] if mb else []):
+            if row["side"] == side:
+                row["opened"] = False
+                row["mood"] = mood
+
+    def delete_mailbox(self, app_id, mailbox_id):
+        for name, np in list(self._nameplates.get(app_id, {}).items()):
+            if np["mailbox_id"] == mailbox_id:
+                self.delete_nameplate(app_id, name)
+        mailboxes = self._mailboxes.get(app_id, {})
+        mailboxes.pop(mailbox_id, None)
+        if not mailboxes:
+            self._mailboxes.pop(app_id, None)
+
+    def count_mailboxes(self, app_id):
+        return len(self._mailboxes.get(app_id, {}))
+
+    def prune(self, app_id, old, limit=None):
+        nameplates = []
+        mailboxes = []
+        for (mailbox_id, mb) in list(self._mailboxes.get(app_id, {}).items()):
+            if mb["updated"] > old:
+                continue
+            if limit is not None and len(mailboxes) == limit:
+                break
+            for (name, np) in list(self._nameplates.get(app_id, {}).items()):
+                if np["mailbox_id"] == mailbox_id:
+                    nameplates.append(self.get_nameplate_sides(app_id, name))
+            mailboxes.append((mb["for_nameplate"],
+                              self.get_mailbox_sides(app_id, mailbox_id)))
+            self.delete_mailbox(app_id, mailbox_id)
+        return nameplates, mailboxes
+
+    # messages
+
+    def add_message(self, app_id, mailbox_id, side, phase, body, server_rx,
+                    msg_id):
+        seq = self._next_seq
+        self._next_seq += 1
+        mb = self._mailbox(app_id, mailbox_id)
+        if mb:
+            mb["messages"].append({"seq": seq, "side": side, "phase": phase,
+                                   "body": body, "server_rx": server_rx,
+                                   "msg_id": msg_id})
+        return seq
+
+    def get_messages(self, app_id, mailbox_id, since=0):
+        mb = self._mailbox(app_id, mailbox_id)
+        return [dict(m) for m in (mb["messages"] if mb else [])
+                if m["seq"] > since]
+
+    def get_last_seq(self, app_id, mailbox_id):
+        mb = self._mailbox(app_id, mailbox_id)
+        if not mb or not mb["messages"]:
+            return 0
+        return mb["messages"][-1]["seq"]
+
+    def has_message(self, app_id, mailbox_id, side, phase, msg_id):
+        mb = self._mailbox(app_id, mailbox_id)
+        return any(m["side"] == side and m["phase"] == phase
+                   and m["msg_id"] == msg_id
+                   for m in (mb["messages"] if mb else []))
+
+    def get_mailbox_size(self, app_id, mailbox_id):
+        mb = self._mailbox(app_id, mailbox_id)
+        messages = mb["messages"] if mb else []
+        return (len(messages), sum(len(m["body"]) for m in messages))
+
+    # statistics
+
+    def get_app_ids(self):
+        return set(self._nameplates) | set(self._mailboxes)
+
+    def count_all_nameplates(self):
+        return {app_id: len(nameplates)
+                for (app_id, nameplates) in self._nameplates.items()}
+
+    def count_all_mailboxes(self):
+        return {app_id: len(mailboxes)
+                for (app_id, mailboxes) in self._mailboxes.items()}
+
+    def get_largest_mailbox(self):
+        all_mailboxes = [mb for mailboxes in self._mailboxes.values()
+                         for mb in mailboxes.values()]
+        return (max((len(mb["messages"]) for mb in all_mailboxes), default=0),
+                max((sum(len(m["body"]) for m in mb["messages"])
+                     for mb in all_mailboxes), default=0))
+
+    # connections
+
+    def clear_connections(self):
+        self._connections.clear()
+
+    def add_connection(self, addrid_generation, addrid_counter, now):
+        connection_id = self._next_connection_id
+        self._next_connection_id += 1
+        self._connections[connection_id] = {
+            "id": connection_id,
+            "addrid_generation": addrid_generation,
+            "addrid_counter": addrid_counter,
+            "connected": now,
+            "side": None,
+            "implementation": None,
+            "version": None,
+            "active": now,
+            "messages": [],
+            }
+        return connection_id
+
+    def set_connection_side(self, connection_id, side, implementation,
+                            version):
+        c = self._connections.get(connection_id)
+        if c:
+            c.update(side=side, implementation=implementation,
+                     version=version)
+
+    def add_connection_message(self, connection_id, now, name):
+        c = self._connections.get(connection_id)
+        if c:
+            c["active"] = now
+            c["messages"].append({"when": now, "name": name})
+
+    def remove_connection(self, connection_id):
+        self._connections.pop(connection_id, None)
+
+    def get_connections(self):
+        return [{k: v for (k, v) in c.items() if k != "messages"}
+                for (connection_id, c) in sorted(self._connections.items())]
+
+    def get_connection_messages(self, connection_id):
+        c = self._connections.get(connection_id)
+        return [dict(m) for m in c["messages"]] if c else []
+
+    def get_addrid_generation(self):
+        if self._addrid_generation is None:
+            return None
+        return dict(self._addrid_generation)
+
+    def set_addrid_generation(self, generation, started):
+        self._addrid_generation = {"generation": generation,
+                                   "started": started}
+
+
+@implementer(IAddressIDStore)
+class MemoryAddressIDStore(object):
+    def __init__(self):
+        self._ids = {} # (addr_type, address) -> (generation, counter)
+        self._addresses = {} # (generation, counter) -> (addr_type, address)
+        self._last_counters = Counter() # generation -> counter
+
+    def commit(self):
+        pass
+
+    def clear(self):
+        self._ids.clear()
+        self._addresses.clear()
+        self._last_counters.clear()
+
+    def get_id(self, addr_type, address):
+        return self._ids.get((addr_type, address))
+
+    def get_address(self, generation, counter):
+        return self._addresses.get((generation, counter))
+
+    def get_last_counter(self, generation):
+        return self._last_counters[generation]
+
+    def add_id(self, generation, counter, addr_type, address):
+        self._ids[(addr_type, address)] = (generation, counter)
+        self._addresses[(generation, counter)] = (addr_type, address)
+        self._last_counters[generation] = max(self._last_counters[generation],
+                                              counter)
@@ -0,0 +1,56 @@
+from twisted.internet import reactor
+from twisted.application import service
+
+LAG_CHECK_INTERVAL = 1.0
+
+class OverloadGovernor(service.Service):
+    """I decide whether new connections should be turned away.
+
+    While running, I keep a timer scheduled LAG_CHECK_INTERVAL seconds in
+    the future, and measure how late it actually fires. When the reactor is
+    busy, that lateness grows, and new connections (each of which costs an
+    address-id lookup and a connection-table INSERT) would only make it
+    worse. Established connections are never affected.
+    """
+    def __init__(self, max_lag=None, max_connections=None,
+                 interval=LAG_CHECK_INTERVAL, reactor=reactor):
+        self._max_lag = max_lag
+        self._max_connections = max_connections
+        self._interval = interval
+        self._reactor = reactor
+        self._timer = None
+        self._expected = None
+        self.lag = 0.0
+        self.shed = {"lag": 0, "connections": 0}
+
+    def startService(self):
+        service.Service.startService(self)
+        self._schedule()
+
+    def stopService(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        return service.Service.stopService(self)
+
+    def _schedule(self):
+        self._expected = self._reactor.seconds() + self._interval
+        self._timer = self._reactor.callLater(self._interval, self._check_lag)
+
+    def _check_lag(self):
+        self.lag = max(0.0, self._reactor.seconds() - self._expected)
+        self._schedule()
+
+    def check(self, open_connections):
+        """Return None to accept a new connection, or the reason (a string)
+        why it should be rejected. 'open_connections' includes the new one.
+        """
+        reason = None
+        if (self._max_connections is not None
+            and open_connections > self._max_connections):
+            reason = "connections"
+        elif self._max_lag is not None and self.lag > self._max_lag:
+            reason = "lag"
+        if reason:
+            self.shed[reason] += 1
+        return reason
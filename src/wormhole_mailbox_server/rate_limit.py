@@ -0,0 +1,115 @@
+from collections import Counter
+
+# Commands are grouped into classes, and each class gets its own rate and
+# burst size. "bind" and "ping" are never limited.
+COMMAND_CLASSES = {
+    "list": "list",
+    "allocate": "nameplate",
+    "claim": "nameplate",
+    "claim-open": "nameplate",
+    "release": "nameplate",
+    "open": "mailbox",
+    "close": "mailbox",
+    "add": "add",
+}
+
+def parse_rate_limit(arg):
+    # CLASS:RATE[:BURST], RATE is commands per second
+    pieces = arg.split(":")
+    if len(pieces) not in (2, 3):
+        raise ValueError("format rate limits as CLASS:RATE[:BURST]")
+    cmdclass = pieces[0]
+    if cmdclass not in set(COMMAND_CLASSES.values()):
+        raise ValueError(f"unknown command class {cmdclass!r}")
+    rate = float(pieces[1])
+    burst = float(pieces[2]) if len(pieces) == 3 else max(rate, 1.0)
+    if rate <= 0 or burst < 1:
+        raise ValueError("RATE must be positive, and BURST at least 1")
+    return (cmdclass, rate, burst)
+
+class RateLimiter(object):
+    """I hold a token bucket for each (command class, key) pair.
+
+    Keys are small tuples like ("addrid", generation, counter), ("host",
+    peer_host), or ("side", app_id, side). Each bucket is a two-item list
+    of [tokens, updated]. Buckets which have refilled completely carry no
+    information, so prune() drops them, and new_generation() drops
+    everything when the address-id generation turns over.
+    """
+    def __init__(self, limits):
+        self._limits = {} # cmdclass -> (rate, burst)
+        for (cmdclass, rate, burst) in limits:
+            self._limits[cmdclass] = (rate, burst)
+        self._buckets = {} # (cmdclass, key) -> [tokens, updated]
+        self.rejected = 0
+
+    def allow(self, keys, mtype, now):
+        cmdclass = COMMAND_CLASSES.get(mtype)
+        if cmdclass not in self._limits:
+            return True
+        rate, burst = self._limits[cmdclass]
+        buckets = []
+        for key in keys:
+            if key is None:
+                continue
+            bucket = self._buckets.get((cmdclass, key))
+            if bucket is None:
+                bucket = self._buckets[(cmdclass, key)] = [burst, now]
+            else:
+                elapsed = max(now - bucket[1], 0)
+                bucket[0] = min(burst, bucket[0] + elapsed * rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                # don't charge the other buckets for a rejected command
+                self.rejected += 1
+                return False
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket[0] -= 1
+        return True
+
+    def prune(self, now):
+        for (cmdclass, key), (tokens, updated) in list(self._buckets.items()):
+            rate, burst = self._limits[cmdclass]
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[(cmdclass, key)]
+
+    def new_generation(self):
+        # the counters in address-ids are reused by the next generation, and
+        # host-keyed buckets hold IP addresses, which should not outlive the
+        # address table
+        self._buckets.clear()
+
+    def count_buckets(self):
+        return len(self._buckets)
+
+
+class AppRateLimiter(object):
+    """I hold one token bucket for each app_id, which every command from
+    that app's connections draws from, so that one busy app can't use up
+    the whole server. Each app may have its own rate (see
+    Limits.for_app()), and its burst is one second's worth.
+    """
+    def __init__(self):
+        self._buckets = {} # app_id -> [tokens, updated, rate]
+        self.rejected = Counter() # app_id -> commands refused
+
+    def allow(self, app_id, rate, now):
+        burst = max(rate, 1.0)
+        bucket = self._buckets.get(app_id)
+        if bucket is None or bucket[2] != rate:
+            bucket = self._buckets[app_id] = [burst, now, rate]
+        else:
+            elapsed = max(now - bucket[1], 0)
+            bucket[0] = min(burst, bucket[0] + elapsed * rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self.rejected[app_id] += 1
+            return False
+        bucket[0] -= 1
+        return True
+
+    def prune(self, now):
+        for app_id, (tokens, updated, rate) in list(self._buckets.items()):
+            if tokens + (now - updated) * rate >= max(rate, 1.0):
+                del self._buckets[app_id]
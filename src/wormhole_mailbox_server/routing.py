@@ -0,0 +1,189 @@
+import bisect, hashlib, itertools
+from twisted.internet import defer, endpoints
+from twisted.python import log
+from autobahn.twisted import websocket
+from .util import dict_to_bytes, bytes_to_dict
+
+# When the mailbox service is spread over several nodes (worker processes
+# on one machine, or the nodes of a cluster), every nameplate and mailbox is
+# owned by exactly one of them, chosen by hashing its name onto a ring of
+# nodes: (app_id, name) for nameplates, and the mailbox id (which is unique
+# across apps) for mailboxes. Nameplates a node allocates, and the mailbox ids it generates, are
+# always ones it owns, so a nameplate and its mailbox live on the same node.
+#
+# A client may connect to any node. That node handles commands for state it
+# owns itself, and forwards the rest over a "link": an ordinary WebSocket
+# connection to the owner, opened on behalf of that one client, on which the
+# owner sees the client's bind and address (via X-Real-IP). Everything the
+# owner sends back on the link (acks, errors, messages) is relayed to the
+# client unchanged.
+
+REPLICAS = 100 # points on the ring for each node
+
+def _hash(s):
+    return int.from_bytes(hashlib.sha256(s.encode("utf-8")).digest()[:8],
+                          "big")
+
+class HashRing(object):
+    """Consistent hashing: adding or removing a node only moves the keys
+    on either side of that node's points."""
+    def __init__(self, nodes, replicas=REPLICAS):
+        assert nodes
+        points = sorted((_hash(f"{node}#{i}"), node)
+                        for node in nodes for i in range(replicas))
+        self._hashes = [h for (h, node) in points]
+        self._nodes = [node for (h, node) in points]
+
+    def owner(self, key):
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[i]
+
+def nameplate_key(app_id, name):
+    return f"nameplate:{app_id}:{name}"
+
+def mailbox_key(mailbox_id):
+    return f"mailbox:{mailbox_id}"
+
+class Router(object):
+    """I know which node owns each nameplate and mailbox, and how to reach
+    the others. 'peers' maps each other node's name to a client endpoint
+    string for its internal listener."""
+    def __init__(self, me, peers, reactor):
+        assert me not in peers
+        self.me = me
+        self._peers = dict(peers)
+        self._ring = HashRing([me] + list(self._peers))
+        self._reactor = reactor
+
+    def peers(self):
+        return sorted(self._peers)
+
+    def owner_of_nameplate(self, app_id, name):
+        return self._ring.owner(nameplate_key(app_id, name))
+
+    def owner_of_mailbox(self, mailbox_id):
+        return self._ring.owner(mailbox_key(mailbox_id))
+
+    def owns_nameplate(self, app_id, name):
+        return self.owner_of_nameplate(app_id, name) == self.me
+
+    def owns_mailbox(self, mailbox_id):
+        return self.owner_of_mailbox(mailbox_id) == self.me
+
+    def connect(self, node, peer_addr_port, bind, received, lost):
+        """Open a Link to 'node' for one client connection."""
+        ep = endpoints.clientFromString(self._reactor, self._peers[node])
+        return Link(ep, peer_addr_port, bind, received, lost)
+
+
+_hidden_ids = itertools.count(0)
+
+class LinkProtocol(websocket.WebSocketClientProtocol):
+    def onOpen(self):
+        self.factory.link._opened(self)
+    def onMessage(self, payload, isBinary):
+        self.factory.link._received(bytes_to_dict(payload))
+    def onClose(self, wasClean, code, reason):
+        self.factory.link._closed(reason)
+
+class Link(object):
+    """One client's connection to the node which owns some of its state.
+    Commands sent before the connection is open are queued. The link's own
+    traffic (the welcome, and acks for its bind and fan-out commands) is
+    not passed on."""
+    def __init__(self, endpoint, peer_addr_port, bind, received, lost):
+        self._received_f = received
+        self._lost_f = lost
+        self._connected = None # the LinkProtocol, once TCP is connected
+        self._protocol = None # the same, once the WebSocket is open
+        self._closing = False
+        self._hidden = set() # ids of commands the client didn't send
+        self._pending_lists = [] # (id, Deferred), oldest first
+        # the client's bind, minus client_version, which the node it
+        # connected to has already logged
+        bind = {k: v for (k, v) in bind.items() if k != "client_version"}
+        self._queue = [self._hide(bind)]
+        (peer_type, peer_host, peer_port) = peer_addr_port
+        headers = {"X-Real-IP": peer_host, "X-Real-Port": str(peer_port)}
+        f = websocket.WebSocketClientFactory("ws://mailbox/v1",
+                                             headers=headers)
+        f.protocol = LinkProtocol
+        f.link = self
+        self._d = endpoint.connect(f)
+        self._d.addCallbacks(self._tcp_connected, self._failed)
+
+    def _hide(self, msg):
+        msg = dict(msg, id="link-%d" % next(_hidden_ids))
+        self._hidden.add(msg["id"])
+        return msg
+
+    def send(self, msg):
+        if self._protocol:
+            self._protocol.sendMessage(dict_to_bytes(msg), False)
+        else:
+            self._queue.append(msg)
+
+    def list_nameplates(self):
+        """Ask the other node for its nameplate ids. Fires with a list,
+        which is empty if the node could not be asked."""
+        msg = self._hide({"type": "list"})
+        d = defer.Deferred()
+        self._pending_lists.append((msg["id"], d))
+        self.send(msg)
+        return d
+
+    def close(self):
+        self._closing = True
+        if self._connected:
+            self._connected.transport.loseConnection()
+        else:
+            self._d.cancel()
+
+    def _tcp_connected(self, protocol):
+        self._connected = protocol
+
+    def _opened(self, protocol):
+        if self._closing:
+            return
+        self._protocol = protocol
+        queue, self._queue = self._queue, []
+        for msg in queue:
+            self.send(msg)
+
+    def _received(self, msg):
+        mtype = msg.get("type")
+        if mtype == "welcome":
+            return
+        if mtype == "ack" and msg.get("id") in self._hidden:
+            return
+        if mtype == "nameplates" and self._pending_lists:
+            (mid, d) = self._pending_lists.pop(0)
+            self._hidden.discard(mid)
+            d.callback([n["id"] for n in msg["nameplates"]])
+            return
+        if mtype == "error":
+            orig_id = (msg.get("orig") or {}).get("id")
+            if orig_id in self._hidden:
+                for (mid, d) in self._pending_lists:
+                    if mid == orig_id:
+                        self._pending_lists.remove((mid, d))
+                        d.callback([])
+                        break
+                else:
+                    log.msg(f"link error: {msg.get('error')}")
+                return
+        self._received_f(msg)
+
+    def _failed(self, f):
+        if not self._closing:
+            log.msg(f"unable to reach another mailbox node: {f.value}")
+        self._closed(None)
+
+    def _closed(self, reason):
+        pending, self._pending_lists = self._pending_lists, []
+        for (mid, d) in pending:
+            d.callback([])
+        self._connected = self._protocol = None
+        if not self._closing:
+            self._closing = True
+            self._lost_f(self)
@@ -1,14 +1,21 @@
 import os, random, base64, re
-from collections import namedtuple
+from collections import namedtuple, Counter
 from twisted.python import log
 from twisted.application import service
 from .address_id import AddressIDTracker
 from .connections import ConnectionTable
+from .rate_limit import RateLimiter, AppRateLimiter
+from .overload import OverloadGovernor
+from .limits import Limits, QuotaError
+from .sqlite_storage import SQLiteChannelStore, SQLiteAddressIDStore
 
 def generate_mailbox_id():
     return base64.b32encode(os.urandom(8)).lower().strip(b"=").decode("ascii")
 
 NAMEPLATE_RE = re.compile(r'^\d+$')
+# pruning deletes this many mailboxes at a time, so the caller can serve
+# clients in between (see Server.iterate_prune_all_apps)
+PRUNE_BATCH = 100
 
 def check_valid_nameplate(n):
     if not isinstance(n, str):
@@ -28,33 +35,34 @@ TransitUsage = namedtuple("TransitUsage",
                           ["started", "waiting_time", "total_time",
                            "total_bytes", "result"])
 
+# 'seq' is the message's row id, assigned when it is added to the mailbox
 SidedMessage = namedtuple("SidedMessage", ["side", "phase", "body",
-                                           "server_rx", "msg_id"])
+                                           "server_rx", "msg_id", "seq"],
+                          defaults=(None,))
 
 class Mailbox:
-    def __init__(self, app, db, usage_db, app_id, mailbox_id):
+    def __init__(self, app, store, usage_db, app_id, mailbox_id):
         self._app = app
-        self._db = db
+        self._store = store
         self._usage_db = usage_db
         self._app_id = app_id
         self._mailbox_id = mailbox_id
-        self._listeners = {} # handle -> (send_f, stop_f)
+        self._listeners = {} # handle -> (send_f, stop_f, presence_f)
         # "handle" is a hashable object, for deregistration
-        # send_f() takes a JSONable object, stop_f() has no args
+        # send_f() takes a JSONable object, stop_f() has no args,
+        # presence_f() (optional) takes (side, event)
+        self._seen_seq = None # the last message our listeners know about
 
     def open(self, side, when):
-        # requires caller to db.commit()
+        # requires caller to store.commit(). Returns True if this side had
+        # not opened the mailbox before.
         assert isinstance(side, str), type(side)
-        db = self._db
+        store = self._store
 
-        already = db.execute("SELECT * FROM `mailbox_sides`"
-                             " WHERE `mailbox_id`=? AND `side`=?",
-                             (self._mailbox_id, side)).fetchone()
+        already = any(row["side"] == side for row in
+                      store.get_mailbox_sides(self._app_id, self._mailbox_id))
         if not already:
-            db.execute("INSERT INTO `mailbox_sides`"
-                       " (`mailbox_id`, `opened`, `side`, `added`)"
-                       " VALUES(?,?,?,?)",
-                       (self._mailbox_id, True, side, when))
+            store.add_mailbox_side(self._app_id, self._mailbox_id, side, when)
         # We accept re-opening a mailbox which a side previously closed,
         # unlike claim_nameplate(), which forbids any side from re-claiming a
         # nameplate which they previously released. (Nameplates forbid this
@@ -70,35 +78,51 @@ class Mailbox:
         # 'close', until they receive the 'closed' ack message.
 
         self._touch(when)
-        db.commit() # XXX: reconcile the need for this with the comment above
+        store.commit() # XXX: reconcile the need for this with the comment above
+        return not already
 
     def _touch(self, when):
-        self._db.execute("UPDATE `mailboxes` SET `updated`=? WHERE `id`=?",
-                         (when, self._mailbox_id))
-
-    def get_messages(self):
-        messages = []
-        db = self._db
-        for row in db.execute("SELECT * FROM `messages`"
-                              " WHERE `app_id`=? AND `mailbox_id`=?"
-                              " ORDER BY `server_rx` ASC",
-                              (self._app_id, self._mailbox_id)).fetchall():
-            sm = SidedMessage(side=row["side"], phase=row["phase"],
-                              body=row["body"], server_rx=row["server_rx"],
-                              msg_id=row["msg_id"])
-            messages.append(sm)
-        return messages
-
-    def add_listener(self, handle, send_f, stop_f):
+        self._store.touch_mailbox(self._app_id, self._mailbox_id, when)
+
+    def get_messages(self, since=None):
+        # with 'since', only return messages added after the one with that
+        # seq, so a reconnecting client doesn't get them all again
+        if since is None:
+            since = 0
+        return [SidedMessage(side=row["side"], phase=row["phase"],
+                             body=row["body"], server_rx=row["server_rx"],
+                             msg_id=row["msg_id"], seq=row["seq"])
+                for row in self._store.get_messages(self._app_id,
+                                                    self._mailbox_id, since)]
+
+    def get_open_sides(self):
+        rows = self._store.get_mailbox_sides(self._app_id, self._mailbox_id)
+        return {row["side"] for row in rows if row["opened"]}
+
+    def add_listener(self, handle, send_f, stop_f, since=None,
+                     presence_f=None):
         #log.msg("add_listener", self._mailbox_id, handle)
-        self._listeners[handle] = (send_f, stop_f)
+        if self._app.is_sharing():
+            # the other listeners must not miss what the new one will see
+            self.catch_up()
+        broker = self._app.get_broker()
+        if broker and not self._listeners:
+            broker.subscribe(self._app_id, self._mailbox_id)
+        self._listeners[handle] = (send_f, stop_f, presence_f)
         #log.msg(" added", len(self._listeners))
-        return self.get_messages()
+        return self.get_messages(since)
 
     def remove_listener(self, handle):
         #log.msg("remove_listener", self._mailbox_id, handle)
         self._listeners.pop(handle, None)
         #log.msg(" removed", len(self._listeners))
+        if not self._listeners:
+            self._unsubscribe()
+
+    def _unsubscribe(self):
+        broker = self._app.get_broker()
+        if broker:
+            broker.unsubscribe(self._app_id, self._mailbox_id)
 
     def has_listeners(self):
         return bool(self._listeners)
@@ -107,96 +131,166 @@ class Mailbox:
         return len(self._listeners)
 
     def broadcast_message(self, sm):
-        for (send_f, stop_f) in self._listeners.values():
+        if sm.seq is not None:
+            self._seen_seq = max(self._seen_seq or 0, sm.seq)
+        for (send_f, stop_f, presence_f) in self._listeners.values():
             send_f(sm)
 
+    def catch_up(self, seq=None):
+        """Broadcast any messages which another process (sharing the channel
+        DB during a handoff, or through a broker) has added since we last
+        looked. With 'seq', only look if we haven't seen that message."""
+        if (seq is not None and self._seen_seq is not None
+            and seq <= self._seen_seq):
+            return
+        if self._seen_seq is None:
+            # nothing broadcast yet: start from here
+            self._seen_seq = self._store.get_last_seq(self._app_id,
+                                                      self._mailbox_id)
+            return
+        for sm in self.get_messages(since=self._seen_seq):
+            self.broadcast_message(sm)
+
+    def broadcast_presence(self, side, event):
+        # 'event' is "opened" or "closed". Listeners hear about their own
+        # side too: it may be a different connection of the same client.
+        for (send_f, stop_f, presence_f) in list(self._listeners.values()):
+            if presence_f:
+                presence_f(side, event)
+
     def _add_message(self, sm):
-        self._db.execute("INSERT INTO `messages`"
-                         " (`app_id`, `mailbox_id`, `side`, `phase`,  `body`,"
-                         "  `server_rx`, `msg_id`)"
-                         " VALUES (?,?,?,?,?, ?,?)",
-                         (self._app_id, self._mailbox_id, sm.side,
-                          sm.phase, sm.body, sm.server_rx, sm.msg_id))
+        seq = self._store.add_message(self._app_id, self._mailbox_id,
+                                      sm.side, sm.phase, sm.body,
+                                      sm.server_rx, sm.msg_id)
         self._touch(sm.server_rx)
-        self._db.commit()
+        self._store.commit()
+        return seq
+
+    def _is_duplicate(self, sm):
+        # a client which didn't see the echo of its "add" (e.g. because its
+        # connection was lost) will send it again, with the same msg_id
+        if sm.msg_id is None:
+            return False
+        return self._store.has_message(self._app_id, self._mailbox_id,
+                                       sm.side, sm.phase, sm.msg_id)
 
     def add_message(self, sm):
+        """Store and broadcast a message. Returns False (and does neither)
+        if this side already added a message with the same phase and
+        msg_id."""
         assert isinstance(sm, SidedMessage)
-        self._add_message(sm)
-        self.broadcast_message(sm)
+        if self._is_duplicate(sm):
+            return False
+        limits = self._app.get_limits()
+        if limits.active():
+            (count, length) = self._store.get_mailbox_size(self._app_id,
+                                                           self._mailbox_id)
+            # bodies are stored as hex
+            limits.check_message(sm.body, count,
+                                 length // 2) # may raise QuotaError
+        seq = self._add_message(sm)
+        if self._app.is_sharing() and self._seen_seq is not None:
+            # another process may have added messages just before this one,
+            # which we haven't heard about yet: deliver them first
+            self.catch_up()
+        else:
+            self.broadcast_message(sm._replace(seq=seq))
+        broker = self._app.get_broker()
+        if broker:
+            broker.publish(self._app_id, self._mailbox_id, seq)
+        return True
 
     def close(self, side, mood, when):
         assert isinstance(side, str), type(side)
-        db = self._db
-        row = db.execute("SELECT * FROM `mailboxes`"
-                         " WHERE `app_id`=? AND `id`=?",
-                         (self._app_id, self._mailbox_id)).fetchone()
+        store = self._store
+        row = store.get_mailbox(self._app_id, self._mailbox_id)
         if not row:
             return
         for_nameplate = row["for_nameplate"]
 
-        row = db.execute("SELECT * FROM `mailbox_sides`"
-                         " WHERE `mailbox_id`=? AND `side`=?",
-                         (self._mailbox_id, side)).fetchone()
-        if not row:
+        side_rows = store.get_mailbox_sides(self._app_id, self._mailbox_id)
+        rows = [sr for sr in side_rows if sr["side"] == side]
+        if not rows:
             return
-        db.execute("UPDATE `mailbox_sides` SET `opened`=?, `mood`=?"
-                   " WHERE `mailbox_id`=? AND `side`=?",
-                   (False, mood, self._mailbox_id, side))
-        db.commit()
+        was_open = rows[0]["opened"]
+        store.close_mailbox_side(self._app_id, self._mailbox_id, side, mood)
+        store.commit()
 
         # are any sides still open?
-        side_rows = db.execute("SELECT * FROM `mailbox_sides`"
-                               " WHERE `mailbox_id`=?",
-                               (self._mailbox_id,)).fetchall()
+        side_rows = store.get_mailbox_sides(self._app_id, self._mailbox_id)
         if any([sr["opened"] for sr in side_rows]):
+            if was_open:
+                self.broadcast_presence(side, "closed")
             return
 
-        # nope. delete and summarize
-
-        # if the nameplate is still allocated we'll get a foreign-key
-        # failure when trying to delete the mailbox, so get rid of
-        # those first
-        db.execute("DELETE FROM `nameplate_sides` WHERE `side`=?",
-                   (side,))
-        db.execute("DELETE FROM `nameplates` WHERE `mailbox_id`=?",
-                   (self._mailbox_id,))
-        # remove mailbox content
-        db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
-                   (self._mailbox_id,))
-        db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
-                   (self._mailbox_id,))
-        db.execute("DELETE FROM `mailboxes` WHERE `id`=?", (self._mailbox_id,))
+        # nope. delete (along with the nameplate, if it is still allocated)
+        # and summarize
+        store.delete_mailbox(self._app_id, self._mailbox_id)
         if self._usage_db:
             self._app._summarize_mailbox_and_store(for_nameplate, side_rows,
                                                 when, pruned=False)
             self._usage_db.commit()
-        db.commit()
+        store.commit()
         # Shut down any listeners, just in case they're still lingering
         # around.
-        for (send_f, stop_f) in self._listeners.values():
+        for (send_f, stop_f, presence_f) in self._listeners.values():
             stop_f()
+        if self._listeners:
+            self._unsubscribe()
         self._listeners = {}
         self._app.free_mailbox(self._mailbox_id)
 
     def _shutdown(self):
         # used at test shutdown to accelerate client disconnects
-        for (send_f, stop_f) in self._listeners.values():
+        for (send_f, stop_f, presence_f) in self._listeners.values():
             stop_f()
+        if self._listeners:
+            self._unsubscribe()
         self._listeners = {}
 
 
 class AppNamespace:
 
-    def __init__(self, db, usage_db, blur_usage, log_requests, app_id,
-                 allow_list):
-        self._db = db
+    def __init__(self, store, usage_db, blur_usage, log_requests, app_id,
+                 allow_list, limits=Limits(), router=None):
+        self._store = store
         self._usage_db = usage_db
         self._blur_usage = blur_usage
         self._log_requests = log_requests
         self._app_id = app_id
         self._mailboxes = {}
         self._allow_list = allow_list
+        self._limits = limits
+        self._router = router # None unless we share the work with other nodes
+        self._sharing = False
+        self._broker = None
+
+    def get_limits(self):
+        return self._limits
+
+    def is_sharing(self):
+        return self._sharing
+
+    def get_broker(self):
+        return self._broker
+    def set_broker(self, broker):
+        self._broker = broker
+
+    def set_sharing(self, sharing):
+        self._sharing = sharing
+        if sharing:
+            for mailbox in self._mailboxes.values():
+                mailbox.catch_up() # to note what has already been seen
+
+    def poll_mailboxes(self):
+        for mailbox in list(self._mailboxes.values()):
+            if mailbox.has_listeners():
+                mailbox.catch_up()
+
+    def mailbox_changed(self, mailbox_id, seq=None):
+        mailbox = self._mailboxes.get(mailbox_id)
+        if mailbox and mailbox.has_listeners():
+            mailbox.catch_up(seq)
 
     def log_client_version(self, server_rx, side, client_version):
         if self._blur_usage:
@@ -218,11 +312,27 @@ class AppNamespace:
         return self._get_nameplate_ids()
 
     def _get_nameplate_ids(self):
-        db = self._db
         # TODO: filter this to numeric ids?
-        c = db.execute("SELECT DISTINCT `name` FROM `nameplates`"
-                       " WHERE `app_id`=?", (self._app_id,))
-        return {row["name"] for row in c.fetchall()}
+        return set(self._store.get_nameplates(self._app_id))
+
+    def _owns_nameplate(self, name):
+        # with a router, we only allocate nameplates (and create mailboxes)
+        # which hash to this node, so clients can find them again
+        return (self._router is None
+                or self._router.owns_nameplate(self._app_id, name))
+
+    def _generate_mailbox_id(self, nameplate=None):
+        # the store may want a nameplate's mailbox kept with the nameplate
+        while True:
+            mailbox_id = generate_mailbox_id()
+            if (self._router is not None
+                and not self._router.owns_mailbox(mailbox_id)):
+                continue
+            if (nameplate is not None
+                and not self._store.accepts_mailbox_id(self._app_id,
+                                                       nameplate, mailbox_id)):
+                continue
+            return mailbox_id
 
     def _find_available_nameplate_id(self):
         claimed = self._get_nameplate_ids()
@@ -230,7 +340,7 @@ class AppNamespace:
             available = set()
             for id_int in range(10**(size-1), 10**size):
                 id = "%d" % id_int
-                if id not in claimed:
+                if id not in claimed and self._owns_nameplate(id):
                     available.add(id)
             if available:
                 return random.choice(list(available))
@@ -238,7 +348,7 @@ class AppNamespace:
         for tries in range(1000):
             id_int = random.randrange(1000, 1000*1000)
             id = "%d" % id_int
-            if id not in claimed:
+            if id not in claimed and self._owns_nameplate(id):
                 return id
         raise ValueError("unable to find a free nameplate-id")
 
@@ -249,6 +359,10 @@ class AppNamespace:
         return nameplate_id
 
     def claim_nameplate(self, name, side, when):
+        mailbox_id, mailbox = self.claim_and_open(name, side, when)
+        return mailbox_id
+
+    def claim_and_open(self, name, side, when):
         # when we're done:
         # * there will be one row for the nameplate
         #  * there will be one 'side' attached to it, with claimed=True
@@ -257,46 +371,35 @@ class AppNamespace:
         assert isinstance(name, str), type(name)
         assert isinstance(side, str), type(side)
         check_valid_nameplate(name)
-        db = self._db
-        row = db.execute("SELECT * FROM `nameplates`"
-                         " WHERE `app_id`=? AND `name`=?",
-                         (self._app_id, name)).fetchone()
-        if not row:
+        store = self._store
+        mailbox_id = store.get_nameplate(self._app_id, name)
+        if mailbox_id is None:
+            if self._limits.max_app_nameplates is not None:
+                count = store.count_nameplates(self._app_id)
+                self._limits.check_app_nameplates(count) # may raise QuotaError
             if self._log_requests:
                 log.msg(f"creating nameplate#{name} for app_id {self._app_id}")
-            mailbox_id = generate_mailbox_id()
+            mailbox_id = self._generate_mailbox_id(name)
             self._add_mailbox(mailbox_id, True, side, when) # ensure row exists
-            sql = ("INSERT INTO `nameplates`"
-                   " (`app_id`, `name`, `mailbox_id`)"
-                   " VALUES(?,?,?)")
-            npid = db.execute(sql, (self._app_id, name, mailbox_id)
-                              ).lastrowid
-        else:
-            npid = row["id"]
-            mailbox_id = row["mailbox_id"]
+            store.add_nameplate(self._app_id, name, mailbox_id)
 
-        row = db.execute("SELECT * FROM `nameplate_sides`"
-                         " WHERE `nameplates_id`=? AND `side`=?",
-                         (npid, side)).fetchone()
-        if not row:
-            db.execute("INSERT INTO `nameplate_sides`"
-                       " (`nameplates_id`, `claimed`, `side`, `added`)"
-                       " VALUES(?,?,?,?)",
-                       (npid, True, side, when))
+        rows = [row for row in store.get_nameplate_sides(self._app_id, name)
+                if row["side"] == side]
+        if not rows:
+            store.add_nameplate_side(self._app_id, name, side, when)
         else:
-            if not row["claimed"]:
+            if not rows[0]["claimed"]:
                 raise ReclaimedError("you cannot re-claim a nameplate that your side previously released")
             # since that might cause a new mailbox to be allocated
-        db.commit()
+        store.commit()
 
-        self.open_mailbox(mailbox_id, side, when) # may raise CrowdedError
-        rows = db.execute("SELECT * FROM `nameplate_sides`"
-                          " WHERE `nameplates_id`=?", (npid,)).fetchall()
+        mailbox = self.open_mailbox(mailbox_id, side, when) # may raise CrowdedError
+        rows = store.get_nameplate_sides(self._app_id, name)
         if len(rows) > 2:
             # this line will probably never get hit: any crowding is noticed
             # on mailbox_sides first, inside open_mailbox()
             raise CrowdedError("too many sides have claimed this nameplate")
-        return mailbox_id
+        return mailbox_id, mailbox
 
     def release_nameplate(self, name, side, when):
         # when we're done:
@@ -307,38 +410,24 @@ class AppNamespace:
         #  * the nameplate sides will be removed
         assert isinstance(name, str), type(name)
         assert isinstance(side, str), type(side)
-        db = self._db
-        np_row = db.execute("SELECT * FROM `nameplates`"
-                            " WHERE `app_id`=? AND `name`=?",
-                            (self._app_id, name)).fetchone()
-        if not np_row:
-            return
-        npid = np_row["id"]
-        row = db.execute("SELECT * FROM `nameplate_sides`"
-                         " WHERE `nameplates_id`=? AND `side`=?",
-                         (npid, side)).fetchone()
-        if not row:
-            return
-        db.execute("UPDATE `nameplate_sides` SET `claimed`=?"
-                   " WHERE `nameplates_id`=? AND `side`=?",
-                   (False, npid, side))
-        db.commit()
+        store = self._store
+        side_rows = store.get_nameplate_sides(self._app_id, name)
+        if not any(sr["side"] == side for sr in side_rows):
+            return # no such nameplate, or not claimed by this side
+        store.release_nameplate_side(self._app_id, name, side)
+        store.commit()
 
         # now, are there any remaining claims?
-        side_rows = db.execute("SELECT * FROM `nameplate_sides`"
-                               " WHERE `nameplates_id`=?",
-                               (npid,)).fetchall()
+        side_rows = store.get_nameplate_sides(self._app_id, name)
         claims = [1 for sr in side_rows if sr["claimed"]]
         if claims:
             return
         # delete and summarize
-        db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id`=?",
-                   (npid,))
-        db.execute("DELETE FROM `nameplates` WHERE `id`=?", (npid,))
+        store.delete_nameplate(self._app_id, name)
         if self._usage_db:
             self._summarize_nameplate_and_store(side_rows, when, pruned=False)
             self._usage_db.commit()
-        db.commit()
+        store.commit()
 
     def _summarize_nameplate_and_store(self, side_rows, delete_time, pruned):
         # requires caller to self._usage_db.commit()
@@ -371,37 +460,33 @@ class AppNamespace:
 
     def _add_mailbox(self, mailbox_id, for_nameplate, side, when):
         assert isinstance(mailbox_id, str), type(mailbox_id)
-        db = self._db
-        row = db.execute("SELECT * FROM `mailboxes`"
-                         " WHERE `app_id`=? AND `id`=?",
-                         (self._app_id, mailbox_id)).fetchone()
-        if not row:
-            self._db.execute("INSERT INTO `mailboxes`"
-                             " (`app_id`, `id`, `for_nameplate`, `updated`)"
-                             " VALUES(?,?,?,?)",
-                             (self._app_id, mailbox_id, for_nameplate, when))
-            # we don't need a commit here, because mailbox.open() only
-            # does SELECT FROM `mailbox_sides`, not from `mailboxes`
+        store = self._store
+        if not store.get_mailbox(self._app_id, mailbox_id):
+            if self._limits.max_app_mailboxes is not None:
+                count = store.count_mailboxes(self._app_id)
+                self._limits.check_app_mailboxes(count) # may raise QuotaError
+            store.add_mailbox(self._app_id, mailbox_id, for_nameplate, when)
+            # we don't need a commit here, because mailbox.open() commits
 
     def open_mailbox(self, mailbox_id, side, when):
         assert isinstance(mailbox_id, str), type(mailbox_id)
         self._add_mailbox(mailbox_id, False, side, when) # ensure row exists
-        db = self._db
         if not mailbox_id in self._mailboxes: # ensure Mailbox object exists
             if self._log_requests:
                 log.msg(f"spawning #{mailbox_id} for app_id {self._app_id}")
             self._mailboxes[mailbox_id] = Mailbox(self,
-                                                  self._db, self._usage_db,
+                                                  self._store, self._usage_db,
                                                   self._app_id, mailbox_id)
         mailbox = self._mailboxes[mailbox_id]
 
         # delegate to mailbox.open() to add a row to mailbox_sides, and
         # update the mailbox.updated timestamp
-        mailbox.open(side, when)
-        db.commit()
-        rows = db.execute("SELECT * FROM `mailbox_sides`"
-                          " WHERE `mailbox_id`=?",
-                          (mailbox_id,)).fetchall()
+        joined = mailbox.open(side, when)
+        rows = self._store.get_mailbox_sides(self._app_id, mailbox_id)
+        if joined:
+            # tell the sides already listening that their peer has arrived
+            # (or, if crowded, that somebody else tried to)
+            mailbox.broadcast_presence(side, "opened")
         if len(rows) > 2:
             raise CrowdedError("too many sides have opened this mailbox")
         return mailbox
@@ -462,6 +547,14 @@ class AppNamespace:
                      total_time=total_time, result=result)
 
     def prune(self, now, old):
+        for _ in self.iterate_prune(now, old):
+            pass
+        return self.in_use()
+
+    def in_use(self):
+        return bool(self._mailboxes)
+
+    def iterate_prune(self, now, old, batch=PRUNE_BATCH):
         # The pruning check runs every 10 minutes, and "old" is defined to be
         # 11 minutes ago (unit tests can use different values). The client is
         # allowed to disconnect for up to 9 minutes without losing the
@@ -479,82 +572,46 @@ class AppNamespace:
         # present when the pruning process began, though, so in the log run
         # it should do less logging.
         log.msg(f" prune begins ({self._app_id})")
-        db = self._db
-        modified = False
 
         for mailbox in self._mailboxes.values():
             if mailbox.has_listeners():
                 log.msg(f"touch {mailbox._mailbox_id} because listeners")
                 mailbox._touch(now)
-        db.commit() # make sure the updates are visible below
-
-        new_mailboxes = set()
-        old_mailboxes = set()
-        for row in db.execute("SELECT * FROM `mailboxes` WHERE `app_id`=?",
-                              (self._app_id,)).fetchall():
-            mailbox_id = row["id"]
-            log.msg(f"  1: age={now - row['updated']}, old={now - old}, {mailbox_id}")
-            if row["updated"] > old:
-                new_mailboxes.add(mailbox_id)
-            else:
-                old_mailboxes.add(mailbox_id)
-        log.msg(" 2: mailboxes:", new_mailboxes, old_mailboxes)
-
-        old_nameplates = set()
-        for row in db.execute("SELECT * FROM `nameplates` WHERE `app_id`=?",
-                              (self._app_id,)).fetchall():
-            npid = row["id"]
-            mailbox_id = row["mailbox_id"]
-            if mailbox_id in old_mailboxes:
-                old_nameplates.add(npid)
-        log.msg(" 3: old_nameplates dbids", old_nameplates)
-
-        for npid in old_nameplates:
-            log.msg("  deleting nameplate with dbid", npid)
-            side_rows = db.execute("SELECT * FROM `nameplate_sides`"
-                                   " WHERE `nameplates_id`=?",
-                                   (npid,)).fetchall()
-            db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id`=?",
-                       (npid,))
-            db.execute("DELETE FROM `nameplates` WHERE `id`=?", (npid,))
-            if self._usage_db:
-                self._summarize_nameplate_and_store(side_rows, now, pruned=True)
-            modified = True
-
-        # delete all messages for old mailboxes
-        # delete all old mailboxes
-
-        for mailbox_id in old_mailboxes:
-            log.msg("  deleting mailbox", mailbox_id)
-            row = db.execute("SELECT * FROM `mailboxes`"
-                             " WHERE `id`=?", (mailbox_id,)).fetchone()
-            for_nameplate = row["for_nameplate"]
-            side_rows = db.execute("SELECT * FROM `mailbox_sides`"
-                                   " WHERE `mailbox_id`=?",
-                                   (mailbox_id,)).fetchall()
-            db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
-                       (mailbox_id,))
-            db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
-                       (mailbox_id,))
-            db.execute("DELETE FROM `mailboxes` WHERE `id`=?",
-                       (mailbox_id,))
-            if self._usage_db:
-                self._summarize_mailbox_and_store(for_nameplate, side_rows,
-                                                  now, pruned=True)
-            modified = True
+        store = self._store
+        store.commit() # make sure the updates are visible below
 
-        if modified:
-            db.commit()
+        while True:
+            nameplates, mailboxes = store.prune(self._app_id, old, batch)
+            log.msg(f"  deleted {len(nameplates)} nameplates,"
+                    f" {len(mailboxes)} mailboxes")
             if self._usage_db:
-                self._usage_db.commit()
-        in_use = bool(self._mailboxes)
-        log.msg(f"  prune complete, modified={modified}, in_use={in_use}")
-        return in_use
+                for side_rows in nameplates:
+                    self._summarize_nameplate_and_store(side_rows, now,
+                                                        pruned=True)
+                for (for_nameplate, side_rows) in mailboxes:
+                    self._summarize_mailbox_and_store(for_nameplate,
+                                                      side_rows, now,
+                                                      pruned=True)
+            if nameplates or mailboxes:
+                store.commit()
+                if self._usage_db:
+                    self._usage_db.commit()
+            if len(mailboxes) < batch:
+                break
+            # a client which opens one of the remaining old mailboxes in
+            # the meantime updates it, so it won't be pruned after all
+            yield
+        log.msg(f"  prune complete, in_use={self.in_use()}")
 
     def count_listeners(self):
         return sum(mailbox.count_listeners()
                    for mailbox in self._mailboxes.values())
 
+    def count_live_mailboxes(self):
+        # mailboxes which some connected client is still listening to
+        return sum(1 for mailbox in self._mailboxes.values()
+                   if mailbox.has_listeners())
+
     def _shutdown(self):
         for channel in self._mailboxes.values():
             channel._shutdown()
@@ -562,21 +619,85 @@ class AppNamespace:
 
 class Server(service.MultiService):
     def __init__(self, db, allow_list, welcome,
-                 blur_usage, usage_db=None, addrid_db=None):
+                 blur_usage, usage_db=None, addrid_db=None,
+                 rate_limits=(), rate_limit_close=False,
+                 max_lag=None, max_connections=None, limits=Limits(),
+                 router=None, shard_dbs=(), app_limits=None,
+                 store=None, addrid_store=None):
         service.MultiService.__init__(self)
-        self._db = db
+        # the SQLite stores are used unless others are provided
+        self._store = store or SQLiteChannelStore([db] + list(shard_dbs))
+        if addrid_db:
+            addrid_store = SQLiteAddressIDStore(addrid_db)
         self._allow_list = allow_list
         self._welcome = welcome
         self._blur_usage = blur_usage
         self._log_requests = blur_usage is None
         self._usage_db = usage_db
 
-        self._addrid_tracker = AddressIDTracker(self._db, addrid_db) if addrid_db else None
-        self._connection_table = ConnectionTable(self._db)
+        self._addrid_tracker = (AddressIDTracker(self._store, addrid_store)
+                                if addrid_store else None)
+        self._connection_table = ConnectionTable(self._store)
+        self._rate_limiter = RateLimiter(rate_limits) if rate_limits else None
+        self._rate_limit_close = rate_limit_close
+        self._counters = Counter() # for things without their own objects
+        self._governor = None
+        if max_lag is not None or max_connections is not None:
+            self._governor = OverloadGovernor(max_lag, max_connections)
+            self._governor.setServiceParent(self)
+        self._limits = limits
+        # app_id -> Limits, for apps given their own with --app-limit=
+        self._app_limits = {app_id: limits.for_app(overrides)
+                            for app_id, overrides
+                            in (app_limits or {}).items()}
+        self._app_connections = Counter() # app_id -> bound connections
+        self._app_rate_limiter = AppRateLimiter()
+        self._router = router
+        self._sharing = False
+        self._broker = None
+        self._draining = False
+        self._drain_welcome = None
+        self._port_labels = {} # label -> WebSocketServerFactory
+        self._ws_factories = [] # of every listener, for --max-connections=
         self._apps = {}
 
     def get_welcome(self):
+        if self._draining:
+            return self._drain_welcome
         return self._welcome
+
+    def start_draining(self, redirect=None):
+        # new connections are told to go away, and existing ones may not
+        # start new wormholes, but can finish the ones they have
+        welcome = self._welcome.copy()
+        if redirect:
+            welcome["error"] = ("This server is going down for maintenance,"
+                                f" please use {redirect} instead")
+            welcome["redirect"] = redirect
+        else:
+            welcome["error"] = ("This server is going down for maintenance,"
+                                " please try again later")
+        self._drain_welcome = welcome
+        self._draining = True
+    def stop_draining(self):
+        self._draining = False
+        self._drain_welcome = None
+    def is_draining(self):
+        return self._draining
+
+    def count_live_mailboxes(self):
+        return sum(app.count_live_mailboxes() for app in self._apps.values())
+
+    def add_ws_factory(self, ws_factory):
+        self._ws_factories.append(ws_factory)
+    def count_open_connections(self):
+        # across all --port= listeners (and the internal one), since
+        # --max-connections= is a limit for the whole server
+        return sum(ws_factory.getConnectionCount()
+                   for ws_factory in self._ws_factories)
+    def add_port_label(self, label, ws_factory):
+        # the open connections of each labelled --port= are counted
+        self._port_labels[label] = ws_factory
     def get_log_requests(self):
         return self._log_requests
     def get_address_id(self, peer_type, peer_host):
@@ -584,57 +705,177 @@ class Server(service.MultiService):
             return self._addrid_tracker.get_id(peer_type, peer_host)
         return None
 
+    def check_admission(self, open_connections):
+        # returns None to accept a new connection, or the reason to refuse it
+        if self._governor:
+            return self._governor.check(open_connections)
+        return None
+
     def connection_established(self, address_id, now):
         c = self._connection_table.established(address_id, now)
         return c
 
+    def check_rate_limit(self, keys, mtype, now):
+        if self._rate_limiter:
+            return self._rate_limiter.allow(keys, mtype, now)
+        return True
+    def get_rate_limit_close(self):
+        return self._rate_limit_close
+    def prune_rate_limits(self, now):
+        if self._rate_limiter:
+            self._rate_limiter.prune(now)
+        self._app_rate_limiter.prune(now)
+
+    def get_app_limits(self, app_id):
+        return self._app_limits.get(app_id, self._limits)
+
+    def app_connected(self, app_id):
+        # called when a connection binds to 'app_id'
+        self.get_app_limits(app_id).check_app_connections(
+            self._app_connections[app_id]) # may raise QuotaError
+        self._app_connections[app_id] += 1
+    def app_disconnected(self, app_id):
+        self._app_connections[app_id] -= 1
+        if not self._app_connections[app_id]:
+            del self._app_connections[app_id]
+
+    def check_app_command_rate(self, app_id, now):
+        rate = self.get_app_limits(app_id).max_app_command_rate
+        if rate is None:
+            return
+        if not self._app_rate_limiter.allow(app_id, rate, now):
+            raise QuotaError("too many commands for this app, slow down")
+
     def get_app(self, app_id):
         assert isinstance(app_id, str)
         if not app_id in self._apps:
             if self._log_requests:
                 log.msg(f"spawning app_id {app_id}")
             self._apps[app_id] = AppNamespace(
-                self._db,
+                self._store,
                 self._usage_db,
                 self._blur_usage,
                 self._log_requests,
                 app_id,
                 self._allow_list,
+                self.get_app_limits(app_id),
+                self._router,
             )
+            self._apps[app_id].set_sharing(self._sharing)
+            self._apps[app_id].set_broker(self._broker)
         return self._apps[app_id]
 
     def get_all_apps(self):
-        apps = set()
-        for row in self._db.execute("SELECT DISTINCT `app_id`"
-                                    " FROM `nameplates`").fetchall():
-            apps.add(row["app_id"])
-        for row in self._db.execute("SELECT DISTINCT `app_id`"
-                                    " FROM `mailboxes`").fetchall():
-            apps.add(row["app_id"])
-        for row in self._db.execute("SELECT DISTINCT `app_id`"
-                                    " FROM `messages`").fetchall():
-            apps.add(row["app_id"])
-        return apps
+        return self._store.get_app_ids()
 
     def prune_all_apps(self, now, old):
+        for app_id in self.iterate_prune_all_apps(now, old):
+            pass
+
+    def iterate_prune_all_apps(self, now, old):
+        # Yields after pruning each app, and after each PRUNE_BATCH
+        # mailboxes of an app with more than that, so the caller can let
+        # clients (of this app and the others) be served in between,
+        # instead of one app with lots of state holding up everybody.
         # As with AppNamespace.prune_old_mailboxes, we log for now.
         log.msg("beginning app prune")
         for app_id in sorted(self.get_all_apps()):
             log.msg(f" app prune checking {app_id!r}")
             app = self.get_app(app_id)
-            in_use = app.prune(now, old)
-            if not in_use:
+            for _ in app.iterate_prune(now, old):
+                yield app_id
+            if not app.in_use():
                 del self._apps[app_id]
+            yield app_id
         log.msg(f"app prune ends, {len(self._apps)} apps")
 
 
+    def set_sharing(self, sharing):
+        # during a handoff, two server processes use the same channel DB,
+        # and each must look for messages added by the other
+        self._sharing = sharing
+        for app in self._apps.values():
+            app.set_sharing(sharing)
+
+    def poll_shared_mailboxes(self):
+        for app in list(self._apps.values()):
+            app.poll_mailboxes()
+
+    def set_broker(self, broker):
+        # processes which always share the channel DB (see broker.py) are
+        # told about each other's messages, instead of polling for them
+        self._broker = broker
+        self.set_sharing(broker is not None)
+        for app in self._apps.values():
+            app.set_broker(broker)
+
+    def mailbox_changed(self, app_id, mailbox_id, seq=None):
+        # another process added a message (with 'seq') to this mailbox
+        app = self._apps.get(app_id)
+        if app:
+            app.mailbox_changed(mailbox_id, seq)
+
     def check_addrid_generation(self, now, generation_duration, force=False):
         if self._addrid_tracker:
-            self._addrid_tracker.check_generation(now, generation_duration, force)
+            rolled = self._addrid_tracker.check_generation(now,
+                                                           generation_duration,
+                                                           force)
+            if rolled and self._rate_limiter:
+                self._rate_limiter.new_generation()
+
+    def get_limits(self):
+        return self._limits
 
     def clear_connections(self):
         self._connection_table.clear()
 
+    def count(self, name, delta=1):
+        self._counters[name] += delta
+
+    def get_counters(self):
+        counters = dict(self._counters)
+        if self._rate_limiter:
+            counters["rate_limited"] = self._rate_limiter.rejected
+            counters["rate_limit_buckets"] = self._rate_limiter.count_buckets()
+        if self._governor:
+            counters["reactor_lag"] = self._governor.lag
+            for reason, count in self._governor.shed.items():
+                counters[f"shed_{reason}"] = count
+        if self._limits.active():
+            counters.update(self._get_quota_usage())
+        if self._limits.app_active() or self._app_limits:
+            counters.update(self._get_app_usage())
+        if self._draining:
+            counters["draining_live_mailboxes"] = self.count_live_mailboxes()
+        for label, ws_factory in self._port_labels.items():
+            count = ws_factory.getConnectionCount()
+            counters[f"port_{label}_connections"] = count
+        return counters
+
+    def _get_quota_usage(self):
+        # the largest current usage of each kind of quota, to compare
+        # against the limits
+        (messages, length) = self._store.get_largest_mailbox()
+        app_mailboxes = self._store.count_all_mailboxes()
+        return {
+            "largest_mailbox_messages": messages,
+            "largest_mailbox_bytes": length // 2, # bodies are stored as hex
+            "largest_app_mailboxes": max(app_mailboxes.values(), default=0),
+            }
+
+    def _get_app_usage(self):
+        # each app's current usage of the per-app limits
+        usage = Counter()
+        for app_id, count in self._store.count_all_nameplates().items():
+            usage[f"app:{app_id}:nameplates"] = count
+        for app_id, count in self._store.count_all_mailboxes().items():
+            usage[f"app:{app_id}:mailboxes"] = count
+        for app_id, count in self._app_connections.items():
+            usage[f"app:{app_id}:connections"] = count
+        for app_id, count in self._app_rate_limiter.rejected.items():
+            usage[f"app:{app_id}:rate_limited"] = count
+        return dict(usage)
+
     def dump_stats(self, now, rebooted):
         if not self._usage_db:
             return
@@ -660,6 +901,10 @@ class Server(service.MultiService):
                                "  `connections_websocket`)"
                                " VALUES(?,?,?,?)",
                                (rebooted, now, self._blur_usage, connections))
+        self._usage_db.execute("DELETE FROM `counters`")
+        for name, value in sorted(self.get_counters().items()):
+            self._usage_db.execute("INSERT INTO `counters` (`name`, `value`)"
+                                   " VALUES(?,?)", (name, value))
         self._usage_db.commit()
 
         # current status: expected to be zero most of the time
@@ -710,6 +955,16 @@ def make_server(db, allow_list=True,
                 usage_db=None,
                 welcome_motd=None,
                 addrid_db=None,
+                rate_limits=(),
+                rate_limit_close=False,
+                max_lag=None,
+                max_connections=None,
+                limits=Limits(),
+                router=None,
+                shard_dbs=(),
+                app_limits=None,
+                store=None,
+                addrid_store=None,
                 ):
     if blur_usage:
         log.msg("blurring access times to %d seconds" % blur_usage)
@@ -733,4 +988,9 @@ def make_server(db, allow_list=True,
         welcome["error"] = signal_error
 
     return Server(db, allow_list=allow_list, welcome=welcome,
-                  blur_usage=blur_usage, usage_db=usage_db, addrid_db=addrid_db)
+                  blur_usage=blur_usage, usage_db=usage_db, addrid_db=addrid_db,
+                  rate_limits=rate_limits, rate_limit_close=rate_limit_close,
+                  max_lag=max_lag, max_connections=max_connections,
+                  limits=limits, router=router, shard_dbs=shard_dbs,
+                  app_limits=app_limits, store=store,
+                  addrid_store=addrid_store)
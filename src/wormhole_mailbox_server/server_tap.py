@@ -1,13 +1,26 @@
-import json, time
-from twisted.internet import reactor
+import json, os, re, sys, time
+from twisted.internet import reactor, defer, task
 from twisted.python import usage, log
 from twisted.application.service import MultiService
 from twisted.application.internet import (TimerService,
                                           StreamServerEndpointService)
 from twisted.internet import endpoints
+from twisted.internet.endpoints import quoteStringArgument
 from .increase_rlimits import increase_rlimits
 from .server import make_server
+from .rate_limit import parse_rate_limit
+from .limits import Limits, parse_app_limit
 from .web import make_web_server
+from .routing import Router
+from .shards import shard_path
+from .handoff import HandoffService, take_over
+from .drain import DrainService
+from .broker import BrokerClient
+from .snapshot import SnapshotService, SNAPSHOT_INTERVAL
+from .workers import (WorkerPool, ReusePortEndpoint, parse_tcp_port,
+                      worker_name, worker_path, worker_socket)
+from .compression import (Compression, deflate_policy, deflate_window_bits,
+                          deflate_mem_level)
 from .database import (create_or_upgrade_channel_db, create_or_upgrade_usage_db,
                        create_or_upgrade_addrid_db)
 
@@ -15,30 +28,141 @@ LONGDESC = """This plugin sets up a 'Mailbox' server for magic-wormhole.
 This service forwards short messages between clients, to perform key exchange
 and connection setup."""
 
+DEFAULT_PORT = r"tcp:4000:interface=\:\:"
+LABEL_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+
+def parse_port(arg):
+    """[LABEL=]ENDPOINT -> (label or None, endpoint). Endpoint types never
+    include an '=', so a prefix without a ':' must be a label."""
+    label, sep, endpoint = arg.partition("=")
+    if sep and ":" not in label:
+        if not LABEL_RE.search(label):
+            raise ValueError(f"bad --port= label '{label}'"
+                             " (use letters, digits, '-', and '_')")
+        if not endpoint:
+            raise ValueError(f"--port={arg} has no endpoint")
+        return (label, endpoint)
+    return (None, arg)
+
 class Options(usage.Options):
     synopsis = "[--port=] [--blur-usage=] [--usage-db=]"
     longdesc = LONGDESC
 
     optParameters = [
-        ("port", "p", r"tcp:4000:interface=\:\:", "endpoint to listen on"),
         ("blur-usage", None, None, "round logged access times to improve privacy"),
         ("channel-db", None, "relay.sqlite", "location for the state database"),
+        ("channel-db-shards", None, 1, "split the state database across this many SQLite files", int),
         ("usage-db", None, None, "record usage data (SQLite)"),
         ("addrid-db", None, None, "IP address mapping data (SQLite)"),
         ("generation-duration", None, 86400, "lifetime of IP-address tracking table"),
         ("advertise-version", None, None, "version to recommend to clients"),
         ("signal-error", None, None, "force all clients to fail with a message"),
         ("motd", None, None, "Send a Message of the Day in the welcome"),
+        ("max-reactor-lag", None, None, "refuse new connections while the event loop is this many seconds behind", float),
+        ("max-connections", None, None, "refuse new connections while this many are open", int),
+        ("permessage-deflate", None, "off", "accept WebSocket compression: off, on, or no-context-takeover", deflate_policy),
+        ("deflate-window-bits", None, None, "deflate window size for compressed connections (9-15)", deflate_window_bits),
+        ("deflate-mem-level", None, None, "deflate memory level for compressed connections (1-9)", deflate_mem_level),
+        ("deflate-min-size", None, 0, "send messages smaller than this many bytes uncompressed", int),
+        ("max-body-size", None, None, "reject message bodies larger than this many bytes", int),
+        ("max-mailbox-messages", None, None, "reject messages beyond this many in one mailbox", int),
+        ("max-mailbox-size", None, None, "reject messages beyond this many body bytes in one mailbox", int),
+        ("max-app-mailboxes", None, None, "reject new mailboxes beyond this many for one app_id", int),
+        ("max-field-length", None, None, "reject commands with longer strings (sides, phases, etc)", int),
+        ("max-channels", None, None, "reject channels beyond this many on one connection", int),
+        ("max-app-nameplates", None, None, "reject new nameplates beyond this many for one app_id", int),
+        ("max-app-connections", None, None, "reject connections beyond this many bound to one app_id", int),
+        ("max-app-command-rate", None, None, "reject commands beyond this many per second from all of one app_id's connections", float),
+        ("max-message-size", None, None, "close connections which send a WebSocket message larger than this many bytes", int),
+        ("workers", None, 1, "run this many processes, sharing the --port= (which must be tcp:)", int),
+        ("worker-socket-dir", None, ".", "directory for the sockets which --workers= use to reach each other"),
+        ("worker-index", None, None, "(used internally by --workers=)", int),
+        ("cluster-node", None, None, "run as this named node of a cluster (with --cluster-listen= and --cluster-peer=)"),
+        ("cluster-listen", None, None, "endpoint where the other cluster nodes connect to this one"),
+        ("handoff-socket", None, None, "take over the --port= from an older server, and later hand it to a newer one, through this UNIX socket"),
+        ("handoff-drain", None, 600, "after handing over, keep serving existing connections for up to this many seconds", float),
+        ("drain-redirect", None, None, "while draining (see --drain-signals), tell new clients to use this server URL instead"),
+        ("broker", None, None, "share the --channel-db= with other servers, hearing about their messages through the broker at this UNIX socket"),
+        ("snapshot-dir", None, None, "periodically write read-only copies of the channel and usage databases into this directory, for monitoring tools"),
+        ("snapshot-interval", None, SNAPSHOT_INTERVAL, "seconds between --snapshot-dir= copies", float),
         ]
     optFlags = [
         ("disallow-list", None, "refuse to send list of allocated nameplates"),
+        ("rate-limit-close", None, "close connections which exceed a rate limit"),
+        ("drain-signals", None, "start draining on SIGUSR1, and stop on SIGUSR2 (not with twistd, which rotates its log on SIGUSR1)"),
         ]
 
     def __init__(self):
         super().__init__()
+        self["port"] = DEFAULT_PORT # the first --port=
+        self["ports"] = []
         self["websocket-protocol-options"] = []
+        self["port-websocket-options"] = {}
+        self["rate-limits"] = []
+        self["cluster-peers"] = {}
+        self["app-limits"] = {}
         self["allow-list"] = True
 
+    def parseOptions(self, options=None):
+        # remembered, so --workers= can start more processes just like us
+        self.args = list(sys.argv[1:] if options is None else options)
+        super().parseOptions(options)
+
+    def postOptions(self):
+        if not self["ports"]:
+            self["ports"] = [(None, DEFAULT_PORT)]
+        self["port"] = self["ports"][0][1]
+        labels = [label for (label, endpoint) in self["ports"] if label]
+        if len(set(labels)) != len(labels):
+            raise usage.UsageError("--port= labels must be unique")
+        for label in self["port-websocket-options"]:
+            if label not in labels:
+                raise usage.UsageError("--port-websocket-option= names"
+                                       f" unknown --port= label '{label}'")
+        if self["broker"] and (self["workers"] > 1 or self["cluster-node"]
+                               or self["handoff-socket"]):
+            raise usage.UsageError("--broker= cannot be used with --workers=,"
+                                   " --cluster-node=, or --handoff-socket=")
+        if len(self["ports"]) > 1 and (self["workers"] > 1
+                                       or self["handoff-socket"]):
+            raise usage.UsageError("--workers= and --handoff-socket= can only"
+                                   " be used with a single --port=")
+        if self["snapshot-dir"]:
+            if self["snapshot-interval"] <= 0:
+                raise usage.UsageError("--snapshot-interval= must be positive")
+            # the snapshots have the same names as the databases
+            snapshot_dir = os.path.realpath(self["snapshot-dir"])
+            for db in (self["channel-db"], self["usage-db"]):
+                if db and (os.path.realpath(os.path.dirname(db) or ".")
+                           == snapshot_dir):
+                    raise usage.UsageError("--snapshot-dir= must not be the"
+                                           " directory of --channel-db= or"
+                                           " --usage-db=")
+        if self["drain-redirect"] and not self["drain-signals"]:
+            raise usage.UsageError("--drain-redirect= needs --drain-signals")
+        if self["channel-db-shards"] < 1:
+            raise usage.UsageError("--channel-db-shards= must be at least 1")
+        if self["workers"] < 1:
+            raise usage.UsageError("--workers= must be at least 1")
+        if self["workers"] > 1:
+            try:
+                parse_tcp_port(self["port"])
+            except ValueError as e:
+                raise usage.UsageError(str(e))
+        if self["cluster-node"] or self["cluster-listen"] or self["cluster-peers"]:
+            if not self["cluster-node"] or not self["cluster-listen"]:
+                raise usage.UsageError("a cluster node needs both"
+                                       " --cluster-node= and --cluster-listen=")
+            if self["cluster-node"] in self["cluster-peers"]:
+                raise usage.UsageError("--cluster-peer= must not name this node")
+            if self["workers"] > 1:
+                raise usage.UsageError("--workers= cannot be used with"
+                                       " --cluster-node=")
+        if self["handoff-socket"] and (self["workers"] > 1
+                                       or self["cluster-node"]):
+            raise usage.UsageError("--handoff-socket= cannot be used with"
+                                   " --workers= or --cluster-node=")
+
     def opt_disallow_list(self):
         self["allow-list"] = False
 
@@ -59,6 +183,52 @@ class Options(usage.Options):
             raise usage.UsageError(f"could not parse JSON value for {key}")
         self["websocket-protocol-options"].append((key, value))
 
+    def opt_port(self, arg):
+        """Endpoint to listen on (default tcp:4000:interface=\\:\\:), with an optional label for the runtime counters: [LABEL=]ENDPOINT. This option can be provided multiple times."""
+        try:
+            self["ports"].append(parse_port(arg))
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+    opt_p = opt_port
+
+    def opt_port_websocket_option(self, arg):
+        """A websocket server protocol option for one labelled --port=, added to any --websocket-protocol-option=: LABEL:OPTION=VALUE. This option can be provided multiple times."""
+        label, sep, option = arg.partition(":")
+        if not sep:
+            raise usage.UsageError("format options as LABEL:OPTION=VALUE")
+        try:
+            key, value = option.split("=", 1)
+        except ValueError:
+            raise usage.UsageError("format options as LABEL:OPTION=VALUE")
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise usage.UsageError(f"could not parse JSON value for {key}")
+        self["port-websocket-options"].setdefault(label, []).append(
+            (key, value))
+
+    def opt_rate_limit(self, arg):
+        """Limit a class of commands (list, nameplate, mailbox, add) to RATE per second for each client address and each side: CLASS:RATE[:BURST]. This option can be provided multiple times."""
+        try:
+            self["rate-limits"].append(parse_rate_limit(arg))
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+
+    def opt_app_limit(self, arg):
+        """Replace one of the --max-app-* limits for a single app: APP_ID:NAME=VALUE, where NAME is nameplates, mailboxes, connections, or command-rate. This option can be provided multiple times."""
+        try:
+            app_id, name, value = parse_app_limit(arg)
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+        self["app-limits"].setdefault(app_id, {})[name] = value
+
+    def opt_cluster_peer(self, arg):
+        """Another node of the cluster, and the client endpoint for its --cluster-listen=: NAME=ENDPOINT. Provide this once for every other node."""
+        name, sep, endpoint = arg.partition("=")
+        if not name or not endpoint:
+            raise usage.UsageError("format peers as NAME=ENDPOINT")
+        self["cluster-peers"][name] = endpoint
+
 
 SECONDS = 1.0
 MINUTE = 60*SECONDS
@@ -72,10 +242,40 @@ def makeService(config, channel_db="relay.sqlite", reactor=reactor):
 
     parent = MultiService()
 
-    channel_db = create_or_upgrade_channel_db(config["channel-db"])
+    channel_dbfile = config["channel-db"]
     usage_dbfile = config["usage-db"]
-    usage_db = create_or_upgrade_usage_db(usage_dbfile) if usage_dbfile else None
     addrid_dbfile = config["addrid-db"]
+    workers = config["workers"]
+    router = None
+    internal_ep = None # where other nodes forward commands for our state
+    if workers > 1:
+        # each worker has its own databases, and owns a share of the
+        # nameplates and mailboxes
+        index = config["worker-index"] or 0
+        channel_dbfile = worker_path(channel_dbfile, index)
+        if usage_dbfile:
+            usage_dbfile = worker_path(usage_dbfile, index)
+        if addrid_dbfile:
+            addrid_dbfile = worker_path(addrid_dbfile, index)
+        socket_dir = config["worker-socket-dir"]
+        router = Router(worker_name(index),
+                        {worker_name(i): "unix:path=" + quoteStringArgument(
+                            worker_socket(socket_dir, i))
+                         for i in range(workers) if i != index},
+                        reactor)
+        internal_ep = endpoints.UNIXServerEndpoint(
+            reactor, worker_socket(socket_dir, index), wantPID=True)
+    elif config["cluster-node"]:
+        router = Router(config["cluster-node"], config["cluster-peers"],
+                        reactor)
+        internal_ep = endpoints.serverFromString(reactor,
+                                                 config["cluster-listen"])
+
+    channel_db = create_or_upgrade_channel_db(channel_dbfile)
+    # any more shards are created and upgraded just like the first
+    shard_dbs = [create_or_upgrade_channel_db(shard_path(channel_dbfile, i))
+                 for i in range(1, config["channel-db-shards"])]
+    usage_db = create_or_upgrade_usage_db(usage_dbfile) if usage_dbfile else None
     addrid_db = create_or_upgrade_addrid_db(addrid_dbfile) if addrid_dbfile else None
     generation_duration = config["generation-duration"]
 
@@ -87,6 +287,23 @@ def makeService(config, channel_db="relay.sqlite", reactor=reactor):
                          usage_db=usage_db,
                          welcome_motd=config["motd"],
                          addrid_db=addrid_db,
+                         rate_limits=config["rate-limits"],
+                         rate_limit_close=bool(config["rate-limit-close"]),
+                         max_lag=config["max-reactor-lag"],
+                         max_connections=config["max-connections"],
+                         limits=Limits(
+                             max_body=config["max-body-size"],
+                             max_mailbox_messages=config["max-mailbox-messages"],
+                             max_mailbox_bytes=config["max-mailbox-size"],
+                             max_app_mailboxes=config["max-app-mailboxes"],
+                             max_field_length=config["max-field-length"],
+                             max_channels=config["max-channels"],
+                             max_app_nameplates=config["max-app-nameplates"],
+                             max_app_connections=config["max-app-connections"],
+                             max_app_command_rate=config["max-app-command-rate"]),
+                         app_limits=config["app-limits"],
+                         router=router,
+                         shard_dbs=shard_dbs,
                          )
     server.setServiceParent(parent)
 
@@ -94,15 +311,30 @@ def makeService(config, channel_db="relay.sqlite", reactor=reactor):
     # ignored if the server didn't build a tracker.
     server.check_addrid_generation(time.time(), generation_duration, force=True)
 
-    # clear stale connection records from previous run
-    server.clear_connections()
+    inherited = None
+    if config["handoff-socket"]:
+        # if an older server is running, we use its listening socket
+        # instead of opening our own
+        inherited = take_over(config["handoff-socket"])
+    if config["broker"]:
+        broker = BrokerClient(reactor, server, config["broker"])
+        broker.setServiceParent(parent)
+        server.set_broker(broker)
+    elif not inherited:
+        # clear stale connection records from previous run (but not those
+        # of an older server we're taking over from, or of the others
+        # sharing the DB through the broker: they are still using them)
+        server.clear_connections()
 
     rebooted = time.time()
+    @defer.inlineCallbacks
     def expire():
         now = time.time()
         old = now - CHANNEL_EXPIRATION_TIME
         try:
-            server.prune_all_apps(now, old)
+            # a slice of apps at a time, serving clients in between
+            yield task.cooperate(server.iterate_prune_all_apps(now, old)
+                                 ).whenDone()
         except Exception as e:
             # catch-and-log exceptions during prune, so a single error won't
             # kill the loop. See #13 for details.
@@ -113,14 +345,66 @@ def makeService(config, channel_db="relay.sqlite", reactor=reactor):
         except Exception as e:
             log.msg("error during check_addrid_generation")
             log.err(e)
+        server.prune_rate_limits(now)
         server.dump_stats(now, rebooted=rebooted)
     TimerService(EXPIRATION_CHECK_PERIOD, expire).setServiceParent(parent)
 
+    if config["snapshot-dir"]:
+        snapshots = [(os.path.basename(channel_dbfile), channel_db)]
+        snapshots.extend((os.path.basename(shard_path(channel_dbfile, i)), db)
+                         for (i, db) in enumerate(shard_dbs, 1))
+        if usage_db:
+            snapshots.append((os.path.basename(usage_dbfile), usage_db))
+        SnapshotService(config["snapshot-dir"], snapshots,
+                        config["snapshot-interval"]).setServiceParent(parent)
+
     log_requests = config["blur-usage"] is None
-    site = make_web_server(server, log_requests,
-                           config["websocket-protocol-options"])
-    ep = endpoints.serverFromString(reactor, config["port"]) # to listen
-    StreamServerEndpointService(ep, site).setServiceParent(parent)
+    compression = Compression(config["permessage-deflate"],
+                              window_bits=config["deflate-window-bits"],
+                              mem_level=config["deflate-mem-level"],
+                              min_size=config["deflate-min-size"])
+    sites = []
+    for (label, port) in config["ports"]:
+        options = (config["websocket-protocol-options"]
+                   + config["port-websocket-options"].get(label, []))
+        site = make_web_server(server, log_requests, options,
+                               compression, config["max-message-size"],
+                               router)
+        if label:
+            server.add_port_label(label, site.ws_factory)
+        sites.append(site)
+    if internal_ep:
+        # this site handles everything locally, without routing
+        internal_site = make_web_server(server, log_requests,
+                                        config["websocket-protocol-options"],
+                                        compression,
+                                        config["max-message-size"])
+        StreamServerEndpointService(internal_ep,
+                                    internal_site).setServiceParent(parent)
+    pool = None
+    if workers > 1:
+        [site] = sites
+        ep = ReusePortEndpoint(reactor, *parse_tcp_port(config["port"]))
+        if config["worker-index"] is None:
+            pool = WorkerPool(reactor, workers, config.args)
+            pool.setServiceParent(parent)
+        StreamServerEndpointService(ep, site).setServiceParent(parent)
+    elif config["handoff-socket"]:
+        [site] = sites
+        ep = endpoints.serverFromString(reactor, config["port"])
+        HandoffService(reactor, ep, site, server, config["handoff-socket"],
+                       config["handoff-drain"],
+                       inherited).setServiceParent(parent)
+    else:
+        for ((label, port), site) in zip(config["ports"], sites):
+            ep = endpoints.serverFromString(reactor, port) # to listen
+            StreamServerEndpointService(ep, site).setServiceParent(parent)
     log.msg("websocket listening on ws://HOSTNAME:PORT/v1")
 
+    if config["drain-signals"]:
+        # SIGUSR1 starts draining, SIGUSR2 stops (and workers follow worker 0)
+        DrainService(server, config["drain-redirect"],
+                     pool.signal_workers if pool else None,
+                     reactor=reactor).setServiceParent(parent)
+
     return parent
@@ -3,14 +3,21 @@ from twisted.internet import reactor
 from twisted.python import log
 from twisted.logger import Logger
 from autobahn.twisted import websocket
+from autobahn.websocket.types import ConnectionDeny
 from .server import CrowdedError, ReclaimedError, SidedMessage, check_valid_nameplate
-from .util import dict_to_bytes, bytes_to_dict, str_or_none
+from .limits import QuotaError
+from twisted.internet import defer
+from .util import str_or_none, bytes_to_hexstr
+from .framing import JSON, FrameError, choose_framing
+from .compression import Compression, TimedDeflate
 
 # The WebSocket allows the client to send "commands" to the server, and the
 # server to send "responses" to the client. Note that commands and responses
 # are not necessarily one-to-one. All commands provoke an "ack" response
 # (with a copy of the original message) for timing, testing, and
-# synchronization purposes. All commands and responses are JSON-encoded.
+# synchronization purposes. All commands and responses are JSON-encoded,
+# unless the client negotiated one of the binary subprotocols from
+# framing.py, in which case they are CBOR or msgpack, with raw-bytes bodies.
 
 # Each WebSocket connection is bound to one "appid" and one "side", which are
 # set by the "bind" command (which must be the first command on the
@@ -64,7 +71,8 @@ from .util import dict_to_bytes, bytes_to_dict, str_or_none
 #        current_cli_version: out-of-date clients display a warning
 #        motd: all clients display message, then continue normally
 #        error: all clients display mesage, then terminate with error
-# -> {type: "bind", appid:, side:}
+# -> {type: "bind", appid:, side:, features: [str,..]?}
+#     .features is optional, unrecognized features are ignored
 #
 # -> {type: "list"} -> nameplates
 #  <- {type: "nameplates", nameplates: [{id: str,..},..]}
@@ -72,29 +80,123 @@ from .util import dict_to_bytes, bytes_to_dict, str_or_none
 #  <- {type: "allocated", nameplate: str}
 # -> {type: "claim", nameplate: str} -> mailbox
 #  <- {type: "claimed", mailbox: str}
+# -> {type: "claim-open", nameplate: str} -> mailbox, message
+#     claim, then open the nameplate's mailbox (one per connection, like
+#     "claim" and "open")
+#  <- {type: "claimed", mailbox: str}
 # -> {type: "release"}
 #     .nameplate is optional, but must match previous claim()
 #  <- {type: "released"}
 #
-# -> {type: "open", mailbox: str} -> message
+# -> {type: "open", mailbox: str, since: int} -> message
 #     sends old messages now, and subscribes to deliver future messages
-#  <- {type: "message", side:, phase:, body:, msg_id:}} # body is hex
+#     .since is optional: only messages with a larger .seq are sent now
+#  <- {type: "message", side:, phase:, body:, msg_id:, seq: int} # body is hex
 # -> {type: "add", phase: str, body: hex} # will send echo in a "message"
+#     if this side already added a message with the same .phase and .id,
+#     the add is ignored (no echo)
 #
 # -> {type: "close", mood: str} -> closed
 #     .mailbox is optional, but must match previous open()
 #  <- {type: "closed"}
 #
 #  <- {type: "error", error: str, orig: {}} # in response to malformed msgs
+#
+# While the server is draining (before a restart), new connections get a
+# welcome with an "error" (and, if configured, a "redirect" URL of another
+# server to use instead), and "allocate", "claim", and "claim-open" get an
+# "error" response of "server is draining, try again later". Everything else
+# keeps working, so wormholes in progress can finish.
+#
+# If the server was started with --rate-limit=, commands which exceed the
+# limit get an "error" response of "rate limited" (or, with
+# --rate-limit-close, the connection is closed).
+
+# Commands which exceed a storage limit (--max-body-size=, etc) get an
+# "error" response explaining which one, like "mailbox is full (too many
+# messages)", and have no other effect. The per-app limits work the same
+# way: a "bind" beyond --max-app-connections= gets "too many connections
+# for this app" (and the connection stays unbound), and commands beyond
+# --max-app-command-rate= get "too many commands for this app, slow down".
+
+# Several commands can be sent in a single frame, to save round trips:
+# -> {type: "batch", commands: [{type:..},{type:..},..]}
+#     each command is processed in order, exactly as if it had arrived in
+#     its own frame (including its "ack"). If "bind" included the
+#     "batch-responses" feature, all responses to the batch are delivered in
+#     a single frame:
+#  <- {type: "batch", messages: [{type:..},..]}
+
+# Clients which bind with the "presence" feature are told when other sides
+# open or close their mailbox, so they don't need to poll for their peer:
+#  <- {type: "presence", side: str, event: "opened"|"closed"}
+# Sides which already have the mailbox open are reported as "opened" right
+# after "open" (or "claim-open"), before any old messages.
+
+# Clients which bind with the "channels" feature can use several nameplates
+# and mailboxes at once on one connection. Any command except bind, ping,
+# and batch may include a "channel" handle (a string or integer chosen by the
+# client), and each handle gets its own allocate/claim/release/open/add/close
+# state, with the same once-per-connection rules as a whole connection
+# without channels. Every response to a tagged command, and every "message"
+# from a mailbox opened on that channel, carries the same handle:
+# -> {type: "open", mailbox: str, channel: 7}
+#  <- {type: "message", ..., channel: 7}
+# Commands without a "channel" use the connection's default channel, so
+# clients which don't use the feature see no change. Once a channel has been
+# closed (and released, if it claimed a nameplate), its handle may be reused.
+# --max-channels= limits how many handles can be in use at once.
+
+# Clients which bind with the "no-acks" feature do not get an "ack" for
+# commands which provoke some other response anyway (ping, list, allocate,
+# claim, release, add, close). bind, open, and batch are always acked.
 
 # for tests that need to know when a message has been processed:
 # -> {type: "ping", ping: int} -> pong (does not require bind/claim)
 #  <- {type: "pong", pong: int}
 
+# commands which always provoke some other response (or an "error"), so
+# clients which bind with the "no-acks" feature don't need an "ack" for them
+DIRECT_RESPONSES = {"ping", "list", "allocate", "claim", "claim-open",
+                    "release", "add", "close"}
+
+# commands which start a new wormhole, refused while the server is draining
+# (so it can be restarted once the wormholes in progress have finished)
+NEW_WORMHOLE_COMMANDS = {"allocate", "claim", "claim-open"}
+
+# commands which name a nameplate or mailbox, so when the service is shared
+# among several nodes (see routing.py), they may belong to another one
+ROUTED_COMMANDS = {"claim", "claim-open", "release", "open", "add", "close"}
+
 class Error(Exception):
     def __init__(self, explain):
         self._explain = explain
 
+class Channel(object):
+    """The nameplate and mailbox state of one wormhole on a connection.
+    Every connection has a default channel (handle None). Clients which
+    bind with the "channels" feature get another one for each "channel"
+    handle they use, and responses for it are tagged with that handle."""
+    def __init__(self, protocol, handle):
+        self._protocol = protocol
+        self.handle = handle
+        self.did_allocate = False # only one allocate() per channel
+        self.listening = False
+        self.did_claim = False
+        self.nameplate_id = None
+        self.did_release = False
+        self.mailbox = None
+        self.mailbox_id = None
+        self.did_close = False
+
+    def send(self, mtype, **kwargs):
+        if self.handle is not None:
+            kwargs["channel"] = self.handle
+        self._protocol.send(mtype, **kwargs)
+
+    def is_finished(self):
+        return self.did_close and (self.did_release or not self.did_claim)
+
 class WebSocketServer(websocket.WebSocketServerProtocol):
     _log = Logger() # not: autobahn claims .log, so we use ._log
 
@@ -102,16 +204,20 @@ class WebSocketServer(websocket.WebSocketServerProtocol):
         websocket.WebSocketServerProtocol.__init__(self)
         self._app = None
         self._side = None
-        self._did_allocate = False # only one allocate() per websocket
-        self._listening = False
-        self._did_claim = False
-        self._nameplate_id = None
-        self._did_release = False
-        self._did_open = False
-        self._mailbox = None
-        self._mailbox_id = None
-        self._did_close = False
+        self._channels = {None: Channel(self, None)}
+        self._bind = None # the bind command, to repeat on links
+        self._links = {} # node -> routing.Link
+        self._routes = {} # (channel handle, "nameplate"/"mailbox") -> node
         self._peer_addr_port = None
+        self._rate_key = None
+        self._side_rate_key = None
+        self._connection_tracker = None
+        self._features = set()
+        self._batched = None # list of responses while processing a batch
+        self._acks_suppressed = 0
+        self._framing = JSON
+        self._deflate = None # TimedDeflate, if permessage-deflate is in use
+        self._deflate_skipped = 0
 
     def onConnect(self, request):
         # Exceptions in onConnect are caught by autobahn, which logs
@@ -121,12 +227,20 @@ class WebSocketServer(websocket.WebSocketServerProtocol):
         # because tests mock that out.
         try:
             return self._onConnect(request)
+        except ConnectionDeny:
+            raise # autobahn turns this into an HTTP error response
         except Exception:
             self._log.failure("error in onConnect")
             raise
 
     def _onConnect(self, request):
         rv = self.factory._server
+        # When we're overloaded, refuse new connections before spending any
+        # work on them. This count includes the new connection.
+        shed = rv.check_admission(rv.count_open_connections())
+        if shed:
+            raise ConnectionDeny(ConnectionDeny.SERVICE_UNAVAILABLE,
+                                 f"server overloaded ({shed})")
         # Caddy uses capitalized headers like X-Real-IP and X-Real-Port, which
         # you see if you forward Caddy to netcat. But the twisted/autobahn
         # Request object lowercases everything.
@@ -140,6 +254,12 @@ class WebSocketServer(websocket.WebSocketServerProtocol):
             peer_port = request.headers.get("x-real-port")
             # assume frontends like Caddy don't give us v4-in-v6 addrs
             peer_type = "ipv6" if ":" in peer_host else "ipv4"
+        elif request.peer.split(":", maxsplit=1)[0] == "unix":
+            # a local proxy on a unix: --port= which didn't tell us who
+            # the client is: they all look alike
+            peer_type = "unix"
+            peer_host = "localhost"
+            peer_port = 0
         else:
             peer = request.peer
             peer_type = peer.split(":", maxsplit=1)[0]
@@ -159,6 +279,12 @@ class WebSocketServer(websocket.WebSocketServerProtocol):
         # address_id is None if the address tracker is disabled (no --addrid-db=)
         address_id = self.factory._server.get_address_id(peer_type, peer_host)
         self._addr_id = address_id # for logging
+        # rate limits are keyed by address-id, or by host if we aren't
+        # tracking address-ids
+        if address_id:
+            self._rate_key = ("addrid",) + tuple(address_id)
+        else:
+            self._rate_key = ("host", peer_host)
         now = time.time()
         self._connection_tracker = self.factory._server.connection_established(address_id, now)
 
@@ -168,7 +294,9 @@ class WebSocketServer(websocket.WebSocketServerProtocol):
         self._reactor = self.factory.reactor
         # can return (name, dict) or name here, where name is
         # WebSocket subprotocol name and dict is extra headers (if
-        # provided) to send
+        # provided) to send. Clients which don't offer one of ours get JSON.
+        self._framing = choose_framing(request.protocols)
+        return self._framing.subprotocol
 
     def get_your_address(self):
         (peer_type, peer_host, peer_port) = self._peer_addr_port
@@ -193,47 +321,189 @@ class WebSocketServer(websocket.WebSocketServerProtocol):
 
     def _onOpen(self):
         rv = self.factory._server
+        if self._perMessageCompress is not None:
+            # negotiated during the handshake: wrap it to measure its cost
+            self._deflate = TimedDeflate(self._perMessageCompress)
+            self._perMessageCompress = self._deflate
+            rv.count("deflate_connections")
         welcome = rv.get_welcome().copy()
         welcome["your-address"] = self.get_your_address()
         self.send("welcome", welcome=welcome)
 
     def onMessage(self, payload, isBinary):
         server_rx = time.time()
-        msg = bytes_to_dict(payload)
+        try:
+            msg = self._framing.decode(payload)
+        except FrameError as e:
+            self.factory._server.count("rejected_frames_" + e.reason)
+            self.send("error", error=str(e))
+            return
+        self.handle_command(msg, server_rx)
+
+    def handle_command(self, msg, server_rx):
         try:
             if "type" not in msg:
                 raise Error("missing 'type'")
-            self.send("ack", id=msg.get("id"))
-
             mtype = msg["type"]
+            if not isinstance(mtype, str):
+                raise Error("'type' must be a string")
+            handle = None
+            if "channels" in self._features:
+                handle = msg.get("channel")
+            if (mtype in NEW_WORMHOLE_COMMANDS
+                and self.factory._server.is_draining()):
+                # checked before routing, so a draining node's clients don't
+                # start wormholes on the other nodes either
+                raise Error("server is draining, try again later")
+            if self.route_command(mtype, handle, msg):
+                # the owner will ack and respond
+                self._connection_tracker.add_message(server_rx, mtype)
+                return
+            if "no-acks" in self._features and mtype in DIRECT_RESPONSES:
+                self._acks_suppressed += 1
+                self.factory._server.count("acks_suppressed")
+            elif handle is None:
+                self.send("ack", id=msg.get("id"))
+            else:
+                self.send("ack", id=msg.get("id"), channel=handle)
+
             self._connection_tracker.add_message(server_rx, mtype)
+            self.check_field_lengths(msg)
 
             if mtype == "ping":
                 return self.handle_ping(msg)
             if mtype == "bind":
                 return self.handle_bind(msg, server_rx)
+            if mtype == "batch":
+                return self.handle_batch(msg, server_rx)
 
             if not self._app:
                 raise Error("must bind first")
+            if not self.check_rate_limit(mtype, server_rx):
+                return
+            self.factory._server.check_app_command_rate(self._bind["appid"],
+                                                        server_rx)
             if mtype == "list":
-                return self.handle_list()
+                return self.handle_list(handle)
+            ch = self.get_channel(handle)
             if mtype == "allocate":
-                return self.handle_allocate(server_rx)
+                return self.handle_allocate(ch, server_rx)
             if mtype == "claim":
-                return self.handle_claim(msg, server_rx)
+                return self.handle_claim(ch, msg, server_rx)
+            if mtype == "claim-open":
+                return self.handle_claim_open(ch, msg, server_rx)
             if mtype == "release":
-                return self.handle_release(msg, server_rx)
+                return self.handle_release(ch, msg, server_rx)
 
             if mtype == "open":
-                return self.handle_open(msg, server_rx)
+                return self.handle_open(ch, msg, server_rx)
             if mtype == "add":
-                return self.handle_add(msg, server_rx)
+                return self.handle_add(ch, msg, server_rx)
             if mtype == "close":
-                return self.handle_close(msg, server_rx)
+                return self.handle_close(ch, msg, server_rx)
 
             raise Error("unknown type")
         except Error as e:
             self.send("error", error=e._explain, orig=msg)
+        except QuotaError as e:
+            self.factory._server.count("quota_rejections")
+            self.send("error", error=str(e), orig=msg)
+
+    def get_channel(self, handle):
+        if handle is not None and (not isinstance(handle, (str, int))
+                                   or isinstance(handle, bool)):
+            raise Error("'channel' must be a string or integer")
+        if handle in self._channels:
+            return self._channels[handle]
+        # the default channel doesn't count
+        self.factory._server.get_limits().check_channels(len(self._channels) - 1)
+        ch = self._channels[handle] = Channel(self, handle)
+        return ch
+
+    def route_command(self, mtype, handle, msg):
+        """If this command belongs to another node, forward it there and
+        return True. Otherwise (including when it is malformed, so we can
+        complain about it) return False."""
+        router = self.factory._router
+        if not router or not self._app or mtype not in ROUTED_COMMANDS:
+            return False
+        if handle is not None and not isinstance(handle, (str, int)):
+            return False
+        app_id = self._bind["appid"]
+        if mtype in ("claim", "claim-open", "release"):
+            name = msg.get("nameplate")
+            if isinstance(name, str):
+                node = router.owner_of_nameplate(app_id, name)
+            else:
+                node = self._routes.get((handle, "nameplate"))
+            if mtype != "release":
+                self._routes[(handle, "nameplate")] = node
+            if mtype == "claim-open":
+                # its mailbox is generated to hash to the same node
+                self._routes[(handle, "mailbox")] = node
+        else:
+            mailbox_id = msg.get("mailbox")
+            if mtype != "add" and isinstance(mailbox_id, str):
+                node = router.owner_of_mailbox(mailbox_id)
+            else:
+                node = self._routes.get((handle, "mailbox"))
+            if mtype == "open":
+                self._routes[(handle, "mailbox")] = node
+        if node is None or node == router.me:
+            return False
+        if isinstance(msg.get("body"), bytes):
+            # links always use JSON
+            msg = dict(msg, body=bytes_to_hexstr(msg["body"]))
+        self.get_link(node).send(msg)
+        return True
+
+    def get_link(self, node):
+        if node not in self._links:
+            self._links[node] = self.factory._router.connect(
+                node, self._peer_addr_port, self._bind,
+                self.link_received, self.link_lost)
+        return self._links[node]
+
+    def link_received(self, msg):
+        # relayed as-is, keeping the owner's server_tx
+        if msg.get("type") == "message":
+            msg["body"] = self._framing.body_to_client(msg["body"])
+        self._send_frame(msg)
+
+    def link_lost(self, link):
+        # the owner no longer knows about this client's claims and
+        # subscriptions: make the client reconnect and start over
+        if self.state == self.STATE_OPEN:
+            self.sendClose(self.CLOSE_STATUS_CODE_NORMAL,
+                           "lost connection to another server")
+
+    def drop_finished_channel(self, ch):
+        # once closed (and released), a channel holds nothing, so its handle
+        # can be forgotten and reused for the next wormhole
+        if ch.handle is not None and ch.is_finished():
+            del self._channels[ch.handle]
+
+    def check_field_lengths(self, msg):
+        # message bodies have their own limit, and batched commands are
+        # checked as they are processed
+        limits = self.factory._server.get_limits()
+        for name, value in msg.items():
+            if name in ("body", "commands"):
+                continue
+            values = value if isinstance(value, list) else [value]
+            for v in values:
+                limits.check_field(name, v) # may raise QuotaError
+
+    def check_rate_limit(self, mtype, server_rx):
+        rv = self.factory._server
+        keys = (self._rate_key, self._side_rate_key)
+        if rv.check_rate_limit(keys, mtype, server_rx):
+            return True
+        if rv.get_rate_limit_close():
+            # autobahn only lets us send 1000 or an application code
+            self.sendClose(self.CLOSE_STATUS_CODE_NORMAL, "rate limited")
+            return False
+        raise Error("rate limited")
 
     def handle_ping(self, msg):
         if "ping" not in msg:
@@ -247,8 +517,17 @@ class WebSocketServer(websocket.WebSocketServerProtocol):
             raise Error("bind requires 'appid'")
         if "side" not in msg:
             raise Error("bind requires 'side'")
-        self._app = self.factory._server.get_app(msg["appid"])
+        rv = self.factory._server
+        app = rv.get_app(msg["appid"])
+        rv.app_connected(msg["appid"]) # may raise QuotaError
+        self._app = app
         self._side = msg["side"]
+        self._bind = msg
+        self._side_rate_key = ("side", msg["appid"], self._side)
+        features = msg.get("features", [])
+        if isinstance(features, list):
+            # ignore unrecognized features, and non-strings
+            self._features = {f for f in features if isinstance(f, str)}
         client_version = msg.get("client_version", (None, None))
         # ignore extra args or non-string/None
         client_version = (str_or_none(client_version[0]), str_or_none(client_version[1]))
@@ -257,30 +536,69 @@ class WebSocketServer(websocket.WebSocketServerProtocol):
         self._connection_tracker.bound(self._side, client_version)
 
 
-    def handle_list(self):
-        nameplate_ids = sorted(self._app.get_nameplate_ids())
+    def handle_batch(self, msg, server_rx):
+        if self._batched is not None:
+            raise Error("batches cannot be nested")
+        if not isinstance(msg.get("commands"), list):
+            raise Error("batch requires 'commands' list")
+        self._batched = []
+        try:
+            for command in msg["commands"]:
+                if self.state != self.STATE_OPEN:
+                    break # e.g. closed by the rate limiter
+                if not isinstance(command, dict):
+                    self.send("error", error="batch commands must be objects",
+                              orig=command)
+                    continue
+                self.handle_command(command, server_rx)
+        finally:
+            responses, self._batched = self._batched, None
+        if not responses:
+            return
+        if "batch-responses" in self._features:
+            self.send("batch", messages=responses)
+        else:
+            for response in responses:
+                self._send_frame(response)
+
+
+    def handle_list(self, handle):
+        nameplate_ids = self._app.get_nameplate_ids()
+        router = self.factory._router
+        if not router:
+            return self.send_nameplates(handle, nameplate_ids)
+        # each node only knows about the nameplates it owns
+        d = defer.gatherResults([self.get_link(node).list_nameplates()
+                                 for node in router.peers()])
+        d.addCallback(lambda lists: self.send_nameplates(
+            handle, set(nameplate_ids).union(*lists)))
+
+    def send_nameplates(self, handle, nameplate_ids):
         # provide room to add nameplate attributes later (like which wordlist
         # is used for each, maybe how many words)
-        nameplates = [{"id": nid} for nid in nameplate_ids]
-        self.send("nameplates", nameplates=nameplates)
+        nameplates = [{"id": nid} for nid in sorted(nameplate_ids)]
+        if handle is None:
+            self.send("nameplates", nameplates=nameplates)
+        else:
+            self.send("nameplates", nameplates=nameplates, channel=handle)
 
-    def handle_allocate(self, server_rx):
-        if self._did_allocate:
+    def handle_allocate(self, ch, server_rx):
+        if ch.did_allocate:
             raise Error("you already allocated one, don't be greedy")
         nameplate_id = self._app.allocate_nameplate(self._side, server_rx)
         assert isinstance(nameplate_id, str)
-        self._did_allocate = True
-        self.send("allocated", nameplate=nameplate_id)
+        ch.did_allocate = True
+        ch.send("allocated", nameplate=nameplate_id)
 
-    def handle_claim(self, msg, server_rx):
+    def handle_claim(self, ch, msg, server_rx):
         if "nameplate" not in msg:
             raise Error("claim requires 'nameplate'")
-        if self._did_claim:
+        if ch.did_claim:
             raise Error("only one claim per connection")
-        self._did_claim = True
+        ch.did_claim = True
         nameplate_id = msg["nameplate"]
         check_valid_nameplate(nameplate_id)
-        self._nameplate_id = nameplate_id
+        ch.nameplate_id = nameplate_id
         try:
             mailbox_id = self._app.claim_nameplate(nameplate_id, self._side,
                                                    server_rx)
@@ -288,111 +606,235 @@ class WebSocketServer(websocket.WebSocketServerProtocol):
             raise Error("crowded")
         except ReclaimedError:
             raise Error("reclaimed")
-        self.send("claimed", mailbox=mailbox_id)
+        ch.send("claimed", mailbox=mailbox_id)
 
-    def handle_release(self, msg, server_rx):
-        if self._did_release:
+    def handle_claim_open(self, ch, msg, server_rx):
+        # "claim" and "open" in a single step: claim_nameplate() has to
+        # open the mailbox anyways, so this saves a round trip and a second
+        # open_mailbox()
+        if "nameplate" not in msg:
+            raise Error("claim-open requires 'nameplate'")
+        if ch.did_claim:
+            raise Error("only one claim per connection")
+        if ch.mailbox:
+            raise Error("only one open per connection")
+        ch.did_claim = True
+        nameplate_id = msg["nameplate"]
+        check_valid_nameplate(nameplate_id)
+        ch.nameplate_id = nameplate_id
+        try:
+            mailbox_id, mailbox = self._app.claim_and_open(nameplate_id,
+                                                           self._side,
+                                                           server_rx)
+        except CrowdedError:
+            raise Error("crowded")
+        except ReclaimedError:
+            raise Error("reclaimed")
+        ch.send("claimed", mailbox=mailbox_id)
+        ch.mailbox_id = mailbox_id
+        ch.mailbox = mailbox
+        self._subscribe(ch)
+
+    def handle_release(self, ch, msg, server_rx):
+        if ch.did_release:
             raise Error("only one release per connection")
         if "nameplate" in msg:
-            if self._nameplate_id is not None:
+            if ch.nameplate_id is not None:
                 # we only care about equality, don't bother with
                 # check_valid_nameplate()
-                if msg["nameplate"] != self._nameplate_id:
+                if msg["nameplate"] != ch.nameplate_id:
                     raise Error("release and claim must use same nameplate")
             nameplate_id = msg["nameplate"]
         else:
-            if self._nameplate_id is None:
+            if ch.nameplate_id is None:
                 raise Error("release without nameplate must follow claim")
-            nameplate_id = self._nameplate_id
+            nameplate_id = ch.nameplate_id
         assert nameplate_id is not None
-        self._did_release = True
+        ch.did_release = True
         self._app.release_nameplate(nameplate_id, self._side, server_rx)
-        self.send("released")
+        ch.send("released")
+        self.drop_finished_channel(ch)
 
 
-    def handle_open(self, msg, server_rx):
-        if self._mailbox:
+    def handle_open(self, ch, msg, server_rx):
+        if ch.mailbox:
             raise Error("only one open per connection")
         if "mailbox" not in msg:
             raise Error("open requires 'mailbox'")
         mailbox_id = msg["mailbox"]
         assert isinstance(mailbox_id, str)
-        self._mailbox_id = mailbox_id
+        since = msg.get("since")
+        if since is not None and (not isinstance(since, int)
+                                  or isinstance(since, bool)):
+            raise Error("open 'since' must be an integer")
+        ch.mailbox_id = mailbox_id
         try:
-            self._mailbox = self._app.open_mailbox(mailbox_id, self._side,
-                                                   server_rx)
+            ch.mailbox = self._app.open_mailbox(mailbox_id, self._side,
+                                                server_rx)
         except CrowdedError:
             raise Error("crowded")
+        self._subscribe(ch, since)
+
+    def _subscribe(self, ch, since=None):
+        # deliver old messages (newer than 'since') now, and future ones as
+        # they arrive
         def _send(sm):
-            self.send("message", side=sm.side, phase=sm.phase,
-                      body=sm.body, server_rx=sm.server_rx, id=sm.msg_id)
+            ch.send("message", side=sm.side, phase=sm.phase,
+                    body=self._framing.body_to_client(sm.body),
+                    server_rx=sm.server_rx, id=sm.msg_id, seq=sm.seq)
         def _stop():
             pass
-        self._listening = True
-        for old_sm in self._mailbox.add_listener(self, _send, _stop):
+        def _presence(side, event):
+            ch.send("presence", side=side, event=event)
+        presence_f = None
+        if "presence" in self._features:
+            presence_f = _presence
+            # report the peers which are already here, then any changes
+            for side in sorted(ch.mailbox.get_open_sides() - {self._side}):
+                _presence(side, "opened")
+        ch.listening = True
+        for old_sm in ch.mailbox.add_listener(ch, _send, _stop, since,
+                                              presence_f):
             _send(old_sm)
 
-    def handle_add(self, msg, server_rx):
-        if not self._mailbox:
+    def handle_add(self, ch, msg, server_rx):
+        if not ch.mailbox:
             raise Error("must open mailbox before adding")
         if "phase" not in msg:
             raise Error("missing 'phase'")
         if "body" not in msg:
             raise Error("missing 'body'")
         msg_id = msg.get("id") # optional
+        body = msg["body"]
+        if isinstance(body, bytes):
+            # from a binary-framed client: store it as hex, like JSON
+            # clients send it, so either kind can read it
+            body = bytes_to_hexstr(body)
         sm = SidedMessage(side=self._side, phase=msg["phase"],
-                          body=msg["body"], server_rx=server_rx,
+                          body=body, server_rx=server_rx,
                           msg_id=msg_id)
-        self._mailbox.add_message(sm)
-
-    def handle_close(self, msg, server_rx):
-        if self._did_close:
+        if not ch.mailbox.add_message(sm):
+            # a retransmission: it was already stored and broadcast, so
+            # there will be no echo. Clients which asked for "no-acks"
+            # need the ack after all, to learn that it arrived.
+            self.factory._server.count("duplicate_adds")
+            if "no-acks" in self._features:
+                ch.send("ack", id=msg_id)
+
+    def handle_close(self, ch, msg, server_rx):
+        if ch.did_close:
             raise Error("only one close per connection")
         if "mailbox" in msg:
-            if self._mailbox_id is not None:
-                if msg["mailbox"] != self._mailbox_id:
+            if ch.mailbox_id is not None:
+                if msg["mailbox"] != ch.mailbox_id:
                     raise Error("open and close must use same mailbox")
             mailbox_id = msg["mailbox"]
         else:
-            if self._mailbox_id is None:
+            if ch.mailbox_id is None:
                 raise Error("close without mailbox must follow open")
-            mailbox_id = self._mailbox_id
-        if not self._mailbox:
+            mailbox_id = ch.mailbox_id
+        if not ch.mailbox:
             try:
-                self._mailbox = self._app.open_mailbox(mailbox_id, self._side,
-                                                       server_rx)
+                ch.mailbox = self._app.open_mailbox(mailbox_id, self._side,
+                                                    server_rx)
             except CrowdedError:
                 raise Error("crowded")
-        if self._listening:
-            self._mailbox.remove_listener(self)
-            self._listening = False
-        self._did_close = True
-        self._mailbox.close(self._side, msg.get("mood"), server_rx)
-        self._mailbox = None
-        self.send("closed")
+        if ch.listening:
+            ch.mailbox.remove_listener(ch)
+            ch.listening = False
+        ch.did_close = True
+        ch.mailbox.close(self._side, msg.get("mood"), server_rx)
+        ch.mailbox = None
+        ch.send("closed")
+        self.drop_finished_channel(ch)
 
     def send(self, mtype, **kwargs):
         kwargs["type"] = mtype
         kwargs["server_tx"] = time.time()
-        payload = dict_to_bytes(kwargs)
-        self.sendMessage(payload, False)
+        if self._batched is not None:
+            self._batched.append(kwargs)
+            return
+        self._send_frame(kwargs)
+
+    def _send_frame(self, kwargs):
+        # Each frame is a separate transport.write(), but the transport
+        # (TCP, or TLS via its small-write aggregation) buffers them until
+        # the end of the reactor turn, so all the frames provoked by one
+        # inbound message leave, in order, in a single send(). See
+        # misc/bench_frames.py.
+        payload = self._framing.encode(kwargs)
+        small = False
+        if self._deflate and len(payload) < self.factory._compression.min_size:
+            small = True
+            self._deflate_skipped += 1
+        self.sendMessage(payload, self._framing.is_binary, doNotCompress=small)
+
+    def get_compression_stats(self):
+        if not self._deflate:
+            return None
+        ts = self.trafficStats
+        return {"deflate_in_app": ts.incomingOctetsAppLevel,
+                "deflate_in_wire": ts.incomingOctetsWebSocketLevel,
+                "deflate_out_app": ts.outgoingOctetsAppLevel,
+                "deflate_out_wire": ts.outgoingOctetsWebSocketLevel,
+                "deflate_skipped": self._deflate_skipped,
+                "deflate_cpu": self._deflate.cpu,
+                }
 
     def onClose(self, wasClean, code, reason):
-        #log.msg("onClose", self, self._mailbox, self._listening)
-        self._connection_tracker.lost()
-        if self._mailbox and self._listening:
-            self._mailbox.remove_listener(self)
+        #log.msg("onClose", self, self._channels)
+        if self._connection_tracker: # None if onConnect refused us
+            self._connection_tracker.lost()
+        if self.localCloseCode == self.CLOSE_STATUS_CODE_MESSAGE_TOO_BIG:
+            # autobahn refused a frame larger than --max-message-size=
+            self.factory._server.count("rejected_frames_too_large")
+        stats = self.get_compression_stats()
+        if stats:
+            rv = self.factory._server
+            for name, value in stats.items():
+                rv.count(name, value)
+            if rv.get_log_requests():
+                log.msg("ws client closed: deflate %d/%d bytes out,"
+                        " %d/%d in, %.3fs cpu"
+                        % (stats["deflate_out_wire"], stats["deflate_out_app"],
+                           stats["deflate_in_wire"], stats["deflate_in_app"],
+                           stats["deflate_cpu"]))
+        if self._acks_suppressed and self.factory._server.get_log_requests():
+            # the server-wide total is in the acks_suppressed counter
+            log.msg("ws client closed: %d acks suppressed"
+                    % self._acks_suppressed)
+        if self._app:
+            self.factory._server.app_disconnected(self._bind["appid"])
+        for ch in self._channels.values():
+            if ch.mailbox and ch.listening:
+                ch.mailbox.remove_listener(ch)
+        for link in self._links.values():
+            link.close()
 
 
 class WebSocketServerFactory(websocket.WebSocketServerFactory):
     protocol = WebSocketServer
 
-    def __init__(self, url, server):
+    def __init__(self, url, server, compression=None, max_message_size=None,
+                 router=None):
         websocket.WebSocketServerFactory.__init__(self, url)
         self.setProtocolOptions(autoPingInterval=60, autoPingTimeout=600)
+        if max_message_size is not None:
+            # autobahn closes the connection (with code 1009) as soon as
+            # the frame header announces something bigger, before buffering
+            # or parsing any of it. Do the closing handshake rather than
+            # just dropping the TCP connection, so the client learns why.
+            self.setProtocolOptions(maxFramePayloadSize=max_message_size,
+                                    maxMessagePayloadSize=max_message_size,
+                                    failByDrop=False)
+        self._compression = compression or Compression()
+        if self._compression.enabled():
+            self.setProtocolOptions(
+                perMessageCompressionAccept=self._compression.accept)
         # note: Autobahn uses "self.factory.server" for the Server
         # version string, so we musn't use that as well.
         self._server = server
+        self._router = router
         from . import __version__
         self.server = f"Magic Wormhole Mailbox {__version__}"
         self.reactor = reactor # for tests to control
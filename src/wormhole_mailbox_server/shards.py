@@ -0,0 +1,60 @@
+import hashlib, os
+
+# With --channel-db-shards=K, the channel state is split across K SQLite
+# files, each with its own connection, so writes for different mailboxes
+# don't all wait on one file's lock and commit. Nameplates are assigned to a
+# shard by hashing (app_id, name), and mailboxes (with their sides and
+# messages) by hashing the mailbox id. The mailbox created for a nameplate
+# is always given an id which hashes to the nameplate's shard, so the
+# nameplate and its mailbox can still reference each other. The connection
+# table and address-id generation live in the first shard, which is the
+# --channel-db= file itself.
+
+def shard_path(dbfile, index):
+    """relay.sqlite is shard 0, relay.shard-1.sqlite is shard 1, etc."""
+    if index == 0 or dbfile == ":memory:":
+        return dbfile
+    base, ext = os.path.splitext(dbfile)
+    return f"{base}.shard-{index}{ext}"
+
+def _hash(s):
+    return int.from_bytes(hashlib.sha256(s.encode("utf-8")).digest()[:8],
+                          "big")
+
+class ChannelShards(object):
+    def __init__(self, dbs):
+        assert dbs
+        self._dbs = list(dbs)
+
+    def __len__(self):
+        return len(self._dbs)
+
+    def all(self):
+        return list(self._dbs)
+
+    def primary(self):
+        return self._dbs[0]
+
+    def _index(self, key):
+        if len(self._dbs) == 1:
+            return 0
+        return _hash(key) % len(self._dbs)
+
+    def nameplate_index(self, app_id, name):
+        return self._index(f"nameplate:{app_id}:{name}")
+
+    def mailbox_index(self, mailbox_id):
+        return self._index(f"mailbox:{mailbox_id}")
+
+    def for_nameplate(self, app_id, name):
+        return self._dbs[self.nameplate_index(app_id, name)]
+
+    def for_mailbox(self, mailbox_id):
+        return self._dbs[self.mailbox_index(mailbox_id)]
+
+    def commit_written(self):
+        # each shard commits on its own, and only if it was written to since
+        # its last commit (sqlite3 opens a transaction at the first write)
+        for db in self._dbs:
+            if db.in_transaction:
+                db.commit()
@@ -0,0 +1,51 @@
+import os, sqlite3, stat, tempfile
+from twisted.application.internet import TimerService
+from twisted.python import log
+
+# Monitoring tools which read relay.sqlite or the usage DB while the server
+# is writing to them take locks on the live files, which makes the server
+# wait (or fail with SQLITE_BUSY). With --snapshot-dir=DIR, the server
+# instead copies each database into DIR every --snapshot-interval= seconds,
+# and those tools read the copies. Each copy is made with SQLite's online
+# backup API, through the server's own connection, so it is a consistent
+# picture of one moment and takes no lock the server could wait for. It is
+# written to a temporary file and renamed into place, so a reader sees
+# either the previous snapshot or the new one, never half of one.
+
+SNAPSHOT_INTERVAL = 60.0
+
+def write_snapshot(db, path):
+    """Copy the database behind connection 'db' to a read-only file at
+    'path', replacing any previous snapshot."""
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(path) + ".",
+                                dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        target = sqlite3.connect(temp)
+        try:
+            db.backup(target) # all pages in one step: one moment in time
+        finally:
+            target.close()
+        os.chmod(temp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+class SnapshotService(TimerService):
+    """I write a snapshot of each of my databases into 'directory' every
+    'interval' seconds."""
+    def __init__(self, directory, dbs, interval=SNAPSHOT_INTERVAL):
+        self._directory = directory
+        self._dbs = dbs # [(filename, db)]
+        TimerService.__init__(self, interval, self.write_snapshots)
+
+    def write_snapshots(self):
+        for (filename, db) in self._dbs:
+            try:
+                write_snapshot(db, os.path.join(self._directory, filename))
+            except (OSError, sqlite3.Error) as e:
+                # the next interval will try again
+                log.msg(f"error writing snapshot of {filename}")
+                log.err(e)
@@ -0,0 +1,397 @@
+from collections import Counter
+from zope.interface import implementer
+from .storage import IChannelStore, IAddressIDStore
+from .shards import ChannelShards
+
+# The channel state lives in the --channel-db= file, and (with
+# --channel-db-shards=) its shards. See shards.py for which shard holds
+# what. The schemas are in db-schemas/.
+
+@implementer(IChannelStore)
+class SQLiteChannelStore(object):
+    def __init__(self, dbs):
+        self.shards = ChannelShards(dbs)
+
+    def commit(self):
+        self.shards.commit_written()
+
+    # nameplates
+
+    def get_nameplates(self, app_id):
+        nameplates = {}
+        for db in self.shards.all():
+            for row in db.execute("SELECT `name`, `mailbox_id`"
+                                  " FROM `nameplates` WHERE `app_id`=?",
+                                  (app_id,)).fetchall():
+                nameplates[row["name"]] = row["mailbox_id"]
+        return nameplates
+
+    def get_nameplate(self, app_id, name):
+        db = self.shards.for_nameplate(app_id, name)
+        row = db.execute("SELECT `mailbox_id` FROM `nameplates`"
+                         " WHERE `app_id`=? AND `name`=?",
+                         (app_id, name)).fetchone()
+        return row["mailbox_id"] if row else None
+
+    def accepts_mailbox_id(self, app_id, name, mailbox_id):
+        # the nameplate and its mailbox must be in the same shard
+        return (self.shards.mailbox_index(mailbox_id)
+                == self.shards.nameplate_index(app_id, name))
+
+    def add_nameplate(self, app_id, name, mailbox_id):
+        db = self.shards.for_nameplate(app_id, name)
+        db.execute("INSERT INTO `nameplates`"
+                   " (`app_id`, `name`, `mailbox_id`)"
+                   " VALUES(?,?,?)",
+                   (app_id, name, mailbox_id))
+
+    def get_nameplate_sides(self, app_id, name):
+        db = self.shards.for_nameplate(app_id, name)
+        return db.execute("SELECT `side`, `claimed`, `added`"
+                          " FROM `nameplate_sides`"
+                          " WHERE `nameplates_id`="
+                          "  (SELECT `id` FROM `nameplates`"
+                          "   WHERE `app_id`=? AND `name`=?)"
+                          " ORDER BY `rowid`",
+                          (app_id, name)).fetchall()
+
+    def add_nameplate_side(self, app_id, name, side, when):
+        db = self.shards.for_nameplate(app_id, name)
+        db.execute("INSERT INTO `nameplate_sides`"
+                   " (`nameplates_id`, `claimed`, `side`, `added`)"
+                   " SELECT `id`, ?, ?, ? FROM `nameplates`"
+                   " WHERE `app_id`=? AND `name`=?",
+                   (True, side, when, app_id, name))
+
+    def release_nameplate_side(self, app_id, name, side):
+        db = self.shards.for_nameplate(app_id, name)
+        db.execute("UPDATE `nameplate_sides` SET `claimed`=?"
+                   " WHERE `side`=? AND `nameplates_id`="
+                   "  (SELECT `id` FROM `nameplates`"
+                   "   WHERE `app_id`=? AND `name`=?)",
+                   (False, side, app_id, name))
+
+    def delete_nameplate(self, app_id, name):
+        db = self.shards.for_nameplate(app_id, name)
+        db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id` IN"
+                   " (SELECT `id` FROM `nameplates`"
+                   "  WHERE `app_id`=? AND `name`=?)",
+                   (app_id, name))
+        db.execute("DELETE FROM `nameplates` WHERE `app_id`=? AND `name`=?",
+                   (app_id, name))
+
+    def count_nameplates(self, app_id):
+        return self._count_app_rows("nameplates", app_id)
+
+    def _count_app_rows(self, table, app_id):
+        # an app's nameplates and mailboxes are spread across all shards
+        return sum(db.execute(f"SELECT COUNT() AS `count` FROM `{table}`"
+                              " WHERE `app_id`=?",
+                              (app_id,)).fetchone()["count"]
+                   for db in self.shards.all())
+
+    # mailboxes
+
+    def get_mailboxes(self, app_id):
+        mailboxes = {}
+        for db in self.shards.all():
+            for row in db.execute("SELECT `id`, `updated` FROM `mailboxes`"
+                                  " WHERE `app_id`=?",
+                                  (app_id,)).fetchall():
+                mailboxes[row["id"]] = row["updated"]
+        return mailboxes
+
+    def get_mailbox(self, app_id, mailbox_id):
+        db = self.shards.for_mailbox(mailbox_id)
+        return db.execute("SELECT `for_nameplate`, `updated` FROM `mailboxes`"
+                          " WHERE `app_id`=? AND `id`=?",
+                          (app_id, mailbox_id)).fetchone()
+
+    def add_mailbox(self, app_id, mailbox_id, for_nameplate, when):
+        db = self.shards.for_mailbox(mailbox_id)
+        db.execute("INSERT INTO `mailboxes`"
+                   " (`app_id`, `id`, `for_nameplate`, `updated`)"
+                   " VALUES(?,?,?,?)",
+                   (app_id, mailbox_id, for_nameplate, when))
+
+    def touch_mailbox(self, app_id, mailbox_id, when):
+        db = self.shards.for_mailbox(mailbox_id)
+        db.execute("UPDATE `mailboxes` SET `updated`=? WHERE `id`=?",
+                   (when, mailbox_id))
+
+    def get_mailbox_sides(self, app_id, mailbox_id):
+        db = self.shards.for_mailbox(mailbox_id)
+        return db.execute("SELECT `side`, `opened`, `added`, `mood`"
+                          " FROM `mailbox_sides` WHERE `mailbox_id`=?"
+                          " ORDER BY `rowid`",
+                          (mailbox_id,)).fetchall()
+
+    def add_mailbox_side(self, app_id, mailbox_id, side, when):
+        db = self.shards.for_mailbox(mailbox_id)
+        db.execute("INSERT INTO `mailbox_sides`"
+                   " (`mailbox_id`, `opened`, `side`, `added`)"
+                   " VALUES(?,?,?,?)",
+                   (mailbox_id, True, side, when))
+
+    def close_mailbox_side(self, app_id, mailbox_id, side, mood):
+        db = self.shards.for_mailbox(mailbox_id)
+        db.execute("UPDATE `mailbox_sides` SET `opened`=?, `mood`=?"
+                   " WHERE `mailbox_id`=? AND `side`=?",
+                   (False, mood, mailbox_id, side))
+
+    def delete_mailbox(self, app_id, mailbox_id):
+        db = self.shards.for_mailbox(mailbox_id)
+        # the nameplate (if any) refers to the mailbox, and its sides to the
+        # nameplate, so those go first
+        db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id` IN"
+                   " (SELECT `id` FROM `nameplates` WHERE `mailbox_id`=?)",
+                   (mailbox_id,))
+        db.execute("DELETE FROM `nameplates` WHERE `mailbox_id`=?",
+                   (mailbox_id,))
+        db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
+                   (mailbox_id,))
+        db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
+                   (mailbox_id,))
+        db.execute("DELETE FROM `mailboxes` WHERE `id`=?", (mailbox_id,))
+
+    def count_mailboxes(self, app_id):
+        return self._count_app_rows("mailboxes", app_id)
+
+    def prune(self, app_id, old, limit=None):
+        # Each shard is pruned on its own, so rows left behind by a change
+        # in the number of shards (which for_mailbox() and for_nameplate()
+        # no longer point at) are still found and deleted. A nameplate and
+        # its mailbox are always created in the same shard.
+        nameplates = []
+        mailboxes = []
+        for db in self.shards.all():
+            remaining = -1 if limit is None else limit - len(mailboxes)
+            if remaining == 0:
+                break
+            old_mailboxes = [row["id"] for row in db.execute(
+                "SELECT `id` FROM `mailboxes`"
+                " WHERE `app_id`=? AND `updated`<=? LIMIT ?",
+                (app_id, old, remaining)).fetchall()]
+            for mailbox_id in old_mailboxes:
+                for row in db.execute("SELECT `id` FROM `nameplates`"
+                                      " WHERE `app_id`=? AND `mailbox_id`=?",
+                                      (app_id, mailbox_id)).fetchall():
+                    nameplates.append(db.execute(
+                        "SELECT `side`, `claimed`, `added`"
+                        " FROM `nameplate_sides` WHERE `nameplates_id`=?"
+                        " ORDER BY `rowid`", (row["id"],)).fetchall())
+                    db.execute("DELETE FROM `nameplate_sides`"
+                               " WHERE `nameplates_id`=?", (row["id"],))
+                    db.execute("DELETE FROM `nameplates` WHERE `id`=?",
+                               (row["id"],))
+                row = db.execute("SELECT `for_nameplate` FROM `mailboxes`"
+                                 " WHERE `app_id`=? AND `id`=?",
+                                 (app_id, mailbox_id)).fetchone()
+                sides = db.execute("SELECT `side`, `opened`, `added`, `mood`"
+                                   " FROM `mailbox_sides`"
+                                   " WHERE `mailbox_id`=? ORDER BY `rowid`",
+                                   (mailbox_id,)).fetchall()
+                mailboxes.append((row["for_nameplate"], sides))
+                db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
+                           (mailbox_id,))
+                db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
+                           (mailbox_id,))
+                db.execute("DELETE FROM `mailboxes` WHERE `id`=?",
+                           (mailbox_id,))
+        return nameplates, mailboxes
+
+    # messages
+
+    def add_message(self, app_id, mailbox_id, side, phase, body, server_rx,
+                    msg_id):
+        db = self.shards.for_mailbox(mailbox_id)
+        c = db.execute("INSERT INTO `messages`"
+                       " (`app_id`, `mailbox_id`, `side`, `phase`,"
+                       "  `body`, `server_rx`, `msg_id`)"
+                       " VALUES (?,?,?,?,?, ?,?)",
+                       (app_id, mailbox_id, side, phase, body, server_rx,
+                        msg_id))
+        return c.lastrowid
+
+    def get_messages(self, app_id, mailbox_id, since=0):
+        # messages_idx covers this range, so a reconnecting client doesn't
+        # cost a scan of the whole mailbox
+        db = self.shards.for_mailbox(mailbox_id)
+        return db.execute("SELECT `id` AS `seq`, `side`, `phase`, `body`,"
+                          " `server_rx`, `msg_id` FROM `messages`"
+                          " WHERE `app_id`=? AND `mailbox_id`=?"
+                          " AND `id`>?"
+                          " ORDER BY `id` ASC",
+                          (app_id, mailbox_id, since)).fetchall()
+
+    def get_last_seq(self, app_id, mailbox_id):
+        db = self.shards.for_mailbox(mailbox_id)
+        row = db.execute("SELECT MAX(`id`) AS `seq` FROM `messages`"
+                         " WHERE `app_id`=? AND `mailbox_id`=?",
+                         (app_id, mailbox_id)).fetchone()
+        return row["seq"] or 0
+
+    def has_message(self, app_id, mailbox_id, side, phase, msg_id):
+        # mailboxes only hold a handful of messages, so messages_idx is
+        # enough to make this cheap
+        db = self.shards.for_mailbox(mailbox_id)
+        row = db.execute("SELECT `id` FROM `messages`"
+                         " WHERE `app_id`=? AND `mailbox_id`=?"
+                         " AND `side`=? AND `phase`=? AND `msg_id`=?",
+                         (app_id, mailbox_id, side, phase,
+                          msg_id)).fetchone()
+        return bool(row)
+
+    def get_mailbox_size(self, app_id, mailbox_id):
+        db = self.shards.for_mailbox(mailbox_id)
+        row = db.execute("SELECT COUNT() AS `count`,"
+                         " TOTAL(LENGTH(`body`)) AS `length`"
+                         " FROM `messages`"
+                         " WHERE `app_id`=? AND `mailbox_id`=?",
+                         (app_id, mailbox_id)).fetchone()
+        return (row["count"], int(row["length"]))
+
+    # statistics
+
+    def get_app_ids(self):
+        apps = set()
+        for db in self.shards.all():
+            for table in ["nameplates", "mailboxes", "messages"]:
+                for row in db.execute("SELECT DISTINCT `app_id`"
+                                      f" FROM `{table}`").fetchall():
+                    apps.add(row["app_id"])
+        return apps
+
+    def _count_all(self, table):
+        counts = Counter()
+        for db in self.shards.all():
+            for row in db.execute("SELECT `app_id`, COUNT() AS `count`"
+                                  f" FROM `{table}` GROUP BY `app_id`"):
+                counts[row["app_id"]] += row["count"]
+        return dict(counts)
+
+    def count_all_nameplates(self):
+        return self._count_all("nameplates")
+
+    def count_all_mailboxes(self):
+        return self._count_all("mailboxes")
+
+    def get_largest_mailbox(self):
+        # each mailbox is in a single shard
+        q = lambda db, sql: db.execute(sql).fetchone()["usage"] or 0
+        return (
+            max(q(db, "SELECT MAX(`count`) AS `usage` FROM"
+                      " (SELECT COUNT() AS `count` FROM `messages`"
+                      "  GROUP BY `app_id`, `mailbox_id`)")
+                for db in self.shards.all()),
+            max(q(db, "SELECT MAX(`length`) AS `usage` FROM"
+                      " (SELECT SUM(LENGTH(`body`)) AS `length`"
+                      "  FROM `messages` GROUP BY `app_id`, `mailbox_id`)")
+                for db in self.shards.all()),
+            )
+
+    # connections, and the address-id generation, are in the first shard
+
+    def clear_connections(self):
+        db = self.shards.primary()
+        db.execute("DELETE FROM `connection_messages`")
+        db.execute("DELETE FROM `connections`")
+
+    def add_connection(self, addrid_generation, addrid_counter, now):
+        sql = ("INSERT INTO `connections`"
+               " (`addrid_generation`, `addrid_counter`, `connected`, `active`)"
+               " VALUES(?,?,?,?)")
+        return self.shards.primary().execute(
+            sql, (addrid_generation, addrid_counter, now, now)).lastrowid
+
+    def set_connection_side(self, connection_id, side, implementation,
+                            version):
+        self.shards.primary().execute(
+            "UPDATE `connections`"
+            " SET `side`=?, `implementation`=?, `version`=?"
+            " WHERE `id`=?",
+            (side, implementation, version, connection_id))
+
+    def add_connection_message(self, connection_id, now, name):
+        db = self.shards.primary()
+        db.execute("UPDATE `connections`"
+                   " SET `active`=?"
+                   " WHERE `id`=?",
+                   (now, connection_id))
+        db.execute("INSERT INTO `connection_messages`"
+                   " (`id`, `when`, `name`)"
+                   " VALUES(?,?,?)",
+                   (connection_id, now, name))
+
+    def remove_connection(self, connection_id):
+        db = self.shards.primary()
+        db.execute("DELETE FROM `connection_messages` WHERE `id`=?",
+                   (connection_id,))
+        db.execute("DELETE FROM `connections` WHERE `id`=?",
+                   (connection_id,))
+
+    def get_connections(self):
+        return self.shards.primary().execute(
+            "SELECT * FROM `connections` ORDER BY `id`").fetchall()
+
+    def get_connection_messages(self, connection_id):
+        return self.shards.primary().execute(
+            "SELECT `when`, `name` FROM `connection_messages`"
+            " WHERE `id`=? ORDER BY `rowid`", (connection_id,)).fetchall()
+
+    def get_addrid_generation(self):
+        return self.shards.primary().execute(
+            "SELECT `generation`, `started` FROM `addrid_generation`"
+            ).fetchone()
+
+    def set_addrid_generation(self, generation, started):
+        db = self.shards.primary()
+        db.execute("DELETE FROM `addrid_generation`")
+        db.execute("INSERT INTO `addrid_generation`"
+                   " (`generation`, `started`)"
+                   " VALUES(?,?)",
+                   (generation, started))
+
+
+@implementer(IAddressIDStore)
+class SQLiteAddressIDStore(object):
+    def __init__(self, db):
+        self._db = db
+
+    def commit(self):
+        self._db.commit()
+
+    def clear(self):
+        self._db.execute("DELETE FROM `address_ids`")
+
+    def get_id(self, addr_type, address):
+        # we should only record one generation at a time, so there
+        # shouldn't be more than one match
+        row = self._db.execute("SELECT * FROM `address_ids`"
+                               " WHERE `type`=? AND `address`=?",
+                               (addr_type, address)).fetchone()
+        if row:
+            return (row["generation"], row["counter"])
+        return None
+
+    def get_address(self, generation, counter):
+        row = self._db.execute("SELECT * FROM `address_ids`"
+                               " WHERE `generation`=? AND `counter`=?",
+                               (generation, counter)).fetchone()
+        if row:
+            return (row["type"], row["address"])
+        return None
+
+    def get_last_counter(self, generation):
+        row = self._db.execute("SELECT `counter` FROM `address_ids`"
+                               " WHERE `generation`=?"
+                               " ORDER BY `counter` DESC"
+                               " LIMIT 1",
+                               (generation,)).fetchone()
+        return row["counter"] if row else 0
+
+    def add_id(self, generation, counter, addr_type, address):
+        self._db.execute("INSERT INTO `address_ids`"
+                         " (`generation`, `counter`, `type`, `address`)"
+                         " VALUES(?,?,?,?)",
+                         (generation, counter, addr_type, address))
@@ -0,0 +1,198 @@
+from zope.interface import Interface
+
+# The server keeps its channel state (nameplates, mailboxes, messages, the
+# connection table, and the address-id generation) in an IChannelStore, and
+# the address-id mapping in an IAddressIDStore. The usual stores are the
+# SQLite ones in sqlite_storage.py, which use the --channel-db= (and its
+# shards) and the --addrid-db=. memory_storage.py has stores which keep
+# everything in dicts. Other stores can be passed to make_server() as
+# store= and addrid_store=. test/test_storage.py has the tests which every
+# store must pass.
+#
+# Rows are returned as dicts, with the keys named in each method. Times
+# are whatever numbers the server passes in. Changes made through a store
+# need not be visible to other processes (or survive a crash) until
+# commit() is called, but must be visible through the same store at once.
+
+class IChannelStore(Interface):
+    """The channel state of a server."""
+
+    def commit():
+        """Make the changes so far durable, and visible to other processes
+        sharing this store."""
+
+    # nameplates
+
+    def get_nameplates(app_id):
+        """Return a dict mapping each nameplate name of 'app_id' to the id
+        of its mailbox."""
+
+    def get_nameplate(app_id, name):
+        """Return the mailbox id of nameplate 'name', or None if there is
+        no such nameplate."""
+
+    def accepts_mailbox_id(app_id, name, mailbox_id):
+        """Return True if 'mailbox_id' may be used for the mailbox of
+        nameplate 'name' (a store may want to keep the two together)."""
+
+    def add_nameplate(app_id, name, mailbox_id):
+        """Create nameplate 'name', for mailbox 'mailbox_id'."""
+
+    def get_nameplate_sides(app_id, name):
+        """Return the sides of nameplate 'name', as a list of dicts with
+        'side', 'claimed', and 'added', in the order they were added."""
+
+    def add_nameplate_side(app_id, name, side, when):
+        """Add 'side' to nameplate 'name', as claimed."""
+
+    def release_nameplate_side(app_id, name, side):
+        """Mark 'side' of nameplate 'name' as no longer claimed."""
+
+    def delete_nameplate(app_id, name):
+        """Delete nameplate 'name', and its sides."""
+
+    def count_nameplates(app_id):
+        """Return the number of nameplates of 'app_id'."""
+
+    # mailboxes
+
+    def get_mailboxes(app_id):
+        """Return a dict mapping each mailbox id of 'app_id' to the time it
+        was last updated."""
+
+    def get_mailbox(app_id, mailbox_id):
+        """Return a dict with 'for_nameplate' and 'updated', or None if
+        there is no such mailbox."""
+
+    def add_mailbox(app_id, mailbox_id, for_nameplate, when):
+        """Create mailbox 'mailbox_id', updated at 'when'."""
+
+    def touch_mailbox(app_id, mailbox_id, when):
+        """Set the time mailbox 'mailbox_id' was last updated."""
+
+    def get_mailbox_sides(app_id, mailbox_id):
+        """Return the sides of mailbox 'mailbox_id', as a list of dicts with
+        'side', 'opened', 'added', and 'mood', in the order they were
+        added."""
+
+    def add_mailbox_side(app_id, mailbox_id, side, when):
+        """Add 'side' to mailbox 'mailbox_id', as opened."""
+
+    def close_mailbox_side(app_id, mailbox_id, side, mood):
+        """Mark 'side' of mailbox 'mailbox_id' as closed, with 'mood'."""
+
+    def delete_mailbox(app_id, mailbox_id):
+        """Delete mailbox 'mailbox_id', with its sides and messages, and
+        any nameplate (with its sides) which refers to it."""
+
+    def count_mailboxes(app_id):
+        """Return the number of mailboxes of 'app_id'."""
+
+    def prune(app_id, old, limit=None):
+        """Delete every mailbox of 'app_id' last updated at or before 'old'
+        (or only 'limit' of them, if given), with its sides and messages,
+        and any nameplate (with its sides) which refers to it. This must also find rows which the other
+        methods no longer look for, such as ones left in the wrong shard
+        after the number of shards changed. Return (nameplates,
+        mailboxes): a list with the sides (as from get_nameplate_sides) of
+        each deleted nameplate, and a list of (for_nameplate, sides) for
+        each deleted mailbox, with sides as from get_mailbox_sides."""
+
+    # messages
+
+    def add_message(app_id, mailbox_id, side, phase, body, server_rx,
+                    msg_id):
+        """Add a message to mailbox 'mailbox_id', and return its seq: a
+        positive integer, larger than the seq of every earlier message in
+        the mailbox."""
+
+    def get_messages(app_id, mailbox_id, since=0):
+        """Return the messages of mailbox 'mailbox_id' with a seq larger
+        than 'since', in order, as a list of dicts with 'seq', 'side',
+        'phase', 'body', 'server_rx', and 'msg_id'."""
+
+    def get_last_seq(app_id, mailbox_id):
+        """Return the largest seq in mailbox 'mailbox_id', or 0."""
+
+    def has_message(app_id, mailbox_id, side, phase, msg_id):
+        """Return True if 'side' has added a message to mailbox
+        'mailbox_id' with this 'phase' and 'msg_id'."""
+
+    def get_mailbox_size(app_id, mailbox_id):
+        """Return (number of messages, total length of their bodies) for
+        mailbox 'mailbox_id'."""
+
+    # statistics
+
+    def get_app_ids():
+        """Return the set of app_ids with any nameplates, mailboxes, or
+        messages."""
+
+    def count_all_nameplates():
+        """Return a dict mapping each app_id to its number of
+        nameplates."""
+
+    def count_all_mailboxes():
+        """Return a dict mapping each app_id to its number of mailboxes."""
+
+    def get_largest_mailbox():
+        """Return (the most messages in any mailbox, the largest total
+        length of the bodies in any mailbox), or (0, 0)."""
+
+    # connections
+
+    def clear_connections():
+        """Delete every connection."""
+
+    def add_connection(addrid_generation, addrid_counter, now):
+        """Record a new connection, and return its id."""
+
+    def set_connection_side(connection_id, side, implementation, version):
+        """Record the side and client version of a connection."""
+
+    def add_connection_message(connection_id, now, name):
+        """Record a command received by a connection at 'now', which also
+        becomes the time it was last active."""
+
+    def remove_connection(connection_id):
+        """Delete a connection and its commands."""
+
+    def get_connections():
+        """Return every connection, as a list of dicts with 'id',
+        'addrid_generation', 'addrid_counter', 'connected', 'side',
+        'implementation', 'version', and 'active'."""
+
+    def get_connection_messages(connection_id):
+        """Return the commands of a connection, in order, as a list of
+        dicts with 'when' and 'name'."""
+
+    # address-id generations
+
+    def get_addrid_generation():
+        """Return a dict with the current 'generation' and the time it
+        'started', or None before the first one."""
+
+    def set_addrid_generation(generation, started):
+        """Replace the current address-id generation."""
+
+
+class IAddressIDStore(Interface):
+    """The mapping between client addresses and address ids."""
+
+    def commit():
+        """Make the changes so far durable."""
+
+    def clear():
+        """Forget every address."""
+
+    def get_id(addr_type, address):
+        """Return (generation, counter) for this address, or None."""
+
+    def get_address(generation, counter):
+        """Return (addr_type, address) for this address id, or None."""
+
+    def get_last_counter(generation):
+        """Return the largest counter used in 'generation', or 0."""
+
+    def add_id(generation, counter, addr_type, address):
+        """Record the address id of an address."""
@@ -1,10 +1,12 @@
 #from __future__ import unicode_literals
-from twisted.internet import reactor, endpoints
+import os, socket, sys
+from twisted.internet import reactor, endpoints, defer, protocol
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import deferLater
 from ..database import create_or_upgrade_channel_db, create_or_upgrade_usage_db
 from ..server import make_server
 from ..web import make_web_server
+from .ws_client import WSFactory
 
 class ServerBase:
     log_requests = False
@@ -20,13 +22,16 @@ class ServerBase:
         yield self._setup_relay(blur_usage=blur_usage, usage_db=usage_db)
 
     @inlineCallbacks
-    def _setup_relay(self, do_listen=False, web_log_requests=False, **kwargs):
+    def _setup_relay(self, do_listen=False, web_log_requests=False,
+                     compression=None, max_message_size=None, **kwargs):
         channel_db = create_or_upgrade_channel_db(":memory:")
         self._server = make_server(channel_db, **kwargs)
         if do_listen:
             ep = endpoints.TCP4ServerEndpoint(reactor, 0, interface="127.0.0.1")
             self._site = make_web_server(self._server,
-                                         log_requests=web_log_requests)
+                                         log_requests=web_log_requests,
+                                         compression=compression,
+                                         max_message_size=max_message_size)
             self._lp = yield ep.listen(self._site)
             addr = self._lp.getHost()
             self.relayurl = "ws://127.0.0.1:%d/v1" % addr.port
@@ -52,32 +57,99 @@ class ServerBase:
         if self._lp:
             yield self._lp.stopListening()
 
+class ClientServerBase(ServerBase):
+    # for tests which each start the server (with _setup_relay) with their
+    # own options, and connect clients to it
+    def setUp(self):
+        self._lp = None
+        self._clients = []
+
+    def tearDown(self):
+        for c in self._clients:
+            c.transport.loseConnection()
+        return ServerBase.tearDown(self)
+
+    def client_factory(self, url):
+        return WSFactory(url)
+
+    @inlineCallbacks
+    def make_client(self, port=None):
+        port = port or self.rdv_ws_port
+        f = self.client_factory("ws://127.0.0.1:%d/v1" % port)
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", port, f)
+        c = yield f.d
+        self._clients.append(c)
+        return c
+
 class _Util:
     def _nameplate(self, app, name):
-        np_row = app._db.execute("SELECT * FROM `nameplates`"
-                                 " WHERE `app_id`='appid' AND `name`=?",
-                                 (name,)).fetchone()
+        db = app._store.shards.primary()
+        np_row = db.execute("SELECT * FROM `nameplates`"
+                            " WHERE `app_id`='appid' AND `name`=?",
+                            (name,)).fetchone()
         if not np_row:
             return None, None
         npid = np_row["id"]
-        side_rows = app._db.execute("SELECT * FROM `nameplate_sides`"
-                                    " WHERE `nameplates_id`=?",
-                                    (npid,)).fetchall()
+        side_rows = db.execute("SELECT * FROM `nameplate_sides`"
+                               " WHERE `nameplates_id`=?",
+                               (npid,)).fetchall()
         return np_row, side_rows
 
     def _mailbox(self, app, mailbox_id):
-        mb_row = app._db.execute("SELECT * FROM `mailboxes`"
-                                 " WHERE `app_id`='appid' AND `id`=?",
-                                 (mailbox_id,)).fetchone()
+        db = app._store.shards.primary()
+        mb_row = db.execute("SELECT * FROM `mailboxes`"
+                            " WHERE `app_id`='appid' AND `id`=?",
+                            (mailbox_id,)).fetchone()
         if not mb_row:
             return None, None
-        side_rows = app._db.execute("SELECT * FROM `mailbox_sides`"
-                                    " WHERE `mailbox_id`=?",
-                                    (mailbox_id,)).fetchall()
+        side_rows = db.execute("SELECT * FROM `mailbox_sides`"
+                               " WHERE `mailbox_id`=?",
+                               (mailbox_id,)).fetchall()
         return mb_row, side_rows
 
     def _messages(self, app):
-        c = app._db.execute("SELECT * FROM `messages`"
-                            " WHERE `app_id`='appid' AND `mailbox_id`='mid'")
+        db = app._store.shards.primary()
+        c = db.execute("SELECT * FROM `messages`"
+                       " WHERE `app_id`='appid' AND `mailbox_id`='mid'")
         return c.fetchall()
 
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class ServerProcess(protocol.ProcessProtocol):
+    """A 'twist wormhole-mailbox' child process, for tests which need
+    several real servers."""
+    def __init__(self, args, path):
+        self.ended = defer.Deferred()
+        argv = [sys.executable, "-m", "twisted", "wormhole-mailbox"] + args
+        self.transport = reactor.spawnProcess(self, sys.executable, argv,
+                                              env=os.environ, path=path,
+                                              childFDs={0: "w", 1: "r",
+                                                        2: "r"})
+    def processEnded(self, reason):
+        self.ended.callback(None)
+    def stop(self):
+        if not self.ended.called:
+            self.transport.signalProcess("TERM")
+        return self.ended
+
+@inlineCallbacks
+def wait_for_port(port, tries=300):
+    ep = endpoints.TCP4ClientEndpoint(reactor, "127.0.0.1", port)
+    for i in range(tries):
+        try:
+            p = yield ep.connect(protocol.Factory.forProtocol(
+                protocol.Protocol))
+        except Exception:
+            yield deferLater(reactor, 0.1)
+        else:
+            p.transport.loseConnection()
+            return
+    raise AssertionError("nothing is listening on port %d" % port)
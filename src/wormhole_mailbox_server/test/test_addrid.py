@@ -1,16 +1,18 @@
 from twisted.trial import unittest
 from ..database import create_channel_db, create_addrid_db
 from ..address_id import AddressIDTracker
+from ..sqlite_storage import SQLiteChannelStore, SQLiteAddressIDStore
 
 class AddressID(unittest.TestCase):
     def test_generations(self):
         db = create_channel_db(":memory:")
         addr_db = create_addrid_db(":memory:")
-        tracker = AddressIDTracker(db, addr_db)
+        tracker = AddressIDTracker(SQLiteChannelStore([db]),
+                                   SQLiteAddressIDStore(addr_db))
         duration = 100
 
         now = 1
-        tracker.check_generation(now, duration, force=True)
+        self.assertTrue(tracker.check_generation(now, duration, force=True))
         row = db.execute("SELECT * FROM addrid_generation").fetchone()
         self.assertEqual(row["generation"], 1)
         self.assertEqual(row["started"], 1)
@@ -19,14 +21,14 @@ class AddressID(unittest.TestCase):
 
         # generation is still going
         now = 10
-        tracker.check_generation(now, duration)
+        self.assertFalse(tracker.check_generation(now, duration))
         row = db.execute("SELECT * FROM addrid_generation").fetchone()
         self.assertEqual(row["generation"], 1)
         self.assertEqual(row["started"], 1)
 
         # generation just finished, new one starts
         now = 102
-        tracker.check_generation(now, duration)
+        self.assertTrue(tracker.check_generation(now, duration))
         row = db.execute("SELECT * FROM addrid_generation").fetchone()
         self.assertEqual(row["generation"], 2)
         self.assertEqual(row["started"], 101)
@@ -61,7 +63,8 @@ class AddressID(unittest.TestCase):
     def test_address_ids(self):
         db = create_channel_db(":memory:")
         addr_db = create_addrid_db(":memory:")
-        tracker = AddressIDTracker(db, addr_db)
+        tracker = AddressIDTracker(SQLiteChannelStore([db]),
+                                   SQLiteAddressIDStore(addr_db))
         duration = 100
 
         now = 1
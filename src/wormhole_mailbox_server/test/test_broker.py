@@ -0,0 +1,155 @@
+import json, os
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+from twisted.internet.testing import StringTransport
+from ..database import create_or_upgrade_channel_db
+from ..server import make_server, SidedMessage
+from ..broker import Broker, BrokerClient
+
+def connect(broker):
+    p = broker.buildProtocol(None)
+    t = StringTransport()
+    p.makeConnection(t)
+    return p, t
+
+def send(p, **kwargs):
+    p.dataReceived(json.dumps(kwargs).encode("utf-8") + b"\n")
+
+def received(t):
+    lines = t.value().splitlines()
+    t.clear()
+    return [json.loads(line) for line in lines]
+
+class Fanout(unittest.TestCase):
+    def test_publish(self):
+        b = Broker()
+        p1, t1 = connect(b)
+        p2, t2 = connect(b)
+        p3, t3 = connect(b)
+        for p in [p1, p2]:
+            send(p, subscribe=["appid", "mid"])
+        send(p3, subscribe=["appid", "other"])
+        send(p1, publish=["appid", "mid"], seq=7)
+        # not back to the publisher, or to other mailboxes
+        self.assertEqual(received(t1), [])
+        self.assertEqual(received(t2), [{"message": ["appid", "mid"],
+                                         "seq": 7}])
+        self.assertEqual(received(t3), [])
+
+        send(p2, unsubscribe=["appid", "mid"])
+        send(p3, publish=["appid", "mid"], seq=8)
+        self.assertEqual(received(t1), [{"message": ["appid", "mid"],
+                                         "seq": 8}])
+        self.assertEqual(received(t2), [])
+        p1.connectionLost(None)
+        p3.connectionLost(None)
+        self.assertEqual(b.count_topics(), 0)
+
+    def test_bad_line(self):
+        b = Broker()
+        p1, t1 = connect(b)
+        p1.dataReceived(b"not json\n")
+        self.assertTrue(t1.disconnecting)
+
+    def test_slow_subscriber(self):
+        b = Broker(max_queue=2)
+        p1, t1 = connect(b)
+        p2, t2 = connect(b)
+        send(p1, subscribe=["appid", "mid"])
+        # the kernel buffer is full: notifications wait, up to a point
+        p1.pauseProducing()
+        send(p2, publish=["appid", "mid"], seq=1)
+        send(p2, publish=["appid", "mid"], seq=2)
+        self.assertEqual(received(t1), [])
+        p1.resumeProducing()
+        self.assertEqual([m["seq"] for m in received(t1)], [1, 2])
+        p1.pauseProducing()
+        for seq in [3, 4, 5]:
+            send(p2, publish=["appid", "mid"], seq=seq)
+        self.assertTrue(t1.disconnecting)
+
+
+class Servers(unittest.TestCase):
+    # two servers sharing one channel DB, with a broker between them
+    timeout = 30
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        os.mkdir(self.basedir)
+        self.path = os.path.join(self.basedir, "broker.sock")
+        dbfile = os.path.join(self.basedir, "relay.sqlite")
+        self.broker = Broker()
+        self.port = reactor.listenUNIX(self.path, self.broker)
+        self.servers = []
+        self.clients = []
+        for i in range(2):
+            server = make_server(create_or_upgrade_channel_db(dbfile))
+            client = BrokerClient(reactor, server, self.path,
+                                  retry_delay=0.1)
+            server.set_broker(client)
+            client.startService()
+            self.servers.append(server)
+            self.clients.append(client)
+
+    @inlineCallbacks
+    def tearDown(self):
+        for client in self.clients:
+            yield client.stopService()
+        if self.port:
+            yield self.port.stopListening()
+
+    @inlineCallbacks
+    def wait_for(self, condition):
+        while not condition():
+            yield deferLater(reactor, 0.01)
+
+    @inlineCallbacks
+    def test_broadcast(self):
+        a, b = self.servers
+        yield self.wait_for(lambda: all(c._p for c in self.clients))
+        mb_a = a.get_app("appid").open_mailbox("mid", "side1", 1)
+        got = []
+        mb_a.add_listener("h1", got.append, lambda: None)
+        yield self.wait_for(lambda: self.broker.count_topics() == 1)
+
+        mb_b = b.get_app("appid").open_mailbox("mid", "side2", 2)
+        mb_b.add_message(SidedMessage("side2", "pake", "bb", 2, None))
+        yield self.wait_for(lambda: got)
+        self.assertEqual([(sm.side, sm.body) for sm in got], [("side2", "bb")])
+
+        # while the broker is away, notifications are kept, and when it
+        # comes back, everybody catches up
+        yield self.port.stopListening()
+        for c in self.clients:
+            c._p.transport.loseConnection()
+        yield self.wait_for(lambda: not any(c._p for c in self.clients))
+        mb_b.add_message(SidedMessage("side2", "version", "cc", 3, None))
+        self.assertEqual(len(got), 1)
+        self.assertEqual(list(self.clients[1]._pending),
+                         [("appid", "mid")])
+        self.port = reactor.listenUNIX(self.path, self.broker)
+        yield self.wait_for(lambda: len(got) == 2)
+        self.assertEqual(got[1].body, "cc")
+        yield self.wait_for(lambda: not self.clients[1]._pending)
+
+        # once nobody listens, the broker forgets the mailbox
+        mb_a.remove_listener("h1")
+        yield self.wait_for(lambda: self.broker.count_topics() == 0)
+
+    def test_order(self):
+        # a server which adds a message delivers any earlier ones from the
+        # other server first, even if it hasn't been told about them yet
+        a, b = self.servers
+        mb_a = a.get_app("appid").open_mailbox("mid", "side1", 1)
+        got = []
+        mb_a.add_listener("h1", got.append, lambda: None)
+        mb_b = b.get_app("appid").open_mailbox("mid", "side2", 2)
+        mb_b.add_message(SidedMessage("side2", "pake", "bb", 2, None))
+        mb_a.add_message(SidedMessage("side1", "pake", "aa", 3, None))
+        self.assertEqual([sm.body for sm in got], ["bb", "aa"])
+        # and the late notification changes nothing
+        a.mailbox_changed("appid", "mid", got[0].seq)
+        a.mailbox_changed("appid", "mid")
+        self.assertEqual([sm.body for sm in got], ["bb", "aa"])
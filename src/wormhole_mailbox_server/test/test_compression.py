@@ -0,0 +1,50 @@
+from twisted.trial import unittest
+from autobahn.websocket.compress import (PerMessageDeflateOffer,
+                                         PerMessageDeflate)
+from ..compression import Compression, TimedDeflate
+
+class Accept(unittest.TestCase):
+    def test_off(self):
+        c = Compression()
+        self.assertFalse(c.enabled())
+
+    def test_accept(self):
+        c = Compression("on")
+        self.assertTrue(c.enabled())
+        a = c.accept([PerMessageDeflateOffer()])
+        self.assertEqual(a.no_context_takeover, None)
+        self.assertEqual(a.window_bits, None)
+        self.assertEqual(a.mem_level, None)
+        self.assertEqual(c.accept(["some-other-extension"]), None)
+
+    def test_parameters(self):
+        c = Compression("no-context-takeover", window_bits=12, mem_level=4)
+        a = c.accept([PerMessageDeflateOffer()])
+        self.assertEqual(a.no_context_takeover, True)
+        self.assertEqual(a.window_bits, 12)
+        self.assertEqual(a.mem_level, 4)
+        # clients may ask for a smaller window
+        offer = PerMessageDeflateOffer(request_max_window_bits=10)
+        a = c.accept([offer])
+        self.assertEqual(a.window_bits, 10)
+
+    def test_client_requests_no_context_takeover(self):
+        c = Compression("on")
+        offer = PerMessageDeflateOffer(request_no_context_takeover=True)
+        a = c.accept([offer])
+        self.assertEqual(a.no_context_takeover, True)
+
+class Timed(unittest.TestCase):
+    def test_roundtrip(self):
+        server = TimedDeflate(PerMessageDeflate(True, False, False, 0, 0, 0))
+        client = PerMessageDeflate(False, False, False, 0, 0, 0)
+        data = b"x" * 10000
+        server.start_compress_message()
+        compressed = (server.compress_message_data(data)
+                      + server.end_compress_message())
+        self.assertLess(len(compressed), len(data))
+        client.start_decompress_message()
+        self.assertEqual(client.decompress_message_data(compressed), data)
+        client.end_decompress_message()
+        self.assertGreaterEqual(server.cpu, 0.0)
+        self.assertEqual(server.EXTENSION_NAME, "permessage-deflate")
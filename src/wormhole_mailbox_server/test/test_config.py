@@ -4,196 +4,146 @@ from .. import server_tap
 
 PORT = r"tcp:4000:interface=\:\:"
 
+# the complete parsed configuration when no arguments are given
+DEFAULTS = {"port": PORT,
+            "ports": [(None, PORT)],
+            "port-websocket-options": {},
+            "channel-db": "relay.sqlite",
+            "disallow-list": 0,
+            "allow-list": True,
+            "advertise-version": None,
+            "signal-error": None,
+            "usage-db": None,
+            "blur-usage": None,
+            "motd": None,
+            "websocket-protocol-options": [],
+            "addrid-db": None,
+            "generation-duration": 86400,
+            "rate-limits": [],
+            "rate-limit-close": 0,
+            "max-reactor-lag": None,
+            "max-connections": None,
+            "permessage-deflate": "off",
+            "deflate-window-bits": None,
+            "deflate-mem-level": None,
+            "deflate-min-size": 0,
+            "max-body-size": None,
+            "max-mailbox-messages": None,
+            "max-mailbox-size": None,
+            "max-app-mailboxes": None,
+            "max-field-length": None,
+            "max-channels": None,
+            "max-app-nameplates": None,
+            "max-app-connections": None,
+            "max-app-command-rate": None,
+            "app-limits": {},
+            "max-message-size": None,
+            "channel-db-shards": 1,
+            "workers": 1,
+            "worker-socket-dir": ".",
+            "worker-index": None,
+            "cluster-node": None,
+            "cluster-listen": None,
+            "cluster-peers": {},
+            "handoff-socket": None,
+            "handoff-drain": 600,
+            "drain-redirect": None,
+            "drain-signals": 0,
+            "broker": None,
+            "snapshot-dir": None,
+            "snapshot-interval": 60.0,
+            }
+
 class Config(unittest.TestCase):
     def test_defaults(self):
         o = server_tap.Options()
         o.parseOptions([])
-        self.assertEqual(o, {"port": PORT,
-                             "channel-db": "relay.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": True,
-                             "advertise-version": None,
-                             "signal-error": None,
-                             "usage-db": None,
-                             "blur-usage": None,
-                             "motd": None,
-                             "websocket-protocol-options": [],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, DEFAULTS)
 
     def test_advertise_version(self):
         o = server_tap.Options()
         o.parseOptions(["--advertise-version=1.0"])
-        self.assertEqual(o, {"port": PORT,
-                             "channel-db": "relay.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": True,
-                             "advertise-version": "1.0",
-                             "signal-error": None,
-                             "usage-db": None,
-                             "blur-usage": None,
-                             "motd": None,
-                             "websocket-protocol-options": [],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, dict(DEFAULTS, **{"advertise-version": "1.0"}))
 
     def test_blur(self):
         o = server_tap.Options()
         o.parseOptions(["--blur-usage=60"])
-        self.assertEqual(o, {"port": PORT,
-                             "channel-db": "relay.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": True,
-                             "advertise-version": None,
-                             "signal-error": None,
-                             "usage-db": None,
-                             "blur-usage": 60,
-                             "motd": None,
-                             "websocket-protocol-options": [],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, dict(DEFAULTS, **{"blur-usage": 60}))
 
     def test_channel_db(self):
         o = server_tap.Options()
         o.parseOptions(["--channel-db=other.sqlite"])
-        self.assertEqual(o, {"port": PORT,
-                             "channel-db": "other.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": True,
-                             "advertise-version": None,
-                             "signal-error": None,
-                             "usage-db": None,
-                             "blur-usage": None,
-                             "motd": None,
-                             "websocket-protocol-options": [],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, dict(DEFAULTS, **{"channel-db": "other.sqlite"}))
 
     def test_disallow_list(self):
         o = server_tap.Options()
         o.parseOptions(["--disallow-list"])
-        self.assertEqual(o, {"port": PORT,
-                             "channel-db": "relay.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": False,
-                             "advertise-version": None,
-                             "signal-error": None,
-                             "usage-db": None,
-                             "blur-usage": None,
-                             "motd": None,
-                             "websocket-protocol-options": [],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, dict(DEFAULTS, **{"allow-list": False}))
 
     def test_port(self):
         o = server_tap.Options()
         o.parseOptions(["-p", "tcp:5555"])
-        self.assertEqual(o, {"port": "tcp:5555",
-                             "channel-db": "relay.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": True,
-                             "advertise-version": None,
-                             "signal-error": None,
-                             "usage-db": None,
-                             "blur-usage": None,
-                             "motd": None,
-                             "websocket-protocol-options": [],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, dict(DEFAULTS, port="tcp:5555",
+                                 ports=[(None, "tcp:5555")]))
 
         o = server_tap.Options()
         o.parseOptions(["--port=tcp:5555"])
-        self.assertEqual(o, {"port": "tcp:5555",
-                             "channel-db": "relay.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": True,
-                             "advertise-version": None,
-                             "signal-error": None,
-                             "usage-db": None,
-                             "blur-usage": None,
-                             "motd": None,
-                             "websocket-protocol-options": [],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, dict(DEFAULTS, port="tcp:5555",
+                                 ports=[(None, "tcp:5555")]))
+
+    def test_ports(self):
+        o = server_tap.Options()
+        o.parseOptions(["--port=tcp:5555",
+                        "--port=proxy=unix:/run/mailbox.sock:mode=660",
+                        "--port=health=tcp:5556:interface=127.0.0.1",
+                        "--port-websocket-option=health:autoPingInterval=5"])
+        self.assertEqual(o, dict(DEFAULTS, port="tcp:5555", ports=[
+            (None, "tcp:5555"),
+            ("proxy", "unix:/run/mailbox.sock:mode=660"),
+            ("health", "tcp:5556:interface=127.0.0.1")],
+            **{"port-websocket-options": {
+                "health": [("autoPingInterval", 5)]}}))
+
+    def test_ports_errors(self):
+        for args in [["--port=bad label=tcp:5555"],
+                     ["--port=health="],
+                     ["--port=a=tcp:5555", "--port=a=tcp:5556"],
+                     ["--port-websocket-option=health:autoPingInterval=5"],
+                     ["--port=health=tcp:5555",
+                      "--port-websocket-option=health"],
+                     ["--port=tcp:5555", "--port=tcp:5556", "--workers=2"],
+                     ["--port=tcp:5555", "--port=tcp:5556",
+                      "--handoff-socket=handoff"],
+                     ]:
+            o = server_tap.Options()
+            with self.assertRaises(UsageError):
+                o.parseOptions(args)
 
     def test_signal_error(self):
         o = server_tap.Options()
         o.parseOptions(["--signal-error=ohnoes"])
-        self.assertEqual(o, {"port": PORT,
-                             "channel-db": "relay.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": True,
-                             "advertise-version": None,
-                             "signal-error": "ohnoes",
-                             "usage-db": None,
-                             "blur-usage": None,
-                             "motd": None,
-                             "websocket-protocol-options": [],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, dict(DEFAULTS, **{"signal-error": "ohnoes"}))
 
     def test_usage_db(self):
         o = server_tap.Options()
         o.parseOptions(["--usage-db=usage.sqlite"])
-        self.assertEqual(o, {"port": PORT,
-                             "channel-db": "relay.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": True,
-                             "advertise-version": None,
-                             "signal-error": None,
-                             "usage-db": "usage.sqlite",
-                             "blur-usage": None,
-                             "motd": None,
-                             "websocket-protocol-options": [],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, dict(DEFAULTS, **{"usage-db": "usage.sqlite"}))
 
     def test_websocket_protocol_option_1(self):
         o = server_tap.Options()
         o.parseOptions(["--websocket-protocol-option", 'foo="bar"'])
-        self.assertEqual(o, {"port": PORT,
-                             "channel-db": "relay.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": True,
-                             "advertise-version": None,
-                             "signal-error": None,
-                             "usage-db": None,
-                             "blur-usage": None,
-                             "motd": None,
-                             "websocket-protocol-options": [("foo", "bar")],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, dict(DEFAULTS, **{"websocket-protocol-options": [("foo", "bar")]}))
 
     def test_websocket_protocol_option_2(self):
         o = server_tap.Options()
         o.parseOptions(["--websocket-protocol-option", 'foo="bar"',
                         "--websocket-protocol-option", 'baz=[1,"buz"]',
                         ])
-        self.assertEqual(o, {"port": PORT,
-                             "channel-db": "relay.sqlite",
-                             "disallow-list": 0,
-                             "allow-list": True,
-                             "advertise-version": None,
-                             "signal-error": None,
-                             "usage-db": None,
-                             "blur-usage": None,
-                             "motd": None,
-                             "websocket-protocol-options": [("foo", "bar"),
-                                                            ("baz", [1, "buz"]),
-                                                            ],
-                             "addrid-db": None,
-                             "generation-duration": 86400,
-                             })
+        self.assertEqual(o, dict(DEFAULTS, **{
+            "websocket-protocol-options": [("foo", "bar"),
+                                           ("baz", [1, "buz"]),
+                                           ],
+            }))
 
     def test_websocket_protocol_option_errors(self):
         o = server_tap.Options()
@@ -206,6 +156,188 @@ class Config(unittest.TestCase):
             # (e.g. '"bar"')
             o.parseOptions(["--websocket-protocol-option", 'foo=bar'])
 
+    def test_rate_limit(self):
+        o = server_tap.Options()
+        o.parseOptions(["--rate-limit", "add:10:50",
+                        "--rate-limit", "list:0.5",
+                        "--rate-limit-close"])
+        self.assertEqual(o, dict(DEFAULTS, **{
+            "rate-limits": [("add", 10.0, 50.0),
+                            ("list", 0.5, 1.0),
+                            ],
+            "rate-limit-close": 1,
+            }))
+
+    def test_rate_limit_errors(self):
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--rate-limit", "add"])
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--rate-limit", "bogus:10"])
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--rate-limit", "add:ten"])
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--rate-limit", "add:10:0"])
+
+    def test_overload(self):
+        o = server_tap.Options()
+        o.parseOptions(["--max-reactor-lag=0.5", "--max-connections=1000"])
+        self.assertEqual(o, dict(DEFAULTS, **{"max-reactor-lag": 0.5,
+                                              "max-connections": 1000}))
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--max-connections=lots"])
+
+    def test_deflate(self):
+        o = server_tap.Options()
+        o.parseOptions(["--permessage-deflate=no-context-takeover",
+                        "--deflate-window-bits=10", "--deflate-mem-level=4",
+                        "--deflate-min-size=200"])
+        self.assertEqual(o, dict(DEFAULTS, **{
+            "permessage-deflate": "no-context-takeover",
+            "deflate-window-bits": 10,
+            "deflate-mem-level": 4,
+            "deflate-min-size": 200}))
+        for bad in ["--permessage-deflate=maybe", "--deflate-window-bits=8",
+                    "--deflate-mem-level=10"]:
+            o = server_tap.Options()
+            with self.assertRaises(UsageError):
+                o.parseOptions([bad])
+
+    def test_limits(self):
+        o = server_tap.Options()
+        o.parseOptions(["--max-body-size=65536", "--max-mailbox-messages=50",
+                        "--max-mailbox-size=1000000",
+                        "--max-app-mailboxes=10000", "--max-field-length=100"])
+        self.assertEqual(o, dict(DEFAULTS, **{
+            "max-body-size": 65536,
+            "max-mailbox-messages": 50,
+            "max-mailbox-size": 1000000,
+            "max-app-mailboxes": 10000,
+            "max-field-length": 100}))
+
+    def test_app_limits(self):
+        o = server_tap.Options()
+        o.parseOptions(["--max-app-nameplates=100",
+                        "--max-app-connections=200",
+                        "--max-app-command-rate=50",
+                        "--app-limit=lothar.com/wormhole/text-or-file-xfer:nameplates=1000",
+                        "--app-limit=lothar.com/wormhole/text-or-file-xfer:command-rate=500",
+                        "--app-limit=example.com:8080/app:connections=10"])
+        self.assertEqual(o, dict(DEFAULTS, **{
+            "max-app-nameplates": 100,
+            "max-app-connections": 200,
+            "max-app-command-rate": 50.0,
+            "app-limits": {
+                "lothar.com/wormhole/text-or-file-xfer": {
+                    "nameplates": 1000, "command-rate": 500.0},
+                "example.com:8080/app": {"connections": 10}}}))
+        for arg in ["appid=10", ":nameplates=10", "appid:bogus=10",
+                    "appid:nameplates=0", "appid:nameplates=x"]:
+            o = server_tap.Options()
+            with self.assertRaises(UsageError):
+                o.parseOptions(["--app-limit=" + arg])
+
+    def test_max_message_size(self):
+        o = server_tap.Options()
+        o.parseOptions(["--max-message-size=1000000"])
+        self.assertEqual(o, dict(DEFAULTS, **{"max-message-size": 1000000}))
+
+    def test_channel_db_shards(self):
+        o = server_tap.Options()
+        o.parseOptions(["--channel-db-shards=4"])
+        self.assertEqual(o, dict(DEFAULTS, **{"channel-db-shards": 4}))
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--channel-db-shards=0"])
+
+    def test_workers(self):
+        o = server_tap.Options()
+        o.parseOptions(["--workers=4", "--port=tcp:4000:interface=127.0.0.1"])
+        self.assertEqual(o, dict(DEFAULTS, workers=4,
+                                 port="tcp:4000:interface=127.0.0.1",
+                                 ports=[(None,
+                                         "tcp:4000:interface=127.0.0.1")]))
+        self.assertEqual(o.args, ["--workers=4",
+                                  "--port=tcp:4000:interface=127.0.0.1"])
+
+    def test_workers_errors(self):
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--workers=0"])
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--workers=2", "--port=unix:/tmp/sock"])
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--workers=2", "--port=tcp:4000:bogus=1"])
+
+    def test_cluster(self):
+        o = server_tap.Options()
+        o.parseOptions(["--cluster-node=a", "--cluster-listen=tcp:4100",
+                        "--cluster-peer=b=tcp:host-b:4100",
+                        "--cluster-peer=c=tcp:host-c:4100"])
+        self.assertEqual(o, dict(DEFAULTS, **{
+            "cluster-node": "a",
+            "cluster-listen": "tcp:4100",
+            "cluster-peers": {"b": "tcp:host-b:4100",
+                              "c": "tcp:host-c:4100"},
+            }))
+
+    def test_cluster_errors(self):
+        for args in [["--cluster-peer=b"],
+                     ["--cluster-peer=b=tcp:host-b:4100"],
+                     ["--cluster-node=a"],
+                     ["--cluster-node=a", "--cluster-listen=tcp:4100",
+                      "--cluster-peer=a=tcp:host-a:4100"],
+                     ["--cluster-node=a", "--cluster-listen=tcp:4100",
+                      "--workers=2"],
+                     ]:
+            o = server_tap.Options()
+            with self.assertRaises(UsageError):
+                o.parseOptions(args)
+
+    def test_handoff(self):
+        o = server_tap.Options()
+        o.parseOptions(["--handoff-socket=/run/mailbox/handoff",
+                        "--handoff-drain=60"])
+        self.assertEqual(o, dict(DEFAULTS, **{
+            "handoff-socket": "/run/mailbox/handoff",
+            "handoff-drain": 60.0}))
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--handoff-socket=handoff", "--workers=2",
+                            "--port=tcp:4000"])
+
+    def test_broker(self):
+        o = server_tap.Options()
+        o.parseOptions(["--broker=/run/mailbox/broker.sock"])
+        self.assertEqual(o, dict(DEFAULTS, broker="/run/mailbox/broker.sock"))
+        for args in [["--workers=2"],
+                     ["--handoff-socket=handoff"],
+                     ["--cluster-node=a", "--cluster-listen=tcp:4100",
+                      "--cluster-peer=b=tcp:host-b:4100"],
+                     ]:
+            o = server_tap.Options()
+            with self.assertRaises(UsageError):
+                o.parseOptions(["--broker=broker.sock"] + args)
+
+    def test_snapshot(self):
+        o = server_tap.Options()
+        o.parseOptions(["--snapshot-dir=/var/lib/wormhole/snapshots",
+                        "--snapshot-interval=10"])
+        self.assertEqual(o, dict(DEFAULTS, **{
+            "snapshot-dir": "/var/lib/wormhole/snapshots",
+            "snapshot-interval": 10.0}))
+        for args in [["--snapshot-dir=snapshots", "--snapshot-interval=0"],
+                     ["--snapshot-dir=."],
+                     ["--snapshot-dir=/var/lib/wormhole",
+                      "--usage-db=/var/lib/wormhole/usage.sqlite"],
+                     ]:
+            o = server_tap.Options()
+            with self.assertRaises(UsageError):
+                o.parseOptions(args)
+
     def test_string(self):
         o = server_tap.Options()
         s = str(o)
@@ -213,3 +345,13 @@ class Config(unittest.TestCase):
         self.assertIn("--blur-usage=", s)
         self.assertIn("round logged access times to improve privacy", s)
 
+    def test_drain(self):
+        o = server_tap.Options()
+        o.parseOptions(["--drain-signals",
+                        "--drain-redirect=ws://other.example.com/v1"])
+        self.assertEqual(o, dict(DEFAULTS, **{
+            "drain-signals": 1,
+            "drain-redirect": "ws://other.example.com/v1"}))
+        o = server_tap.Options()
+        with self.assertRaises(UsageError):
+            o.parseOptions(["--drain-redirect=ws://other.example.com/v1"])
@@ -1,6 +1,7 @@
 from twisted.trial import unittest
 from ..database import create_channel_db
 from ..connections import ConnectionTable
+from ..sqlite_storage import SQLiteChannelStore
 
 def get_messages(db, id):
     #print(list(db.execute("SELECT * FROM `connection_messages`").fetchall()))
@@ -12,7 +13,7 @@ def get_messages(db, id):
 class ConnectionDB(unittest.TestCase):
     def test_connection_table(self):
         db = create_channel_db(":memory:")
-        c = ConnectionTable(db)
+        c = ConnectionTable(SQLiteChannelStore([db]))
 
         c.clear()
         rows = list(db.execute("SELECT * FROM connections").fetchall())
@@ -84,7 +85,7 @@ class ConnectionDB(unittest.TestCase):
 
     def test_clear(self):
         db = create_channel_db(":memory:")
-        c = ConnectionTable(db)
+        c = ConnectionTable(SQLiteChannelStore([db]))
 
         c.clear()
         rows = list(db.execute("SELECT * FROM connections").fetchall())
@@ -90,6 +90,42 @@ class Get(unittest.TestCase):
         # debug with "diff -u _trial_temp/up.sql _trial_temp/new.sql"
         self.assertEqual(dbA_text, latest_text)
 
+    def test_upgrade_channel(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "upgrade.db")
+        self.assertNotEqual(CHANNELDB_TARGET_VERSION, 2)
+
+        # create a v2 DB (the oldest one with an upgrader) with messages
+        db = _get_db(fn, "channel", 2)
+        for (body, server_rx) in [("b1", 5), ("b2", 1), ("b3", 3)]:
+            db.execute("INSERT INTO `messages`"
+                       " (`app_id`, `mailbox_id`, `side`, `phase`, `body`,"
+                       "  `server_rx`, `msg_id`)"
+                       " VALUES ('appid','mid','side','phase',?,?,'msgid')",
+                       (body, server_rx))
+        db.commit()
+        del db
+
+        dbA = _get_db(fn, "channel", CHANNELDB_TARGET_VERSION)
+        rows = dbA.execute("SELECT * FROM version").fetchall()
+        self.assertEqual(rows[0]["version"], CHANNELDB_TARGET_VERSION)
+        # existing messages get ids in their original insertion order
+        rows = dbA.execute("SELECT * FROM `messages`"
+                           " ORDER BY `id`").fetchall()
+        self.assertEqual([(row["id"], row["body"]) for row in rows],
+                         [(1, "b1"), (2, "b2"), (3, "b3")])
+
+        # the rebuilt table should match that of a new DB (the `version`
+        # table's comment differs, so we can't compare the whole dump)
+        def schema(db):
+            return db.execute("SELECT `type`, `name`, `sql`"
+                              " FROM `sqlite_master`"
+                              " WHERE `tbl_name`='messages'"
+                              " ORDER BY `name`").fetchall()
+        latest_db = _get_db(":memory:", "channel", CHANNELDB_TARGET_VERSION)
+        self.assertEqual(schema(dbA), schema(latest_db))
+
     def test_upgrade_fails(self):
         basedir = self.mktemp()
         os.mkdir(basedir)
@@ -0,0 +1,76 @@
+import signal
+from unittest import mock
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.python import log
+from ..database import create_channel_db
+from ..server import make_server
+from ..drain import DrainService
+
+class FakeReactor(Clock):
+    def callFromThread(self, f, *args):
+        f(*args)
+
+class Drain(unittest.TestCase):
+    def setUp(self):
+        self.server = make_server(create_channel_db(":memory:"))
+        self.clock = FakeReactor()
+        self.logged = []
+        observer = lambda event: self.logged.append(log.textFromEventDict(event))
+        log.addObserver(observer)
+        self.addCleanup(log.removeObserver, observer)
+
+    def default_handlers(self):
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            self.addCleanup(signal.signal, signum,
+                            signal.signal(signum, signal.SIG_DFL))
+
+    def test_signals(self):
+        self.default_handlers()
+        forward = mock.Mock()
+        d = DrainService(self.server, forward=forward, interval=1.0,
+                         reactor=self.clock)
+        old = signal.getsignal(signal.SIGUSR1)
+        d.startService()
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), d._signalled)
+        signal.getsignal(signal.SIGUSR1)(signal.SIGUSR1, None)
+        self.assertTrue(self.server.is_draining())
+        signal.getsignal(signal.SIGUSR2)(signal.SIGUSR2, None)
+        self.assertFalse(self.server.is_draining())
+        self.assertEqual(forward.mock_calls, [mock.call(signal.SIGUSR1),
+                                              mock.call(signal.SIGUSR2)])
+        d.stopService()
+        self.assertEqual(signal.getsignal(signal.SIGUSR1), old)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_existing_handler(self):
+        # twistd rotates its log on SIGUSR1, which must keep working
+        self.default_handlers()
+        rotate = lambda signum, frame: None
+        signal.signal(signal.SIGUSR1, rotate)
+        d = DrainService(self.server, interval=1.0, reactor=self.clock)
+        d.startService()
+        self.assertIs(signal.getsignal(signal.SIGUSR1), rotate)
+        self.assertEqual(signal.getsignal(signal.SIGUSR2), signal.SIG_DFL)
+        self.assertIn("SIGUSR1 is already handled (twistd log rotation?),"
+                      " so draining cannot be started by signal", self.logged)
+        d.stopService()
+        self.assertIs(signal.getsignal(signal.SIGUSR1), rotate)
+
+    def test_report(self):
+        d = DrainService(self.server, interval=1.0, reactor=self.clock)
+        app = self.server.get_app("appid")
+        mb = app.open_mailbox("mid", "side1", 0)
+        mb.add_listener("handle", lambda sm: None, lambda: None)
+        d.start_draining()
+        self.assertIn("draining: 1 live mailboxes left", self.logged)
+        self.clock.advance(1.0)
+        self.assertEqual(self.logged.count("draining: 1 live mailboxes left"),
+                         1)
+        mb.remove_listener("handle")
+        self.clock.advance(1.0)
+        self.assertIn("drained: no live mailboxes left, ready to restart",
+                      self.logged)
+        d.stop_draining()
+        self.assertFalse(self.server.is_draining())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
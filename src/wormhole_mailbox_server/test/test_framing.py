@@ -0,0 +1,62 @@
+import json
+from twisted.trial import unittest
+from ..framing import (JSON, FRAMINGS, SPLICE_MIN, FrameError, json_dumps,
+                       choose_framing)
+from ..util import dict_to_bytes
+
+class Splice(unittest.TestCase):
+    def test_small(self):
+        d = {"type": "message", "body": "00ff"}
+        self.assertEqual(json_dumps(d), dict_to_bytes(d))
+
+    def test_spliced(self):
+        body = "00ff" * SPLICE_MIN
+        d = {"type": "message", "side": "side", "body": body, "seq": 1}
+        encoded = json_dumps(d)
+        self.assertTrue(encoded.endswith(b'"body": "' + body.encode() + b'"}'))
+        self.assertEqual(json.loads(encoded.decode("utf-8")), d)
+        self.assertEqual(JSON.decode(JSON.encode(d)), d)
+        # the input is not modified
+        self.assertEqual(d["body"], body)
+        # a body-only message still makes a valid object
+        self.assertEqual(json.loads(json_dumps({"body": body})),
+                         {"body": body})
+
+    def test_not_hex(self):
+        # anything which might need escaping takes the normal path
+        for body in ['"' * SPLICE_MIN, "é" * SPLICE_MIN,
+                     "x" * SPLICE_MIN, "0\n" * SPLICE_MIN]:
+            d = {"type": "message", "body": body}
+            self.assertEqual(json_dumps(d), dict_to_bytes(d))
+            self.assertEqual(json.loads(json_dumps(d)), d)
+
+    def test_choose(self):
+        self.assertIs(choose_framing([]), JSON)
+        self.assertIs(choose_framing(["unknown"]), JSON)
+
+class Decode(unittest.TestCase):
+    def assertRejected(self, framing, payload, reason):
+        with self.assertRaises(FrameError) as cm:
+            framing.decode(payload)
+        self.assertEqual(cm.exception.reason, reason)
+
+    def test_json(self):
+        self.assertEqual(JSON.decode(b' {"type": "ping"}\n'), {"type": "ping"})
+        self.assertEqual(JSON.decode(b'\r\n\t{"type": "ping"}\t\r\n'),
+                         {"type": "ping"})
+        for payload in [b"", b"  ", b"garbage", b"[1]", b'"{}"', b"{",
+                        b" { ", b"}", b"\x00{}"]:
+            self.assertRejected(JSON, payload, "not_object")
+        for payload in [b"{nope}", b"{}garbage}", b'{"a": \xff}']:
+            self.assertRejected(JSON, payload, "malformed")
+
+    def test_binary(self):
+        if not FRAMINGS:
+            raise unittest.SkipTest("neither cbor2 nor msgpack is installed")
+        for framing in FRAMINGS.values():
+            d = {"type": "ping", "ping": 1}
+            self.assertEqual(framing.decode(framing.encode(d)), d)
+            for payload in [b"", b"\x01", b'{"type": "ping"}',
+                            framing.encode(d)[:1] + b"\x00"]:
+                with self.assertRaises(FrameError):
+                    framing.decode(payload)
@@ -0,0 +1,144 @@
+import os
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+from ..database import create_or_upgrade_channel_db
+from ..server import make_server, SidedMessage
+from .common import free_port, ServerProcess, wait_for_port
+from .ws_client import WSFactory
+
+class Sharing(unittest.TestCase):
+    # two servers using the same channel DB, as during a handoff
+    def setUp(self):
+        dbfile = os.path.join(self.mktemp() + ".sqlite")
+        os.makedirs(os.path.dirname(dbfile), exist_ok=True)
+        self.old = make_server(create_or_upgrade_channel_db(dbfile))
+        self.new = make_server(create_or_upgrade_channel_db(dbfile))
+
+    def test_catch_up(self):
+        old_mb = self.old.get_app("appid").open_mailbox("mid", "side1", 1)
+        old_mb.add_message(SidedMessage("side1", "pake", "aa", 1, None))
+        old_got = []
+        old_mb.add_listener("h1", old_got.append, lambda: None)
+        self.old.set_sharing(True)
+        self.new.set_sharing(True)
+
+        new_mb = self.new.get_app("appid").open_mailbox("mid", "side2", 2)
+        new_got = []
+        replay = new_mb.add_listener("h2", new_got.append, lambda: None)
+        self.assertEqual([sm.body for sm in replay], ["aa"])
+
+        new_mb.add_message(SidedMessage("side2", "pake", "bb", 2, None))
+        self.assertEqual([sm.body for sm in new_got], ["bb"])
+        self.assertEqual(old_got, [])
+        self.old.poll_shared_mailboxes()
+        self.assertEqual([sm.body for sm in old_got], ["bb"])
+        self.old.poll_shared_mailboxes() # nothing new
+        self.assertEqual([sm.body for sm in old_got], ["bb"])
+
+        old_mb.add_message(SidedMessage("side1", "version", "cc", 3, None))
+        self.new.poll_shared_mailboxes()
+        self.assertEqual([sm.body for sm in old_got], ["bb", "cc"])
+        self.assertEqual([sm.body for sm in new_got], ["bb", "cc"])
+        self.new.poll_shared_mailboxes()
+        self.old.poll_shared_mailboxes()
+        self.assertEqual([sm.body for sm in old_got], ["bb", "cc"])
+        self.assertEqual([sm.body for sm in new_got], ["bb", "cc"])
+
+    def test_not_sharing(self):
+        old_mb = self.old.get_app("appid").open_mailbox("mid", "side1", 1)
+        old_got = []
+        old_mb.add_listener("h1", old_got.append, lambda: None)
+        new_mb = self.new.get_app("appid").open_mailbox("mid", "side2", 2)
+        new_mb.add_message(SidedMessage("side2", "pake", "bb", 2, None))
+        # polling is only done during a handoff
+        self.assertEqual(self.old.get_app("appid").is_sharing(), False)
+        self.assertEqual(old_got, [])
+
+
+class Handoff(unittest.TestCase):
+    # real server processes, replacing each other
+    timeout = 60
+
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        os.mkdir(self.basedir)
+        self.port = free_port()
+        self.processes = []
+        self._clients = []
+
+    @inlineCallbacks
+    def tearDown(self):
+        for c in self._clients:
+            c.transport.loseConnection()
+        yield defer.DeferredList([p.stop() for p in self.processes])
+
+    def start(self, motd):
+        p = ServerProcess(["--port=tcp:%d:interface=127.0.0.1" % self.port,
+                           "--handoff-socket=handoff",
+                           "--handoff-drain=30",
+                           "--motd=%s" % motd], self.basedir)
+        self.processes.append(p)
+        return p
+
+    @inlineCallbacks
+    def make_client(self):
+        f = WSFactory("ws://127.0.0.1:%d/v1" % self.port)
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", self.port, f)
+        c = yield f.d
+        self._clients.append(c)
+        welcome = yield c.next_non_ack()
+        return (c, welcome["welcome"].get("motd"))
+
+    @inlineCallbacks
+    def test_handoff(self):
+        old = self.start("old")
+        yield wait_for_port(self.port)
+        (c1, motd) = yield self.make_client()
+        self.assertEqual(motd, "old")
+        c1.send("bind", appid="appid", side="side1")
+        c1.send("claim-open", nameplate="1")
+        c1.send("add", phase="pake", body="aa")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "claimed")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["body"], "aa")
+
+        self.start("new")
+        # the port never stops accepting: connections reach the old server
+        # until the new one has taken it over
+        while True:
+            (c2, motd) = yield self.make_client()
+            if motd == "new":
+                break
+            self.assertEqual(motd, "old")
+            c2.transport.loseConnection()
+            yield deferLater(reactor, 0.2)
+
+        # the old server still serves c1, and the two share the mailbox
+        c2.send("bind", appid="appid", side="side2")
+        c2.send("claim-open", nameplate="1")
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["type"], "claimed")
+        m = yield c2.next_non_ack()
+        self.assertEqual((m["side"], m["body"]), ("side1", "aa"))
+        c2.send("add", phase="pake", body="bb")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["side"], m["body"]), ("side2", "bb"))
+        c1.send("add", phase="version", body="cc")
+        m = yield c2.next_non_ack()
+        while m["side"] != "side1": # our own echo
+            m = yield c2.next_non_ack()
+        self.assertEqual(m["body"], "cc")
+
+        # once its last client leaves, the old server exits
+        c1.send("release")
+        c1.send("close", mood="happy")
+        while (yield c1.next_non_ack())["type"] != "closed":
+            pass
+        c1.transport.loseConnection()
+        yield old.ended
+        (c3, motd) = yield self.make_client()
+        self.assertEqual(motd, "new")
@@ -0,0 +1,36 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from ..overload import OverloadGovernor
+
+class Governor(unittest.TestCase):
+    def test_lag(self):
+        clock = Clock()
+        g = OverloadGovernor(max_lag=2.0, interval=1.0, reactor=clock)
+        g.startService()
+        self.assertEqual(g.check(1), None)
+        clock.advance(1.0)
+        self.assertEqual(g.lag, 0.0)
+        # the reactor was busy: the timer fires 3s late
+        clock.advance(4.0)
+        self.assertEqual(g.lag, 3.0)
+        self.assertEqual(g.check(1), "lag")
+        self.assertEqual(g.shed, {"lag": 1, "connections": 0})
+        # and recovers once the reactor catches up
+        clock.advance(1.0)
+        self.assertEqual(g.lag, 0.0)
+        self.assertEqual(g.check(1), None)
+        g.stopService()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_connections(self):
+        g = OverloadGovernor(max_connections=2, reactor=Clock())
+        self.assertEqual(g.check(1), None)
+        self.assertEqual(g.check(2), None)
+        self.assertEqual(g.check(3), "connections")
+        self.assertEqual(g.shed, {"lag": 0, "connections": 1})
+
+    def test_unlimited(self):
+        g = OverloadGovernor(reactor=Clock())
+        g.lag = 100.0
+        self.assertEqual(g.check(100000), None)
+        self.assertEqual(g.shed, {"lag": 0, "connections": 0})
@@ -0,0 +1,101 @@
+from twisted.trial import unittest
+from ..rate_limit import RateLimiter, AppRateLimiter, parse_rate_limit
+
+A1 = ("addrid", 1, 1)
+A2 = ("addrid", 1, 2)
+S1 = ("side", "appid", "side1")
+
+class Parse(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_rate_limit("add:10:50"), ("add", 10.0, 50.0))
+        self.assertEqual(parse_rate_limit("list:0.5"), ("list", 0.5, 1.0))
+        self.assertEqual(parse_rate_limit("mailbox:4"), ("mailbox", 4.0, 4.0))
+
+    def test_errors(self):
+        self.assertRaises(ValueError, parse_rate_limit, "add")
+        self.assertRaises(ValueError, parse_rate_limit, "add:1:2:3")
+        self.assertRaises(ValueError, parse_rate_limit, "bind:1")
+        self.assertRaises(ValueError, parse_rate_limit, "add:-1")
+        self.assertRaises(ValueError, parse_rate_limit, "add:1:0.5")
+
+class Buckets(unittest.TestCase):
+    def test_burst_then_refill(self):
+        rl = RateLimiter([("add", 1.0, 3.0)])
+        for i in range(3):
+            self.assertTrue(rl.allow([A1], "add", 10))
+        self.assertFalse(rl.allow([A1], "add", 10))
+        self.assertEqual(rl.rejected, 1)
+        # other addresses have their own bucket
+        self.assertTrue(rl.allow([A2], "add", 10))
+        # one token comes back each second
+        self.assertTrue(rl.allow([A1], "add", 11))
+        self.assertFalse(rl.allow([A1], "add", 11))
+        self.assertEqual(rl.rejected, 2)
+
+    def test_unlimited_classes(self):
+        rl = RateLimiter([("add", 1.0, 1.0)])
+        for i in range(10):
+            self.assertTrue(rl.allow([A1], "list", 10))
+            self.assertTrue(rl.allow([A1], "bind", 10))
+            self.assertTrue(rl.allow([A1], "ping", 10))
+        self.assertEqual(rl.count_buckets(), 0)
+
+    def test_command_classes(self):
+        rl = RateLimiter([("nameplate", 1.0, 2.0)])
+        self.assertTrue(rl.allow([A1], "allocate", 10))
+        self.assertTrue(rl.allow([A1], "claim", 10))
+        self.assertFalse(rl.allow([A1], "release", 10))
+
+    def test_multiple_keys(self):
+        rl = RateLimiter([("add", 1.0, 2.0)])
+        self.assertTrue(rl.allow([A1, S1], "add", 10))
+        self.assertTrue(rl.allow([A2, S1], "add", 10))
+        # the side bucket is empty, even though A1 has a token left
+        self.assertFalse(rl.allow([A1, S1], "add", 10))
+        # and the rejection did not charge A1's bucket
+        self.assertTrue(rl.allow([A1], "add", 10))
+        # unbound connections have no side key
+        self.assertFalse(rl.allow([A1, None], "add", 10))
+
+    def test_prune(self):
+        rl = RateLimiter([("add", 1.0, 2.0)])
+        rl.allow([A1], "add", 10)
+        rl.allow([A1], "add", 10)
+        rl.allow([A2], "add", 10)
+        self.assertEqual(rl.count_buckets(), 2)
+        rl.prune(10.5)
+        self.assertEqual(rl.count_buckets(), 2)
+        # A2 has refilled, A1 has not
+        rl.prune(11)
+        self.assertEqual(rl.count_buckets(), 1)
+        rl.prune(12)
+        self.assertEqual(rl.count_buckets(), 0)
+
+    def test_new_generation(self):
+        rl = RateLimiter([("add", 1.0, 1.0)])
+        self.assertTrue(rl.allow([A1], "add", 10))
+        self.assertFalse(rl.allow([A1], "add", 10))
+        rl.new_generation()
+        self.assertEqual(rl.count_buckets(), 0)
+        self.assertTrue(rl.allow([A1], "add", 10))
+
+class AppBuckets(unittest.TestCase):
+    def test_apps(self):
+        rl = AppRateLimiter()
+        for i in range(2):
+            self.assertTrue(rl.allow("app1", 2.0, 10))
+        self.assertFalse(rl.allow("app1", 2.0, 10))
+        self.assertTrue(rl.allow("app2", 2.0, 10))
+        self.assertTrue(rl.allow("app1", 2.0, 10.5))
+        self.assertEqual(rl.rejected, {"app1": 1})
+        # slow apps still get one command at a time
+        self.assertTrue(rl.allow("app3", 0.5, 10))
+        self.assertFalse(rl.allow("app3", 0.5, 11))
+        self.assertTrue(rl.allow("app3", 0.5, 12))
+
+    def test_prune(self):
+        rl = AppRateLimiter()
+        rl.allow("app1", 1.0, 10)
+        rl.allow("app2", 1.0, 15)
+        rl.prune(15)
+        self.assertEqual(list(rl._buckets), ["app2"])
@@ -0,0 +1,283 @@
+import os
+from collections import Counter
+from twisted.trial import unittest
+from twisted.internet import reactor, endpoints, defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+from ..database import create_channel_db
+from ..server import make_server
+from ..web import make_web_server
+from ..routing import HashRing, Router
+from .ws_client import WSFactory
+from .common import free_port, ServerProcess, wait_for_port
+
+class Ring(unittest.TestCase):
+    def test_balanced(self):
+        nodes = ["a", "b", "c", "d"]
+        ring = HashRing(nodes)
+        owners = Counter(ring.owner("key%d" % i) for i in range(4000))
+        self.assertEqual(set(owners), set(nodes))
+        for node in nodes:
+            self.assertGreater(owners[node], 600) # 1000 would be perfect
+
+    def test_consistent(self):
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+        moved = 0
+        for i in range(3000):
+            key = "key%d" % i
+            if before.owner(key) != after.owner(key):
+                # only to the new node
+                self.assertEqual(after.owner(key), "d")
+                moved += 1
+        self.assertLess(moved, 1200) # 750 would be perfect
+
+class Ownership(unittest.TestCase):
+    def test_allocate(self):
+        router = Router("a", {"b": "unix:path=unused"}, reactor)
+        s = make_server(create_channel_db(":memory:"), router=router)
+        app = s.get_app("appid")
+        for i in range(20):
+            name = app.allocate_nameplate("side%d" % i, 0)
+            self.assertTrue(router.owns_nameplate("appid", name), name)
+            mailbox_id = app.claim_nameplate(name, "side%d" % i, 0)
+            self.assertTrue(router.owns_mailbox(mailbox_id))
+
+
+class Node(object):
+    def __init__(self, name, sockdir, peers):
+        self.name = name
+        self.internal = os.path.join(sockdir, name + ".sock")
+        self.router = Router(name, {peer: "unix:path=" + os.path.join(
+            sockdir, peer + ".sock") for peer in peers}, reactor)
+        self.server = make_server(create_channel_db(":memory:"),
+                                  router=self.router)
+        self.public_site = make_web_server(self.server, False,
+                                           router=self.router)
+        self.internal_site = make_web_server(self.server, False)
+
+    @inlineCallbacks
+    def listen(self):
+        ep = endpoints.TCP4ServerEndpoint(reactor, 0, interface="127.0.0.1")
+        self.public = yield ep.listen(self.public_site)
+        self.port = self.public.getHost().port
+        ep = endpoints.UNIXServerEndpoint(reactor, self.internal)
+        self.internal_lp = yield ep.listen(self.internal_site)
+
+    @inlineCallbacks
+    def stop(self):
+        for site in [self.public_site, self.internal_site]:
+            while site.ws_factory.getConnectionCount():
+                yield deferLater(reactor, 0.0)
+        yield self.public.stopListening()
+        if self.internal_lp:
+            yield self.internal_lp.stopListening()
+
+class Routed(unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        sockdir = self.mktemp()
+        os.mkdir(sockdir)
+        self.a = Node("a", sockdir, ["b"])
+        self.b = Node("b", sockdir, ["a"])
+        yield self.a.listen()
+        yield self.b.listen()
+        self._clients = []
+
+    @inlineCallbacks
+    def tearDown(self):
+        for c in self._clients:
+            c.transport.loseConnection()
+        yield self.a.stop()
+        yield self.b.stop()
+
+    @inlineCallbacks
+    def make_client(self, node):
+        f = WSFactory("ws://127.0.0.1:%d/v1" % node.port)
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", node.port, f)
+        c = yield f.d
+        self._clients.append(c)
+        yield c.next_non_ack() # welcome
+        return c
+
+    @inlineCallbacks
+    def test_forwarded(self):
+        # a nameplate owned by node b, reached from a client of node a
+        name = next(n for n in map(str, range(1, 100))
+                    if self.a.router.owner_of_nameplate("appid", n) == "b")
+        c1 = yield self.make_client(self.a)
+        c1.send("bind", appid="appid", side="side1")
+        c1.send("claim", nameplate=name)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "claimed")
+        mailbox_id = m["mailbox"]
+        self.assertEqual(self.a.router.owner_of_mailbox(mailbox_id),
+                         "b")
+        # the state is all on b
+        self.assertEqual(self.b.server.get_app("appid").get_nameplate_ids(),
+                         {name})
+        self.assertEqual(self.a.server.get_app("appid").get_nameplate_ids(),
+                         set())
+        c1.send("open", mailbox=mailbox_id)
+        c1.send("add", phase="pake", body="aa", id="1")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["side"], m["body"]),
+                         ("message", "side1", "aa"))
+
+        # a client of node b sees the same nameplate and mailbox
+        c2 = yield self.make_client(self.b)
+        c2.send("bind", appid="appid", side="side2")
+        c2.send("claim-open", nameplate=name)
+        m = yield c2.next_non_ack()
+        self.assertEqual(m, dict(m, type="claimed", mailbox=mailbox_id))
+        m = yield c2.next_non_ack()
+        self.assertEqual((m["type"], m["body"]), ("message", "aa"))
+        c2.send("add", phase="pake", body="bb", id="2")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["side"], m["body"]),
+                         ("message", "side2", "bb"))
+
+        # forwarded commands are acked exactly once, by the owner
+        c1.send("add", phase="version", body="cc", id="3")
+        m = yield c1.next_event()
+        self.assertEqual((m["type"], m["id"]), ("ack", "3"))
+        m = yield c1.next_event()
+        self.assertEqual((m["type"], m["body"]), ("message", "cc"))
+        yield c1.sync()
+        acks = [e for e in c1.events if e["type"] == "ack"]
+        self.assertEqual([a["id"] for a in acks], [None]) # just the ping
+        self.assertEqual(c1.errors, [])
+        c1.events = []
+
+        # "list" gathers nameplates from every node
+        c3 = yield self.make_client(self.a)
+        c3.send("bind", appid="appid", side="side3")
+        c3.send("allocate")
+        m = yield c3.next_non_ack()
+        allocated = m["nameplate"]
+        self.assertEqual(self.a.router.owner_of_nameplate("appid", allocated),
+                         "a")
+        c3.send("list")
+        m = yield c3.next_non_ack()
+        self.assertEqual(m["type"], "nameplates")
+        self.assertEqual(sorted(n["id"] for n in m["nameplates"]),
+                         sorted([name, allocated]))
+
+        # release and close without naming them go to the same owner
+        c1.send("release")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "released")
+        c1.send("close", mood="happy")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "closed")
+
+    @inlineCallbacks
+    def test_lost_link(self):
+        name = next(n for n in map(str, range(1, 100))
+                    if self.a.router.owner_of_nameplate("appid", n) == "b")
+        c1 = yield self.make_client(self.a)
+        c1.send("bind", appid="appid", side="side1")
+        c1.send("claim", nameplate=name)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "claimed")
+
+        # if node b can't be reached, the client is disconnected, so it
+        # will reconnect and start over
+        yield self.b.internal_lp.stopListening()
+        self.b.internal_lp = None
+        c2 = yield self.make_client(self.a)
+        c2.send("bind", appid="appid", side="side2")
+        c2.send("claim", nameplate=name)
+        while True:
+            ev = yield c2.next_event()
+            if isinstance(ev, tuple):
+                break
+        (wasClean, code, reason) = ev
+        self.assertEqual(reason, "lost connection to another server")
+        # other clients are unaffected
+        c1.send("release")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "released")
+
+
+class Cluster(unittest.TestCase):
+    # three real server processes on loopback, configured as a cluster
+    timeout = 60
+
+    @inlineCallbacks
+    def setUp(self):
+        self.basedir = os.path.abspath(self.mktemp())
+        os.mkdir(self.basedir)
+        names = ["a", "b", "c"]
+        self.ports = {name: free_port() for name in names}
+        internal = {name: free_port() for name in names}
+        self.router = Router("a", {"b": "unused", "c": "unused"}, reactor)
+        self.processes = []
+        for name in names:
+            args = ["--port=tcp:%d:interface=127.0.0.1" % self.ports[name],
+                    "--channel-db=%s.sqlite" % name,
+                    "--cluster-node=%s" % name,
+                    "--cluster-listen=tcp:%d:interface=127.0.0.1"
+                    % internal[name]]
+            args.extend("--cluster-peer=%s=tcp:127.0.0.1:%d"
+                        % (peer, internal[peer])
+                        for peer in names if peer != name)
+            self.processes.append(ServerProcess(args, self.basedir))
+        for port in list(self.ports.values()) + list(internal.values()):
+            yield wait_for_port(port)
+        self._clients = []
+
+    @inlineCallbacks
+    def tearDown(self):
+        for c in self._clients:
+            c.transport.loseConnection()
+        yield defer.DeferredList([p.stop() for p in self.processes])
+
+    @inlineCallbacks
+    def make_client(self, name):
+        port = self.ports[name]
+        f = WSFactory("ws://127.0.0.1:%d/v1" % port)
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", port, f)
+        c = yield f.d
+        self._clients.append(c)
+        yield c.next_non_ack() # welcome
+        return c
+
+    @inlineCallbacks
+    def test_wormhole(self):
+        # a nameplate owned by node c, used by clients of nodes a and b
+        name = next(n for n in map(str, range(1, 100))
+                    if self.router.owner_of_nameplate("appid", n) == "c")
+        c1 = yield self.make_client("a")
+        c1.send("bind", appid="appid", side="side1")
+        c1.send("claim-open", nameplate=name)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "claimed")
+        self.assertEqual(self.router.owner_of_mailbox(m["mailbox"]), "c")
+        c1.send("add", phase="pake", body="aa")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["body"]), ("message", "aa"))
+
+        c2 = yield self.make_client("b")
+        c2.send("bind", appid="appid", side="side2")
+        c2.send("list")
+        m = yield c2.next_non_ack()
+        self.assertEqual([n["id"] for n in m["nameplates"]], [name])
+        c2.send("claim-open", nameplate=name)
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["type"], "claimed")
+        m = yield c2.next_non_ack()
+        self.assertEqual((m["type"], m["side"], m["body"]),
+                         ("message", "side1", "aa"))
+        c2.send("add", phase="pake", body="bb")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["side"], m["body"]),
+                         ("message", "side2", "bb"))
+
+        for c in [c1, c2]:
+            c.send("release")
+            c.send("close", mood="happy")
+            while (yield c.next_non_ack())["type"] != "closed":
+                pass
@@ -3,8 +3,11 @@ from twisted.trial import unittest
 from twisted.python import log
 from .common import ServerBase, _Util
 from ..server import (make_server, Usage,
-                      SidedMessage, CrowdedError, AppNamespace)
-from ..database import create_channel_db, create_usage_db
+                      SidedMessage, CrowdedError, AppNamespace,
+                      PRUNE_BATCH)
+from ..database import create_channel_db, create_usage_db, create_addrid_db
+from ..sqlite_storage import SQLiteChannelStore
+from ..limits import Limits, QuotaError
 
 npid = "1"
 
@@ -91,6 +94,11 @@ class Server(_Util, ServerBase, unittest.TestCase):
         self.assertIn(("side2", 3),
                       [(row["side"], row["added"]) for row in side_rows])
 
+        # claim_and_open() also returns the Mailbox, already opened
+        mailbox_id4, mailbox = app.claim_and_open(name, "side2", 3)
+        self.assertEqual(mailbox_id, mailbox_id4)
+        self.assertIs(mailbox, app.open_mailbox(mailbox_id, "side2", 3))
+
         # a third claim marks the nameplate as "crowded", and adds a third
         # claim (which must be released later), but leaves the two existing
         # claims alone
@@ -261,13 +269,88 @@ class Server(_Util, ServerBase, unittest.TestCase):
         self.assertEqual(stop1, [])
         self.assertEqual(stop2, [True])
 
-        # message adds are not idempotent: clients filter duplicates
-        m1.add_message(SidedMessage(side="side1", phase="phase",
-                                    body="body", server_rx=1,
-                                    msg_id="msgid"))
+        # re-adding a message with the same side, phase, and msg_id is
+        # ignored
+        added = m1.add_message(SidedMessage(side="side1", phase="phase",
+                                            body="body", server_rx=2,
+                                            msg_id="msgid"))
+        self.assertFalse(added)
+        msgs = self._messages(app)
+        self.assertEqual(len(msgs), 4)
+        # but any difference makes it a new message
+        for sm in [SidedMessage(side="side2", phase="phase",
+                                body="body", server_rx=2, msg_id="msgid"),
+                   SidedMessage(side="side1", phase="phase5",
+                                body="body", server_rx=2, msg_id="msgid"),
+                   SidedMessage(side="side1", phase="phase",
+                                body="body", server_rx=2, msg_id="msgid2")]:
+            self.assertTrue(m1.add_message(sm))
         msgs = self._messages(app)
-        self.assertEqual(len(msgs), 5)
+        self.assertEqual(len(msgs), 7)
         self.assertEqual(msgs[-1]["body"], "body")
+        # messages without a msg_id are never de-duplicated
+        for i in range(2):
+            self.assertTrue(m1.add_message(SidedMessage(
+                side="side1", phase="phase", body="body", server_rx=2,
+                msg_id=None)))
+        self.assertEqual(len(self._messages(app)), 9)
+
+    def test_messages_since(self):
+        app = self._server.get_app("appid")
+        m1 = app.open_mailbox("mid", "side1", 0)
+        l1 = []
+        m1.add_listener("handle1", l1.append, lambda: None)
+        for i in range(3):
+            m1.add_message(SidedMessage(side="side1", phase="phase%d" % i,
+                                        body="body%d" % i, server_rx=1,
+                                        msg_id="msgid"))
+        # broadcast messages carry the seq assigned by the DB
+        seqs = [sm.seq for sm in l1]
+        self.assertEqual(seqs, sorted(seqs))
+        self.assertEqual(len(set(seqs)), 3)
+        # a mailbox with other traffic in between doesn't confuse the cursor
+        m2 = app.open_mailbox("mid2", "side1", 0)
+        m2.add_message(SidedMessage(side="side1", phase="phase",
+                                    body="other", server_rx=1,
+                                    msg_id="msgid"))
+
+        self.assertEqual(m1.get_messages(), l1)
+        self.assertEqual(m1.get_messages(since=seqs[0]), l1[1:])
+        self.assertEqual(m1.get_messages(since=seqs[2]), [])
+        old = m1.add_listener("handle2", None, None, since=seqs[1])
+        self.assertEqual([sm.body for sm in old], ["body2"])
+
+    def test_presence(self):
+        app = self._server.get_app("appid")
+        m1 = app.open_mailbox("mid", "side1", 0)
+        events = []
+        m1.add_listener("handle1", None, lambda: None,
+                        presence_f=lambda side, event:
+                        events.append((side, event)))
+        m1.add_listener("handle2", None, lambda: None) # doesn't care
+        self.assertEqual(m1.get_open_sides(), {"side1"})
+
+        # re-opening by a side which is already there is not news
+        app.open_mailbox("mid", "side1", 1)
+        self.assertEqual(events, [])
+        app.open_mailbox("mid", "side2", 2)
+        self.assertEqual(events, [("side2", "opened")])
+        app.open_mailbox("mid", "side2", 3)
+        self.assertEqual(m1.get_open_sides(), {"side1", "side2"})
+        self.assertEqual(len(events), 1)
+
+        # a third side is crowded out, but listeners still hear about it
+        with self.assertRaises(CrowdedError):
+            app.open_mailbox("mid", "side3", 4)
+        m1.close("side3", "crowded", 4)
+        self.assertEqual(events[1:], [("side3", "opened"),
+                                      ("side3", "closed")])
+
+        m1.close("side2", "happy", 5)
+        self.assertEqual(events[-1], ("side2", "closed"))
+        m1.close("side2", "happy", 6) # closing twice is only reported once
+        self.assertEqual(len(events), 4)
+        self.assertEqual(m1.get_open_sides(), {"side1"})
 
     def test_early_close(self):
         """
@@ -284,10 +367,7 @@ class Server(_Util, ServerBase, unittest.TestCase):
 class Prune(unittest.TestCase):
 
     def _get_mailbox_updated(self, app, mbox_id):
-        row = app._db.execute("SELECT * FROM `mailboxes` WHERE"
-                              " `app_id`=? AND `id`=?",
-                              (app._app_id, mbox_id)).fetchone()
-        return row["updated"]
+        return app._store.get_mailbox(app._app_id, mbox_id)["updated"]
 
     def test_update(self):
         rv = make_server(create_channel_db(":memory:"))
@@ -307,9 +387,9 @@ class Prune(unittest.TestCase):
         rv = make_server(create_channel_db(":memory:"))
         app = rv.get_app("appid")
         app.allocate_nameplate("side", 121)
-        app.prune = mock.Mock()
+        app.iterate_prune = mock.Mock(return_value=iter([]))
         rv.prune_all_apps(now=123, old=122)
-        self.assertEqual(app.prune.mock_calls, [mock.call(123, 122)])
+        self.assertEqual(app.iterate_prune.mock_calls, [mock.call(123, 122)])
 
     def test_nameplates(self):
         db = create_channel_db(":memory:")
@@ -512,13 +592,15 @@ class Summary(unittest.TestCase):
 
     def test_nameplate_disallowed(self):
         db = create_channel_db(":memory:")
-        a = AppNamespace(db, None, None, False, "some_app_id", False)
+        a = AppNamespace(SQLiteChannelStore([db]), None, None, False,
+                         "some_app_id", False)
         a.allocate_nameplate("side1", "123")
         self.assertEqual([], a.get_nameplate_ids())
 
     def test_nameplate_allowed(self):
         db = create_channel_db(":memory:")
-        a = AppNamespace(db, None, None, False, "some_app_id", True)
+        a = AppNamespace(SQLiteChannelStore([db]), None, None, False,
+                         "some_app_id", True)
         np = a.allocate_nameplate("side1", "321")
         self.assertEqual({np}, a.get_nameplate_ids())
 
@@ -651,6 +733,105 @@ class MakeServer(unittest.TestCase):
             }
         )
 
+class RateLimits(unittest.TestCase):
+    def test_no_limits(self):
+        db = create_channel_db(":memory:")
+        s = make_server(db)
+        for i in range(100):
+            self.assertTrue(s.check_rate_limit([("host", "h")], "add", 1))
+        s.prune_rate_limits(2) # ignored
+        self.assertFalse(s.get_rate_limit_close())
+
+    def test_limits(self):
+        db = create_channel_db(":memory:")
+        s = make_server(db, rate_limits=[("add", 1.0, 2.0)],
+                        rate_limit_close=True)
+        self.assertTrue(s.get_rate_limit_close())
+        self.assertTrue(s.check_rate_limit([("host", "h")], "add", 1))
+        self.assertTrue(s.check_rate_limit([("host", "h")], "add", 1))
+        self.assertFalse(s.check_rate_limit([("host", "h")], "add", 1))
+        s.prune_rate_limits(1)
+        self.assertEqual(s._rate_limiter.count_buckets(), 1)
+        s.prune_rate_limits(3)
+        self.assertEqual(s._rate_limiter.count_buckets(), 0)
+
+    def test_limits_expire_with_generation(self):
+        db = create_channel_db(":memory:")
+        addrid_db = create_addrid_db(":memory:")
+        s = make_server(db, addrid_db=addrid_db,
+                        rate_limits=[("add", 0.001, 1.0)])
+        s.check_addrid_generation(1, 100, force=True)
+        aid = ("addrid",) + s.get_address_id("ipv4", "1.2.3.4")
+        self.assertTrue(s.check_rate_limit([aid], "add", 1))
+        self.assertFalse(s.check_rate_limit([aid], "add", 1))
+        # still the same generation
+        s.check_addrid_generation(50, 100)
+        self.assertFalse(s.check_rate_limit([aid], "add", 50))
+        # the next generation forgets the buckets
+        s.check_addrid_generation(102, 100)
+        self.assertEqual(s._rate_limiter.count_buckets(), 0)
+
+class StorageLimits(unittest.TestCase):
+    def sm(self, phase, body):
+        return SidedMessage(side="side1", phase=phase, body=body,
+                            server_rx=1, msg_id=phase)
+
+    def test_unlimited(self):
+        s = make_server(create_channel_db(":memory:"))
+        self.assertFalse(s.get_limits().active())
+        mb = s.get_app("appid").open_mailbox("mid", "side1", 1)
+        for i in range(20):
+            mb.add_message(self.sm(str(i), "00"*1000))
+        self.assertNotIn("largest_mailbox_messages", s.get_counters())
+
+    def test_mailbox(self):
+        limits = Limits(max_body=10, max_mailbox_messages=3,
+                        max_mailbox_bytes=25)
+        s = make_server(create_channel_db(":memory:"), limits=limits)
+        mb = s.get_app("appid").open_mailbox("mid", "side1", 1)
+        e = self.assertRaises(QuotaError, mb.add_message,
+                              self.sm("1", "00"*11))
+        self.assertEqual(str(e), "body is too large (max 10 bytes)")
+        mb.add_message(self.sm("1", "00"*10))
+        mb.add_message(self.sm("2", "00"*10))
+        e = self.assertRaises(QuotaError, mb.add_message,
+                              self.sm("3", "00"*6))
+        self.assertEqual(str(e), "mailbox is full (too many bytes)")
+        mb.add_message(self.sm("3", "00"*5))
+        e = self.assertRaises(QuotaError, mb.add_message,
+                              self.sm("4", ""))
+        self.assertEqual(str(e), "mailbox is full (too many messages)")
+        self.assertEqual(len(mb.get_messages()), 3)
+        # duplicates are ignored before the quota is checked
+        self.assertFalse(mb.add_message(self.sm("3", "00"*5)))
+        c = s.get_counters()
+        self.assertEqual(c["largest_mailbox_messages"], 3)
+        self.assertEqual(c["largest_mailbox_bytes"], 25)
+        self.assertEqual(c["largest_app_mailboxes"], 1)
+
+    def test_app_mailboxes(self):
+        s = make_server(create_channel_db(":memory:"),
+                        limits=Limits(max_app_mailboxes=2))
+        app = s.get_app("appid")
+        app.open_mailbox("mid1", "side1", 1)
+        app.claim_nameplate("1", "side1", 1)
+        self.assertRaises(QuotaError, app.open_mailbox, "mid3", "side1", 1)
+        self.assertRaises(QuotaError, app.claim_nameplate, "2", "side1", 1)
+        self.assertEqual(app.get_nameplate_ids(), {"1"})
+        # existing mailboxes can still be opened
+        app.open_mailbox("mid1", "side2", 1)
+        # and other apps have their own quota
+        s.get_app("appid2").open_mailbox("mid3", "side1", 1)
+        self.assertEqual(s.get_counters()["largest_app_mailboxes"], 2)
+
+    def test_field_length(self):
+        limits = Limits(max_field_length=5)
+        limits.check_field("side", "12345")
+        limits.check_field("phase", 123456) # only strings are checked
+        e = self.assertRaises(QuotaError, limits.check_field, "side",
+                              "123456")
+        self.assertEqual(str(e), "'side' is too long (max 5 characters)")
+
 # exercise _find_available_nameplate_id failing
 # exercise CrowdedError
 # exercise double free_mailbox
@@ -661,3 +842,103 @@ class MakeServer(unittest.TestCase):
 ## test make_server(signal_error=)
 ## exercise dump_stats (with/without usagedb)
 
+
+class AppLimits(unittest.TestCase):
+    def test_nameplates(self):
+        s = make_server(create_channel_db(":memory:"),
+                        limits=Limits(max_app_nameplates=2))
+        app = s.get_app("appid")
+        # allocate_nameplate() never picks names this long, so it can't
+        # collide with the ones claimed here
+        app.claim_nameplate("1000001", "side1", 1)
+        app.claim_nameplate("1000002", "side2", 1)
+        e = self.assertRaises(QuotaError, app.allocate_nameplate, "side3", 1)
+        self.assertEqual(str(e), "too many nameplates for this app")
+        self.assertRaises(QuotaError, app.claim_nameplate, "1000003",
+                          "side3", 1)
+        # claiming an existing one is still fine
+        app.claim_nameplate("1000001", "side4", 1)
+        s.get_app("appid2").allocate_nameplate("side1", 1)
+        c = s.get_counters()
+        self.assertEqual(c["app:appid:nameplates"], 2)
+        self.assertEqual(c["app:appid:mailboxes"], 2)
+        self.assertEqual(c["app:appid2:nameplates"], 1)
+
+    def test_connections(self):
+        s = make_server(create_channel_db(":memory:"),
+                        limits=Limits(max_app_connections=2))
+        s.app_connected("appid")
+        s.app_connected("appid")
+        e = self.assertRaises(QuotaError, s.app_connected, "appid")
+        self.assertEqual(str(e), "too many connections for this app")
+        s.app_connected("appid2")
+        self.assertEqual(s.get_counters()["app:appid:connections"], 2)
+        s.app_disconnected("appid")
+        s.app_connected("appid")
+        s.app_disconnected("appid2")
+        self.assertNotIn("app:appid2:connections", s.get_counters())
+
+    def test_command_rate(self):
+        s = make_server(create_channel_db(":memory:"),
+                        limits=Limits(max_app_command_rate=2.0))
+        s.check_app_command_rate("appid", 10)
+        s.check_app_command_rate("appid", 10)
+        e = self.assertRaises(QuotaError, s.check_app_command_rate,
+                              "appid", 10)
+        self.assertEqual(str(e), "too many commands for this app, slow down")
+        # other apps aren't affected
+        s.check_app_command_rate("appid2", 10)
+        s.check_app_command_rate("appid", 10.5)
+        self.assertEqual(s.get_counters()["app:appid:rate_limited"], 1)
+
+    def test_overrides(self):
+        s = make_server(create_channel_db(":memory:"),
+                        limits=Limits(max_app_connections=1),
+                        app_limits={"big": {"connections": 3},
+                                    "fast": {"command-rate": 5.0}})
+        for i in range(3):
+            s.app_connected("big")
+        self.assertRaises(QuotaError, s.app_connected, "big")
+        s.app_connected("small")
+        self.assertRaises(QuotaError, s.app_connected, "small")
+        self.assertEqual(s.get_app_limits("fast"),
+                         Limits(max_app_connections=1,
+                                max_app_command_rate=5.0))
+        self.assertEqual(s.get_app("big")._limits.max_app_connections, 3)
+
+    def test_unlimited(self):
+        s = make_server(create_channel_db(":memory:"))
+        for i in range(100):
+            s.app_connected("appid")
+            s.check_app_command_rate("appid", 10)
+        self.assertEqual(s.get_counters(), {})
+
+    def test_iterate_prune(self):
+        s = make_server(create_channel_db(":memory:"))
+        for app_id in ["app1", "app2", "app3"]:
+            s.get_app(app_id).allocate_nameplate("side1", 1)
+        it = s.iterate_prune_all_apps(now=100, old=50)
+        self.assertEqual(next(it), "app1")
+        # the other apps haven't been pruned yet
+        self.assertEqual(s.get_all_apps(), {"app2", "app3"})
+        self.assertEqual(list(it), ["app2", "app3"])
+        self.assertEqual(s.get_all_apps(), set())
+
+    def test_iterate_prune_batches(self):
+        # a big app is pruned PRUNE_BATCH mailboxes at a time, yielding to
+        # the caller in between
+        s = make_server(create_channel_db(":memory:"))
+        app = s.get_app("big")
+        for i in range(PRUNE_BATCH * 2 + 1):
+            app.open_mailbox(f"mid{i}", "side1", 1)
+            app.free_mailbox(f"mid{i}")
+        it = s.iterate_prune_all_apps(now=100, old=50)
+        self.assertEqual(next(it), "big")
+        self.assertEqual(s._store.count_mailboxes("big"), PRUNE_BATCH + 1)
+        # one which a client opens in the meantime is kept
+        kept = sorted(s._store.get_mailboxes("big"))[0]
+        app.open_mailbox(kept, "side2", 99)
+        self.assertEqual(list(it), ["big", "big"])
+        self.assertEqual(s._store.get_mailboxes("big"), {kept: 99})
+        self.assertEqual(s.get_all_apps(), {"big"})
+
@@ -1,7 +1,13 @@
 from twisted.trial import unittest
 from unittest import mock
 from twisted.application.service import MultiService
+from twisted.application.internet import StreamServerEndpointService
 from .. import server_tap
+from ..compression import Compression
+from ..limits import Limits
+from ..workers import WorkerPool
+from ..drain import DrainService
+from ..snapshot import SnapshotService
 
 class Service(unittest.TestCase):
     def test_defaults(self):
@@ -28,8 +34,16 @@ class Service(unittest.TestCase):
                                                    blur_usage=None,
                                                    usage_db=None,
                                                    addrid_db=None,
+                                                   rate_limits=[],
+                                                   rate_limit_close=False,
+                                                   max_lag=None,
+                                                   max_connections=None,
+                                                   limits=Limits(),
+                                                   router=None,
+                                                   shard_dbs=[],
+                                                   app_limits={},
                                                    )])
-        self.assertEqual(mws.mock_calls, [mock.call(r, True, [])])
+        self.assertEqual(mws.mock_calls, [mock.call(r, True, [], Compression(), None, None)])
         self.assertIsInstance(s, MultiService)
         self.assertEqual(len(r.mock_calls), 3) # setServiceParent, check_addrid_generation, clear_connections
 
@@ -54,8 +68,16 @@ class Service(unittest.TestCase):
                                                    blur_usage=None,
                                                    usage_db=udb,
                                                    addrid_db=None,
+                                                   rate_limits=[],
+                                                   rate_limit_close=False,
+                                                   max_lag=None,
+                                                   max_connections=None,
+                                                   limits=Limits(),
+                                                   router=None,
+                                                   shard_dbs=[],
+                                                   app_limits={},
                                                    )])
-        self.assertEqual(mws.mock_calls, [mock.call(r, True, [])])
+        self.assertEqual(mws.mock_calls, [mock.call(r, True, [], Compression(), None, None)])
         self.assertIsInstance(s, MultiService)
         self.assertEqual(len(r.mock_calls), 3) # setServiceParent, check_addrid_generation, clear_connections
 
@@ -83,7 +105,148 @@ class Service(unittest.TestCase):
                                                    blur_usage=None,
                                                    usage_db=None,
                                                    addrid_db=aidb,
+                                                   rate_limits=[],
+                                                   rate_limit_close=False,
+                                                   max_lag=None,
+                                                   max_connections=None,
+                                                   limits=Limits(),
+                                                   router=None,
+                                                   shard_dbs=[],
+                                                   app_limits={},
                                                    )])
-        self.assertEqual(mws.mock_calls, [mock.call(r, True, [])])
+        self.assertEqual(mws.mock_calls, [mock.call(r, True, [], Compression(), None, None)])
         self.assertIsInstance(s, MultiService)
         self.assertEqual(len(r.mock_calls), 3) # setServiceParent, check_addrid_generation, clear_connections
+
+    def test_workers(self):
+        o = server_tap.Options()
+        o.parseOptions(["--workers=3", "--worker-index=2",
+                        "--worker-socket-dir=/run/mailbox",
+                        "--usage-db=usage.sqlite"])
+        cdb = object()
+        udb = object()
+        r = mock.Mock()
+        ws = object()
+        with mock.patch("wormhole_mailbox_server.server_tap.create_or_upgrade_channel_db", return_value=cdb) as ccdb:
+            with mock.patch("wormhole_mailbox_server.server_tap.create_or_upgrade_usage_db", return_value=udb) as ccub:
+                with mock.patch("wormhole_mailbox_server.server_tap.make_server", return_value=r) as ms:
+                    with mock.patch("wormhole_mailbox_server.server_tap.make_web_server", return_value=ws) as mws:
+                        s = server_tap.makeService(o)
+        # each worker has its own databases
+        self.assertEqual(ccdb.mock_calls, [mock.call("relay-2.sqlite")])
+        self.assertEqual(ccub.mock_calls, [mock.call("usage-2.sqlite")])
+        router = ms.mock_calls[0][2]["router"]
+        self.assertEqual(router.me, "worker-2")
+        self.assertEqual(router.peers(), ["worker-0", "worker-1"])
+        # a public site which routes, and an internal one which doesn't
+        self.assertEqual(mws.mock_calls,
+                         [mock.call(r, True, [], Compression(), None, router),
+                          mock.call(r, True, [], Compression(), None)])
+        # only worker 0 starts the others
+        self.assertEqual([c for c in s if isinstance(c, WorkerPool)], [])
+
+    def test_ports(self):
+        o = server_tap.Options()
+        o.parseOptions(["--port=tcp:4000",
+                        "--port=health=tcp:4001:interface=127.0.0.1",
+                        "--websocket-protocol-option=autoPingInterval=60",
+                        "--port-websocket-option=health:autoPingInterval=5"])
+        r = mock.Mock()
+        sites = [mock.Mock(), mock.Mock()]
+        with mock.patch("wormhole_mailbox_server.server_tap.create_or_upgrade_channel_db"):
+            with mock.patch("wormhole_mailbox_server.server_tap.make_server", return_value=r):
+                with mock.patch("wormhole_mailbox_server.server_tap.make_web_server", side_effect=sites) as mws:
+                    s = server_tap.makeService(o)
+        # each port has its own site, with its own protocol options
+        self.assertEqual(mws.mock_calls, [
+            mock.call(r, True, [("autoPingInterval", 60)], Compression(),
+                      None, None),
+            mock.call(r, True, [("autoPingInterval", 60),
+                                ("autoPingInterval", 5)], Compression(),
+                      None, None)])
+        r.add_port_label.assert_called_once_with("health",
+                                                 sites[1].ws_factory)
+        listeners = [c for c in s if isinstance(c, StreamServerEndpointService)]
+        self.assertEqual([l.factory for l in listeners], sites)
+
+    def test_drain(self):
+        o = server_tap.Options()
+        o.parseOptions(["--drain-signals",
+                        "--drain-redirect=ws://other.example.com/v1"])
+        r = mock.Mock()
+        with mock.patch("wormhole_mailbox_server.server_tap.create_or_upgrade_channel_db"):
+            with mock.patch("wormhole_mailbox_server.server_tap.make_server", return_value=r):
+                with mock.patch("wormhole_mailbox_server.server_tap.make_web_server"):
+                    s = server_tap.makeService(o)
+        [drain] = [c for c in s if isinstance(c, DrainService)]
+        self.assertIs(drain._server, r)
+        self.assertEqual(drain._redirect, "ws://other.example.com/v1")
+        self.assertEqual(drain._forward, None)
+
+    def test_no_drain(self):
+        # SIGUSR1 is left for twistd's log rotation unless asked for
+        o = server_tap.Options()
+        o.parseOptions([])
+        with mock.patch("wormhole_mailbox_server.server_tap.create_or_upgrade_channel_db"):
+            with mock.patch("wormhole_mailbox_server.server_tap.make_server"):
+                with mock.patch("wormhole_mailbox_server.server_tap.make_web_server"):
+                    s = server_tap.makeService(o)
+        self.assertEqual([c for c in s if isinstance(c, DrainService)], [])
+
+    def test_snapshot(self):
+        o = server_tap.Options()
+        o.parseOptions(["--channel-db=state/relay.sqlite",
+                        "--channel-db-shards=2",
+                        "--usage-db=state/usage.sqlite",
+                        "--snapshot-dir=snapshots"])
+        cdbs = [object(), object()]
+        udb = object()
+        with mock.patch("wormhole_mailbox_server.server_tap.create_or_upgrade_channel_db", side_effect=cdbs):
+            with mock.patch("wormhole_mailbox_server.server_tap.create_or_upgrade_usage_db", return_value=udb):
+                with mock.patch("wormhole_mailbox_server.server_tap.make_server"):
+                    with mock.patch("wormhole_mailbox_server.server_tap.make_web_server"):
+                        s = server_tap.makeService(o)
+        [ss] = [c for c in s if isinstance(c, SnapshotService)]
+        self.assertEqual(ss._directory, "snapshots")
+        self.assertEqual(ss._dbs, [("relay.sqlite", cdbs[0]),
+                                   ("relay.shard-1.sqlite", cdbs[1]),
+                                   ("usage.sqlite", udb)])
+        self.assertEqual(ss.step, 60.0)
+
+    def test_channel_db_shards(self):
+        o = server_tap.Options()
+        o.parseOptions(["--channel-db=state/relay.sqlite",
+                        "--channel-db-shards=3"])
+        cdbs = [object(), object(), object()]
+        r = mock.Mock()
+        ws = object()
+        with mock.patch("wormhole_mailbox_server.server_tap.create_or_upgrade_channel_db", side_effect=cdbs) as ccdb:
+            with mock.patch("wormhole_mailbox_server.server_tap.make_server", return_value=r) as ms:
+                with mock.patch("wormhole_mailbox_server.server_tap.make_web_server", return_value=ws):
+                    server_tap.makeService(o)
+        # every shard is created or upgraded
+        self.assertEqual(ccdb.mock_calls,
+                         [mock.call("state/relay.sqlite"),
+                          mock.call("state/relay.shard-1.sqlite"),
+                          mock.call("state/relay.shard-2.sqlite")])
+        self.assertIs(ms.mock_calls[0][1][0], cdbs[0])
+        self.assertEqual(ms.mock_calls[0][2]["shard_dbs"], cdbs[1:])
+
+    def test_cluster(self):
+        o = server_tap.Options()
+        o.parseOptions(["--cluster-node=a", "--cluster-listen=tcp:4100",
+                        "--cluster-peer=b=tcp:host-b:4100"])
+        cdb = object()
+        r = mock.Mock()
+        ws = object()
+        with mock.patch("wormhole_mailbox_server.server_tap.create_or_upgrade_channel_db", return_value=cdb) as ccdb:
+            with mock.patch("wormhole_mailbox_server.server_tap.make_server", return_value=r) as ms:
+                with mock.patch("wormhole_mailbox_server.server_tap.make_web_server", return_value=ws) as mws:
+                    server_tap.makeService(o)
+        self.assertEqual(ccdb.mock_calls, [mock.call("relay.sqlite")])
+        router = ms.mock_calls[0][2]["router"]
+        self.assertEqual(router.me, "a")
+        self.assertEqual(router.peers(), ["b"])
+        self.assertEqual(mws.mock_calls,
+                         [mock.call(r, True, [], Compression(), None, router),
+                          mock.call(r, True, [], Compression(), None)])
@@ -0,0 +1,149 @@
+from twisted.trial import unittest
+from ..server import make_server, SidedMessage
+from ..database import create_channel_db, create_usage_db
+from ..limits import Limits, QuotaError
+from ..shards import shard_path, ChannelShards
+from ..sqlite_storage import SQLiteChannelStore
+
+class Paths(unittest.TestCase):
+    def test_shard_path(self):
+        self.assertEqual(shard_path("relay.sqlite", 0), "relay.sqlite")
+        self.assertEqual(shard_path("relay.sqlite", 2), "relay.shard-2.sqlite")
+        self.assertEqual(shard_path("/var/db/relay-1.sqlite", 1),
+                         "/var/db/relay-1.shard-1.sqlite")
+        self.assertEqual(shard_path("relay", 1), "relay.shard-1")
+        self.assertEqual(shard_path(":memory:", 1), ":memory:")
+
+    def test_one_shard(self):
+        db = object()
+        shards = ChannelShards([db])
+        self.assertIs(shards.for_nameplate("appid", "1"), db)
+        self.assertIs(shards.for_mailbox("mid"), db)
+
+    def test_commit_written(self):
+        class FakeDB:
+            in_transaction = False
+            commits = 0
+            def commit(self):
+                self.commits += 1
+                self.in_transaction = False
+        dbs = [FakeDB() for i in range(3)]
+        shards = ChannelShards(dbs)
+        dbs[1].in_transaction = True
+        shards.commit_written()
+        self.assertEqual([db.commits for db in dbs], [0, 1, 0])
+        shards.commit_written()
+        self.assertEqual([db.commits for db in dbs], [0, 1, 0])
+
+def count(db, table):
+    return db.execute(f"SELECT COUNT() AS `count` FROM `{table}`"
+                      ).fetchone()["count"]
+
+class Sharded(unittest.TestCase):
+    def setUp(self):
+        self.dbs = [create_channel_db(":memory:") for i in range(3)]
+        self.server = make_server(self.dbs[0], shard_dbs=self.dbs[1:])
+        self.shards = self.server._store.shards
+
+    def test_nameplates(self):
+        app = self.server.get_app("appid")
+        names = {app.allocate_nameplate("side%d" % i, 0) for i in range(30)}
+        self.assertEqual(app.get_nameplate_ids(), names)
+        # spread across every shard, each nameplate with its mailbox
+        for db in self.dbs:
+            self.assertGreater(count(db, "nameplates"), 0)
+        for name in names:
+            db = self.shards.for_nameplate("appid", name)
+            row = db.execute("SELECT * FROM `nameplates` WHERE `name`=?",
+                             (name,)).fetchone()
+            self.assertIs(self.shards.for_mailbox(row["mailbox_id"]), db)
+            self.assertEqual(count(db, "mailboxes"),
+                             count(db, "nameplates"))
+
+        # claiming by name finds the same nameplate and mailbox
+        name = sorted(names)[0]
+        mailbox_id = app.claim_nameplate(name, "other", 1)
+        db = self.shards.for_nameplate("appid", name)
+        row = db.execute("SELECT * FROM `nameplates` WHERE `name`=?",
+                         (name,)).fetchone()
+        self.assertEqual(row["mailbox_id"], mailbox_id)
+
+        for db in self.dbs:
+            db.execute("DELETE FROM `nameplate_sides`")
+            db.execute("DELETE FROM `nameplates`")
+            db.commit()
+        self.assertEqual(app.get_nameplate_ids(), set())
+
+    def test_mailbox(self):
+        app = self.server.get_app("appid")
+        mailbox_ids = ["mid%d" % i for i in range(10)]
+        for mailbox_id in mailbox_ids:
+            mb = app.open_mailbox(mailbox_id, "side1", 0)
+            mb.add_message(SidedMessage("side1", "phase", "body", 1, "msgid"))
+        for mailbox_id in mailbox_ids:
+            db = self.shards.for_mailbox(mailbox_id)
+            row = db.execute("SELECT * FROM `messages` WHERE `mailbox_id`=?",
+                             (mailbox_id,)).fetchone()
+            self.assertEqual(row["body"], "body")
+        self.assertEqual(sum(count(db, "messages") for db in self.dbs), 10)
+
+        # closing removes everything from its shard
+        for mailbox_id in mailbox_ids:
+            app.open_mailbox(mailbox_id, "side1", 0).close("side1", "happy", 1)
+        for db in self.dbs:
+            self.assertEqual(count(db, "mailboxes"), 0)
+            self.assertEqual(count(db, "messages"), 0)
+
+    def test_app_mailboxes_limit(self):
+        # the limit applies to the app's mailboxes in all shards together
+        self.server = make_server(self.dbs[0], shard_dbs=self.dbs[1:],
+                                  limits=Limits(max_app_mailboxes=5))
+        app = self.server.get_app("appid")
+        for i in range(5):
+            app.open_mailbox("mid%d" % i, "side1", 0)
+        with self.assertRaises(QuotaError):
+            app.open_mailbox("mid5", "side1", 0)
+        self.assertEqual(self.server.get_counters()["largest_app_mailboxes"],
+                         5)
+
+    def test_prune(self):
+        for app_id in ["app1", "app2"]:
+            app = self.server.get_app(app_id)
+            for i in range(10):
+                app.allocate_nameplate("side%d" % i, 0)
+            for i in range(10):
+                app.open_mailbox("%s-mid%d" % (app_id, i), "side", 0)
+        self.assertEqual(self.server.get_all_apps(), {"app1", "app2"})
+        self.server.prune_all_apps(now=123, old=50)
+        for db in self.dbs:
+            for table in ["nameplates", "nameplate_sides", "mailboxes",
+                          "mailbox_sides", "messages"]:
+                self.assertEqual(count(db, table), 0, table)
+        self.assertEqual(self.server.get_all_apps(), set())
+
+    def test_prune_after_reshard(self):
+        # start with two shards, then add a third: most rows are now in a
+        # shard which for_mailbox() and for_nameplate() don't point at, but
+        # pruning must still find (and summarize) them, for every app
+        usage_db = create_usage_db(":memory:")
+        before = make_server(self.dbs[0], shard_dbs=self.dbs[1:2],
+                             usage_db=usage_db)
+        for app_id in ["a", "b"]:
+            app = before.get_app(app_id)
+            for i in range(10):
+                app.allocate_nameplate("side%d" % i, 0)
+                app.open_mailbox("%s-mid%d" % (app_id, i), "side", 0)
+        self.assertEqual(count(self.dbs[2], "mailboxes"), 0)
+
+        after = make_server(self.dbs[0], shard_dbs=self.dbs[1:],
+                            usage_db=usage_db)
+        self.assertIsInstance(after._store, SQLiteChannelStore)
+        self.assertEqual(after.get_all_apps(), {"a", "b"})
+        after.prune_all_apps(now=123, old=50)
+        for db in self.dbs:
+            for table in ["nameplates", "nameplate_sides", "mailboxes",
+                          "mailbox_sides", "messages"]:
+                self.assertEqual(count(db, table), 0, table)
+        self.assertEqual(after.get_all_apps(), set())
+        self.assertEqual(count(usage_db, "nameplates"), 20)
+        self.assertEqual(count(usage_db, "mailboxes"), 40)
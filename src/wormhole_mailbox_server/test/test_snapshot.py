@@ -0,0 +1,53 @@
+import os
+from twisted.trial import unittest
+from ..database import (create_channel_db, create_or_upgrade_usage_db,
+                        open_existing_db)
+from ..server import make_server
+from ..snapshot import write_snapshot, SnapshotService
+
+class Snapshot(unittest.TestCase):
+    def setUp(self):
+        self.basedir = self.mktemp()
+        os.mkdir(self.basedir)
+
+    def files(self):
+        return sorted(os.listdir(self.basedir))
+
+    def test_write(self):
+        db = create_channel_db(":memory:")
+        s = make_server(db)
+        s.get_app("appid").claim_nameplate("1", "side1", 1)
+        path = os.path.join(self.basedir, "relay.sqlite")
+        write_snapshot(db, path)
+        self.assertEqual(self.files(), ["relay.sqlite"])
+        snap = open_existing_db(path)
+        rows = snap.execute("SELECT `name` FROM `nameplates`").fetchall()
+        self.assertEqual(rows, [{"name": "1"}])
+        snap.close()
+        self.assertEqual(os.stat(path).st_mode & 0o222, 0) # read-only
+
+        # the next one replaces it
+        s.get_app("appid").claim_nameplate("2", "side1", 2)
+        write_snapshot(db, path)
+        self.assertEqual(self.files(), ["relay.sqlite"])
+        snap = open_existing_db(path)
+        rows = snap.execute("SELECT `name` FROM `nameplates`"
+                            " ORDER BY `name`").fetchall()
+        self.assertEqual(rows, [{"name": "1"}, {"name": "2"}])
+        snap.close()
+
+    def test_service(self):
+        channel_db = create_channel_db(":memory:")
+        usage_db = create_or_upgrade_usage_db(os.path.join(self.basedir,
+                                                           "live-usage.sqlite"))
+        missing = os.path.join(self.basedir, "missing")
+        ss = SnapshotService(self.basedir, [("relay.sqlite", channel_db),
+                                            ("usage.sqlite", usage_db)])
+        ss.write_snapshots()
+        self.assertEqual(self.files(), ["live-usage.sqlite", "relay.sqlite",
+                                        "usage.sqlite"])
+        # errors are logged, and leave nothing behind
+        bad = SnapshotService(missing, [("relay.sqlite", channel_db)])
+        bad.write_snapshots()
+        self.assertEqual(len(self.flushLoggedErrors(FileNotFoundError)), 1)
+        self.assertFalse(os.path.exists(missing))
@@ -6,10 +6,11 @@ from ..server import make_server, CrowdedError
 np1 = "1"
 
 class _Make:
-    def make(self, blur_usage=None, with_usage_db=True):
+    def make(self, blur_usage=None, with_usage_db=True, **kwargs):
         self._cdb = create_channel_db(":memory:")
         db = create_usage_db(":memory:") if with_usage_db else None
-        s = make_server(self._cdb, usage_db=db, blur_usage=blur_usage)
+        s = make_server(self._cdb, usage_db=db, blur_usage=blur_usage,
+                        **kwargs)
         app = s.get_app("appid")
         return s, db, app
 
@@ -41,6 +42,36 @@ class Current(_Make, unittest.TestCase):
                                connections_websocket=1),
                           ])
 
+class Counters(_Make, unittest.TestCase):
+    def counters(self, db):
+        return {row["name"]: row["value"]
+                for row in db.execute("SELECT * FROM `counters`").fetchall()}
+
+    def test_no_counters(self):
+        s, db, app = self.make()
+        s.dump_stats(456, rebooted=451)
+        self.assertEqual(self.counters(db), {})
+
+    def test_counters(self):
+        s, db, app = self.make(rate_limits=[("add", 1.0, 1.0)],
+                               max_lag=1.0, max_connections=1)
+        s.check_rate_limit([("host", "h")], "add", 1)
+        s.check_rate_limit([("host", "h")], "add", 1)
+        self.assertEqual(s.check_admission(1), None)
+        self.assertEqual(s.check_admission(2), "connections")
+        s._governor.lag = 1.5
+        self.assertEqual(s.check_admission(1), "lag")
+        s.dump_stats(456, rebooted=451)
+        self.assertEqual(self.counters(db), {"rate_limited": 1,
+                                             "rate_limit_buckets": 1,
+                                             "reactor_lag": 1.5,
+                                             "shed_lag": 1,
+                                             "shed_connections": 1})
+        # the table is rewritten each time
+        s.check_admission(2)
+        s.dump_stats(457, rebooted=451)
+        self.assertEqual(self.counters(db)["shed_connections"], 2)
+
 class ClientVersion(_Make, unittest.TestCase):
     def test_add_version(self):
         s, db, app = self.make()
@@ -0,0 +1,370 @@
+from zope.interface.verify import verifyObject
+from twisted.trial import unittest
+from ..database import create_channel_db, create_addrid_db
+from ..storage import IChannelStore, IAddressIDStore
+from ..sqlite_storage import SQLiteChannelStore, SQLiteAddressIDStore
+from ..memory_storage import MemoryChannelStore, MemoryAddressIDStore
+from ..server import make_server, SidedMessage, ReclaimedError
+
+# Every store must pass these tests. To test a new one, add subclasses of
+# ChannelStoreTests and AddressIDStoreTests (and of Workload) which create it.
+
+class ChannelStoreTests(object):
+    def setUp(self):
+        self.store = self.make_store()
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(IChannelStore, self.store))
+
+    def test_nameplates(self):
+        s = self.store
+        self.assertEqual(s.get_nameplates("appid"), {})
+        self.assertEqual(s.get_nameplate("appid", "1"), None)
+        self.assertEqual(s.get_nameplate_sides("appid", "1"), [])
+        self.assertTrue(s.accepts_mailbox_id("appid", "1", "mid1")
+                        or s.accepts_mailbox_id("appid", "1", "mid2")
+                        or s.accepts_mailbox_id("appid", "1", "mid3"))
+        mid = next(m for m in ["mid1", "mid2", "mid3", "mid4", "mid5"]
+                   if s.accepts_mailbox_id("appid", "1", m))
+        s.add_mailbox("appid", mid, True, 1)
+        s.add_nameplate("appid", "1", mid)
+        s.add_nameplate_side("appid", "1", "side1", 1)
+        s.add_nameplate_side("appid", "1", "side2", 2)
+        s.commit()
+        self.assertEqual(s.get_nameplates("appid"), {"1": mid})
+        self.assertEqual(s.get_nameplates("other"), {})
+        self.assertEqual(s.get_nameplate("appid", "1"), mid)
+        self.assertEqual(s.get_nameplate("other", "1"), None)
+        self.assertEqual(s.count_nameplates("appid"), 1)
+        self.assertEqual(s.count_nameplates("other"), 0)
+
+        s.release_nameplate_side("appid", "1", "side1")
+        rows = s.get_nameplate_sides("appid", "1")
+        self.assertEqual([(r["side"], bool(r["claimed"]), r["added"])
+                          for r in rows],
+                         [("side1", False, 1), ("side2", True, 2)])
+
+        s.delete_nameplate("appid", "1")
+        s.commit()
+        self.assertEqual(s.get_nameplates("appid"), {})
+        self.assertEqual(s.get_nameplate_sides("appid", "1"), [])
+        self.assertEqual(s.count_nameplates("appid"), 0)
+        # the mailbox is still there
+        self.assertEqual(s.count_mailboxes("appid"), 1)
+
+    def test_mailboxes(self):
+        s = self.store
+        self.assertEqual(s.get_mailbox("appid", "mid"), None)
+        self.assertEqual(s.get_mailbox_sides("appid", "mid"), [])
+        s.add_mailbox("appid", "mid", False, 1)
+        s.add_mailbox_side("appid", "mid", "side1", 1)
+        s.add_mailbox_side("appid", "mid", "side2", 2)
+        s.commit()
+        row = s.get_mailbox("appid", "mid")
+        self.assertEqual((bool(row["for_nameplate"]), row["updated"]),
+                         (False, 1))
+        self.assertEqual(s.get_mailbox("other", "mid"), None)
+        s.touch_mailbox("appid", "mid", 5)
+        self.assertEqual(s.get_mailbox("appid", "mid")["updated"], 5)
+        self.assertEqual(s.get_mailboxes("appid"), {"mid": 5})
+        self.assertEqual(s.get_mailboxes("other"), {})
+        self.assertEqual(s.count_mailboxes("appid"), 1)
+
+        s.close_mailbox_side("appid", "mid", "side2", "happy")
+        rows = s.get_mailbox_sides("appid", "mid")
+        self.assertEqual([(r["side"], bool(r["opened"]), r["added"],
+                           r["mood"]) for r in rows],
+                         [("side1", True, 1, None),
+                          ("side2", False, 2, "happy")])
+
+    def test_delete_mailbox(self):
+        s = self.store
+        mid = next(m for m in ["mid1", "mid2", "mid3", "mid4", "mid5"]
+                   if s.accepts_mailbox_id("appid", "1", m))
+        s.add_mailbox("appid", mid, True, 1)
+        s.add_nameplate("appid", "1", mid)
+        s.add_nameplate_side("appid", "1", "side1", 1)
+        s.add_mailbox_side("appid", mid, "side1", 1)
+        s.add_message("appid", mid, "side1", "pake", "aa", 1, None)
+        s.add_mailbox("appid", "other", False, 1)
+        s.add_message("appid", "other", "side1", "pake", "bb", 1, None)
+        s.commit()
+
+        # the nameplate goes too
+        s.delete_mailbox("appid", mid)
+        s.commit()
+        self.assertEqual(s.get_mailbox("appid", mid), None)
+        self.assertEqual(s.get_mailbox_sides("appid", mid), [])
+        self.assertEqual(s.get_messages("appid", mid), [])
+        self.assertEqual(s.get_nameplates("appid"), {})
+        self.assertEqual(s.get_nameplate_sides("appid", "1"), [])
+        self.assertEqual([m["body"] for m in s.get_messages("appid", "other")],
+                         ["bb"])
+
+    def test_prune(self):
+        s = self.store
+        mids = {}
+        for (name, when) in [("1", 10), ("2", 20)]:
+            mids[name] = next(f"mid{name}-{i}" for i in range(100)
+                              if s.accepts_mailbox_id("appid", name,
+                                                      f"mid{name}-{i}"))
+            s.add_mailbox("appid", mids[name], True, when)
+            s.add_nameplate("appid", name, mids[name])
+            s.add_nameplate_side("appid", name, "side1", when)
+            s.add_mailbox_side("appid", mids[name], "side1", when)
+            s.add_message("appid", mids[name], "side1", "pake", "aa", when,
+                          None)
+        s.add_mailbox("appid", "mid3", False, 10)
+        s.add_mailbox("other", "mid4", False, 10)
+        s.commit()
+
+        self.assertEqual(s.prune("appid", 5), ([], []))
+        nameplates, mailboxes = s.prune("appid", 15)
+        s.commit()
+        self.assertEqual([[(r["side"], r["added"]) for r in rows]
+                          for rows in nameplates],
+                         [[("side1", 10)]])
+        self.assertEqual(sorted((bool(for_nameplate),
+                                 [(r["side"], r["added"]) for r in rows])
+                                for (for_nameplate, rows) in mailboxes),
+                         [(False, []), (True, [("side1", 10)])])
+        self.assertEqual(s.get_nameplates("appid"), {"2": mids["2"]})
+        self.assertEqual(s.get_mailboxes("appid"), {mids["2"]: 20})
+        self.assertEqual(s.get_messages("appid", mids["1"]), [])
+        self.assertEqual(s.get_mailboxes("other"), {"mid4": 10})
+
+    def test_prune_limit(self):
+        s = self.store
+        for i in range(5):
+            s.add_mailbox("appid", f"mid{i}", False, 10)
+        s.add_mailbox("appid", "new", False, 20)
+        s.commit()
+        self.assertEqual(s.prune("appid", 5, limit=2), ([], []))
+        for expected in [2, 2, 1, 0]:
+            nameplates, mailboxes = s.prune("appid", 15, limit=2)
+            s.commit()
+            self.assertEqual(len(mailboxes), expected)
+        self.assertEqual(s.get_mailboxes("appid"), {"new": 20})
+
+    def test_messages(self):
+        s = self.store
+        s.add_mailbox("appid", "mid", False, 1)
+        s.add_mailbox("appid", "mid2", False, 1)
+        self.assertEqual(s.get_messages("appid", "mid"), [])
+        self.assertEqual(s.get_last_seq("appid", "mid"), 0)
+        self.assertEqual(s.get_mailbox_size("appid", "mid"), (0, 0))
+        seq1 = s.add_message("appid", "mid", "side1", "pake", "aabb", 1, "m1")
+        s.add_message("appid", "mid2", "side1", "pake", "cc", 1, "m1")
+        seq2 = s.add_message("appid", "mid", "side2", "pake", "dd", 2, None)
+        s.commit()
+        self.assertGreater(seq1, 0)
+        self.assertGreater(seq2, seq1)
+        self.assertEqual(s.get_last_seq("appid", "mid"), seq2)
+        self.assertEqual(s.get_messages("appid", "mid"), [
+            {"seq": seq1, "side": "side1", "phase": "pake", "body": "aabb",
+             "server_rx": 1, "msg_id": "m1"},
+            {"seq": seq2, "side": "side2", "phase": "pake", "body": "dd",
+             "server_rx": 2, "msg_id": None},
+            ])
+        self.assertEqual([m["seq"] for m in s.get_messages("appid", "mid",
+                                                           since=seq1)],
+                         [seq2])
+        self.assertEqual(s.get_messages("appid", "mid", since=seq2), [])
+        self.assertEqual(s.get_mailbox_size("appid", "mid"), (2, 6))
+
+        self.assertTrue(s.has_message("appid", "mid", "side1", "pake", "m1"))
+        self.assertFalse(s.has_message("appid", "mid", "side2", "pake", "m1"))
+        self.assertFalse(s.has_message("appid", "mid", "side1", "version",
+                                       "m1"))
+        self.assertFalse(s.has_message("other", "mid", "side1", "pake", "m1"))
+
+    def test_statistics(self):
+        s = self.store
+        self.assertEqual(s.get_app_ids(), set())
+        self.assertEqual(s.count_all_nameplates(), {})
+        self.assertEqual(s.count_all_mailboxes(), {})
+        self.assertEqual(s.get_largest_mailbox(), (0, 0))
+        for (app_id, name) in [("app1", "1"), ("app1", "2"), ("app2", "1")]:
+            mid = next(f"{app_id}-{name}-{i}" for i in range(100)
+                       if s.accepts_mailbox_id(app_id, name,
+                                               f"{app_id}-{name}-{i}"))
+            s.add_mailbox(app_id, mid, True, 1)
+            s.add_nameplate(app_id, name, mid)
+        s.add_mailbox("app3", "mid", False, 1)
+        for body in ["aa", "bbbb", "cc"]:
+            s.add_message("app3", "mid", "side1", "pake", body, 1, None)
+        s.commit()
+        self.assertEqual(s.get_app_ids(), {"app1", "app2", "app3"})
+        self.assertEqual(s.count_all_nameplates(), {"app1": 2, "app2": 1})
+        self.assertEqual(s.count_all_mailboxes(),
+                         {"app1": 2, "app2": 1, "app3": 1})
+        self.assertEqual(s.get_largest_mailbox(), (3, 8))
+
+    def test_connections(self):
+        s = self.store
+        self.assertEqual(s.get_connections(), [])
+        id1 = s.add_connection(1, 3, 10)
+        id2 = s.add_connection(None, None, 11)
+        s.commit()
+        self.assertNotEqual(id1, id2)
+        s.set_connection_side(id1, "side1", "impl", "v1")
+        s.add_connection_message(id1, 12, "bind")
+        s.add_connection_message(id1, 13, "allocate")
+        s.commit()
+        self.assertEqual(s.get_connections(), [
+            {"id": id1, "addrid_generation": 1, "addrid_counter": 3,
+             "connected": 10, "side": "side1", "implementation": "impl",
+             "version": "v1", "active": 13},
+            {"id": id2, "addrid_generation": None, "addrid_counter": None,
+             "connected": 11, "side": None, "implementation": None,
+             "version": None, "active": 11},
+            ])
+        self.assertEqual(s.get_connection_messages(id1),
+                         [{"when": 12, "name": "bind"},
+                          {"when": 13, "name": "allocate"}])
+
+        s.remove_connection(id1)
+        s.commit()
+        self.assertEqual([c["id"] for c in s.get_connections()], [id2])
+        self.assertEqual(s.get_connection_messages(id1), [])
+        s.clear_connections()
+        s.commit()
+        self.assertEqual(s.get_connections(), [])
+
+    def test_addrid_generation(self):
+        s = self.store
+        self.assertEqual(s.get_addrid_generation(), None)
+        s.set_addrid_generation(1, 100)
+        s.set_addrid_generation(2, 200)
+        s.commit()
+        self.assertEqual(s.get_addrid_generation(),
+                         {"generation": 2, "started": 200})
+
+    def test_server(self):
+        # the whole server works on top of the store
+        server = make_server(None, store=self.store)
+        app = server.get_app("appid")
+        name = app.allocate_nameplate("side1", 1)
+        self.assertEqual(app.get_nameplate_ids(), {name})
+        mid = app.claim_nameplate(name, "side2", 2)
+        mb1 = app.open_mailbox(mid, "side1", 3)
+        got = []
+        mb1.add_listener("h1", got.append, lambda: None)
+        mb2 = app.open_mailbox(mid, "side2", 3)
+        mb2.add_message(SidedMessage("side2", "pake", "aa", 4, "m1"))
+        self.assertFalse(mb2.add_message(SidedMessage("side2", "pake", "aa",
+                                                      5, "m1")))
+        self.assertEqual([sm.body for sm in got], ["aa"])
+        app.release_nameplate(name, "side1", 5)
+        self.assertRaises(ReclaimedError, app.claim_nameplate, name,
+                          "side1", 6)
+        app.release_nameplate(name, "side2", 6)
+        self.assertEqual(app.get_nameplate_ids(), set())
+        mb1.close("side1", "happy", 7)
+        mb2.close("side2", "happy", 7)
+        self.assertEqual(self.store.get_app_ids(), set())
+
+        # and abandoned wormholes are pruned
+        app.claim_nameplate("5", "side1", 10)
+        app.open_mailbox("mid", "side1", 10)
+        server.prune_all_apps(now=100, old=50)
+        self.assertEqual(self.store.get_app_ids(), set())
+
+class AddressIDStoreTests(object):
+    def setUp(self):
+        self.store = self.make_store()
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(IAddressIDStore, self.store))
+
+    def test_ids(self):
+        s = self.store
+        self.assertEqual(s.get_id("ipv4", "1.2.3.4"), None)
+        self.assertEqual(s.get_address(1, 1), None)
+        self.assertEqual(s.get_last_counter(1), 0)
+        s.add_id(1, 1, "ipv4", "1.2.3.4")
+        s.add_id(1, 2, "ipv6", "2::3")
+        s.commit()
+        self.assertEqual(s.get_id("ipv4", "1.2.3.4"), (1, 1))
+        self.assertEqual(s.get_id("ipv6", "1.2.3.4"), None)
+        self.assertEqual(s.get_address(1, 2), ("ipv6", "2::3"))
+        self.assertEqual(s.get_last_counter(1), 2)
+        self.assertEqual(s.get_last_counter(2), 0)
+        s.clear()
+        s.commit()
+        self.assertEqual(s.get_id("ipv4", "1.2.3.4"), None)
+        self.assertEqual(s.get_address(1, 1), None)
+        self.assertEqual(s.get_last_counter(1), 0)
+
+
+def run_wormholes(server, count, in_progress, first=0):
+    """Run 'count' complete wormholes through 'server', keeping
+    'in_progress' of them open at once, like a busy server. Each one
+    allocates and claims a nameplate, adds two messages, reads them from
+    the other side, then releases and closes. misc/bench_storage.py uses
+    this too."""
+    app = server.get_app("appid")
+    pending = []
+    def finish(name, mid, i, now):
+        mb = app.open_mailbox(mid, f"b{i}", now)
+        assert len(mb.get_messages(since=0)) == 2
+        app.release_nameplate(name, f"a{i}", now)
+        app.release_nameplate(name, f"b{i}", now)
+        mb.remove_listener(i)
+        mb.close(f"a{i}", "happy", now)
+        mb.close(f"b{i}", "happy", now)
+    for i in range(first, first + count):
+        now = i
+        name = app.allocate_nameplate(f"a{i}", now)
+        mid = app.claim_nameplate(name, f"b{i}", now)
+        mb = app.open_mailbox(mid, f"a{i}", now)
+        mb.add_listener(i, lambda sm: None, lambda: None)
+        for phase in ["pake", "version"]:
+            mb.add_message(SidedMessage(f"a{i}", phase, "aa" * 64, now,
+                                        f"{i}-{phase}"))
+        pending.append((name, mid, i))
+        if len(pending) > in_progress:
+            finish(*pending.pop(0), now)
+    assert len(app.get_nameplate_ids()) == min(count, in_progress)
+    for (name, mid, i) in pending:
+        finish(name, mid, i, first + count)
+
+class Workload(object):
+    # Many wormholes, some of them in progress at once, all through one
+    # store: the results must stay right, and nothing may be left behind.
+    # How fast each store does this is measured by misc/bench_storage.py,
+    # not here.
+    WORMHOLES = 500
+    IN_PROGRESS = 50
+
+    def test_workload(self):
+        store = self.make_store()
+        server = make_server(None, store=store)
+        run_wormholes(server, self.WORMHOLES, self.IN_PROGRESS)
+        self.assertEqual(server.get_app("appid").get_nameplate_ids(), set())
+        self.assertEqual(store.get_app_ids(), set())
+        self.assertEqual(store.get_connections(), [])
+
+def sqlite_store():
+    return SQLiteChannelStore([create_channel_db(":memory:")])
+def sharded_sqlite_store():
+    return SQLiteChannelStore([create_channel_db(":memory:")
+                               for i in range(3)])
+
+class SQLite(ChannelStoreTests, unittest.TestCase):
+    make_store = staticmethod(sqlite_store)
+class ShardedSQLite(ChannelStoreTests, unittest.TestCase):
+    make_store = staticmethod(sharded_sqlite_store)
+class Memory(ChannelStoreTests, unittest.TestCase):
+    make_store = MemoryChannelStore
+
+class SQLiteAddressIDs(AddressIDStoreTests, unittest.TestCase):
+    def make_store(self):
+        return SQLiteAddressIDStore(create_addrid_db(":memory:"))
+class MemoryAddressIDs(AddressIDStoreTests, unittest.TestCase):
+    make_store = MemoryAddressIDStore
+
+class SQLiteWorkload(Workload, unittest.TestCase):
+    make_store = staticmethod(sqlite_store)
+class MemoryWorkload(Workload, unittest.TestCase):
+    make_store = MemoryChannelStore
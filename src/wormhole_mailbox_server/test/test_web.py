@@ -1,14 +1,22 @@
-import io, time
+import io, os, time
 from unittest import mock
 import treq
 from twisted.trial import unittest
-from twisted.internet import defer, reactor
+from twisted.internet import defer, endpoints, reactor, tcp
+from twisted.python import log
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
 from ..web import make_web_server
 from ..server import SidedMessage
+from .. import framing
+from ..framing import FRAMINGS
+from ..compression import Compression
+from ..limits import Limits
+from autobahn.websocket.compress import (PerMessageDeflateOffer,
+                                         PerMessageDeflateResponseAccept)
 from ..database import create_or_upgrade_usage_db
-from .common import ServerBase, _Util
-from .ws_client import WSFactory
+from .common import ServerBase, ClientServerBase, _Util
+from .ws_client import WSFactory, WSError
 
 np1 = "1"
 np2 = "2"
@@ -16,7 +24,7 @@ np2 = "2"
 class WebSocketProtocolOptions(unittest.TestCase):
     @mock.patch('wormhole_mailbox_server.web.WebSocketServerFactory')
     def test_set(self, fake_factory):
-        make_web_server(None, False,
+        make_web_server(mock.Mock(), False,
                         websocket_protocol_options=[ ("foo", "bar"), ],
                         )
         self.assertEqual(
@@ -300,8 +308,7 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
 
         # claiming a nameplate assigns a random mailbox id and creates the
         # mailbox row
-        mailboxes = app._db.execute("SELECT * FROM `mailboxes`"
-                                    " WHERE `app_id`='appid'").fetchall()
+        mailboxes = app._store.get_mailboxes("appid")
         self.assertEqual(len(mailboxes), 1)
 
     @inlineCallbacks
@@ -320,6 +327,218 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         self.assertEqual(err["type"], "error")
         self.assertEqual(err["error"], "crowded")
 
+    @inlineCallbacks
+    def test_presence(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side", features=["presence"])
+        c1.send("open", mailbox="mb1")
+        yield c1.sync()
+        self.assertEqual([m for m in c1.events if m["type"] != "ack"], [])
+        c1.strip_acks()
+
+        c2 = yield self.make_client()
+        yield c2.next_non_ack()
+        c2.send("bind", appid="appid", side="side2", features=["presence"])
+        c2.send("open", mailbox="mb1")
+        # c2 learns that c1 is already there
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["type"], "presence")
+        self.assertEqual((m["side"], m["event"]), ("side", "opened"))
+        # and c1 learns that c2 arrived, without any message being added
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "presence")
+        self.assertEqual((m["side"], m["event"]), ("side2", "opened"))
+
+        c2.send("close", mood="happy")
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["type"], "closed")
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["side"], m["event"]), ("side2", "closed"))
+
+        # clients which didn't ask are not told
+        c3 = yield self.make_client()
+        yield c3.next_non_ack()
+        c3.send("bind", appid="appid", side="side3")
+        c3.send("open", mailbox="mb2")
+        yield c3.sync()
+        self._server.get_app("appid").open_mailbox("mb2", "side4", 0)
+        yield c3.sync()
+        self.assertEqual([m for m in c3.events if m["type"] == "presence"],
+                         [])
+
+    @inlineCallbacks
+    def test_channels(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side", features=["channels"])
+        app = self._server.get_app("appid")
+        mb1 = app.open_mailbox("mb1", "side2", 0)
+        mb2 = app.open_mailbox("mb2", "side2", 0)
+
+        # the default channel, and two tagged ones, each with an open
+        c1.send("open", mailbox="mb0")
+        c1.send("open", mailbox="mb1", channel=1)
+        c1.send("open", mailbox="mb2", channel="two")
+        yield c1.sync()
+        self.assertEqual(c1.errors, [])
+        acks = [m for m in c1.events if m["type"] == "ack"]
+        # bind, the three opens, and the sync ping
+        self.assertEqual([m.get("channel") for m in acks],
+                         [None, None, 1, "two", None])
+        c1.strip_acks()
+
+        mb2.add_message(SidedMessage(side="side2", phase="phase",
+                                     body="body2", server_rx=0, msg_id="m2"))
+        mb1.add_message(SidedMessage(side="side2", phase="phase",
+                                     body="body1", server_rx=0, msg_id="m1"))
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["body"], m["channel"]), ("body2", "two"))
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["body"], m["channel"]), ("body1", 1))
+
+        c1.send("add", phase="p", body="aa", channel=1)
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["channel"]), ("message", 1))
+        self.assertEqual(len(mb1.get_messages()), 2)
+        self.assertEqual(len(mb2.get_messages()), 1)
+
+        # each channel has its own once-per-connection rules
+        c1.send("open", mailbox="mb3", channel=1)
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["error"], "only one open per connection")
+        self.assertEqual(err["orig"]["channel"], 1)
+        c1.send("open", mailbox="mb3", channel=[1])
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["error"], "'channel' must be a string or integer")
+
+        # closing one channel leaves the others subscribed, and frees its
+        # handle for another mailbox
+        c1.send("close", mood="happy", channel=1)
+        m = yield c1.next_non_ack()
+        self.assertEqual((m["type"], m["channel"]), ("closed", 1))
+        self.assertFalse(mb1.has_listeners())
+        self.assertTrue(mb2.has_listeners())
+        c1.send("open", mailbox="mb3", channel=1)
+        yield c1.sync()
+        self.assertEqual(len(c1.errors), 2)
+
+        # clients without the feature don't get channels
+        c2 = yield self.make_client()
+        yield c2.next_non_ack()
+        c2.send("bind", appid="appid", side="side")
+        c2.send("open", mailbox="mb2", channel=1)
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["type"], "message")
+        self.assertNotIn("channel", m)
+        c2.send("open", mailbox="mb4", channel=2)
+        err = yield c2.next_non_ack()
+        self.assertEqual(err["error"], "only one open per connection")
+
+    @inlineCallbacks
+    def test_claim_open(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        app = self._server.get_app("appid")
+
+        c1.send("claim-open") # missing nameplate=
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "claim-open requires 'nameplate'")
+
+        mbid = app.claim_nameplate(np1, "side2", 0)
+        mb1 = app.open_mailbox(mbid, "side2", 0)
+        mb1.add_message(SidedMessage(side="side2", phase="phase",
+                                     body="body", server_rx=0,
+                                     msg_id="msgid"))
+
+        c1.send("claim-open", nameplate=np1)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "claimed")
+        self.assertEqual(m["mailbox"], mbid)
+        # the existing message is delivered without a separate "open"
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "message")
+        self.assertEqual(m["body"], "body")
+        self.assertTrue(mb1.has_listeners())
+        np_row, side_rows = self._nameplate(app, np1)
+        self.assertEqual(sorted([row["side"] for row in side_rows]),
+                         ["side", "side2"])
+
+        mb1.add_message(SidedMessage(side="side2", phase="phase2",
+                                     body="body2", server_rx=0,
+                                     msg_id="msgid"))
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "message")
+        self.assertEqual(m["body"], "body2")
+
+        c1.send("claim-open", nameplate=np1)
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "only one claim per connection")
+        c1.send("open", mailbox=mbid)
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "only one open per connection")
+
+        # release and close work as if "claim" and "open" had been used
+        c1.send("release")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "released")
+        c1.send("close", mood="happy")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "closed")
+        self.assertFalse(mb1.has_listeners())
+
+    @inlineCallbacks
+    def test_frames_coalesced(self):
+        # all the frames provoked by one command (the ack, "claimed", and
+        # every replayed "message") are written during a single reactor
+        # turn, and the TCP transport flushes them with a single send()
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        yield c1.sync()
+        c1.strip_acks()
+        app = self._server.get_app("appid")
+        mbid = app.claim_nameplate(np1, "side2", 0)
+        mb1 = app.open_mailbox(mbid, "side2", 0)
+        for phase in ["1", "2", "3"]:
+            mb1.add_message(SidedMessage(side="side2", phase=phase,
+                                         body="body", server_rx=0,
+                                         msg_id=phase))
+        sends = []
+        orig = tcp.Server.writeSomeData
+        def writeSomeData(transport, data):
+            sends.append(data)
+            return orig(transport, data)
+        with mock.patch.object(tcp.Server, "writeSomeData", writeSomeData):
+            c1.send("claim-open", nameplate=np1)
+            types = []
+            for i in range(5):
+                m = yield c1.next_event()
+                types.append(m["type"])
+        # frames arrive in the order they were sent
+        self.assertEqual(types, ["ack", "claimed",
+                                 "message", "message", "message"])
+        self.assertEqual(len(sends), 1)
+
+    @inlineCallbacks
+    def test_claim_open_crowded(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        app = self._server.get_app("appid")
+
+        app.claim_nameplate(np1, "side1", 0)
+        app.claim_nameplate(np1, "side2", 0)
+
+        c1.send("claim-open", nameplate=np1)
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "crowded")
+
     @inlineCallbacks
     def test_release(self):
         c1 = yield self.make_client()
@@ -429,6 +648,160 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         mb1.close("side2", "happy", 1)
         mb1.close("side", "happy", 2)
 
+    @inlineCallbacks
+    def test_open_since(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        app = self._server.get_app("appid")
+
+        mb1 = app.open_mailbox("mb1", "side2", 0)
+        for body in ["body1", "body2", "body3"]:
+            mb1.add_message(SidedMessage(side="side2", phase="phase",
+                                         body=body, server_rx=0,
+                                         msg_id=body))
+        seqs = [sm.seq for sm in mb1.get_messages()]
+
+        c1.send("open", mailbox="mb1", since="nope")
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "open 'since' must be an integer")
+
+        # a reconnecting client only gets the messages it missed
+        c1.send("open", mailbox="mb1", since=seqs[1])
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "message")
+        self.assertEqual(m["body"], "body3")
+        self.assertEqual(m["seq"], seqs[2])
+
+        c1.send("add", phase="phase", body="body4")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "message")
+        self.assertEqual(m["body"], "body4")
+        self.assertTrue(m["seq"] > seqs[2])
+
+    @inlineCallbacks
+    def _test_binary_framing(self, subprotocol):
+        if subprotocol not in FRAMINGS:
+            raise unittest.SkipTest(f"{subprotocol} library not installed")
+        f = WSFactory(self.relayurl, protocols=[subprotocol])
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", self.rdv_ws_port, f)
+        c1 = yield f.d
+        self._clients.append(c1)
+        self.assertEqual(c1.websocket_protocol_in_use, subprotocol)
+        welcome = yield c1.next_non_ack()
+        self.check_welcome(welcome)
+        c2 = yield self.make_client() # JSON
+        yield c2.next_non_ack()
+
+        c1.send("bind", appid="appid", side="side1")
+        c2.send("bind", appid="appid", side="side2")
+        c1.send("open", mailbox="mb1")
+        c2.send("open", mailbox="mb1")
+        yield c1.sync()
+        yield c2.sync()
+
+        # binary clients send and receive raw bytes, JSON clients see hex
+        c1.send("add", phase="1", body=b"\x00\xff")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "message")
+        self.assertEqual(m["body"], b"\x00\xff")
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["body"], "00ff")
+
+        c2.send("add", phase="2", body="4142")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["body"], b"AB")
+        m = yield c2.next_non_ack()
+        self.assertEqual(m["body"], "4142")
+
+    def test_cbor(self):
+        return self._test_binary_framing("wormhole.cbor")
+
+    def test_msgpack(self):
+        return self._test_binary_framing("wormhole.msgpack")
+
+    @inlineCallbacks
+    def _test_type_not_string(self, subprotocol, bad_types):
+        if subprotocol is None:
+            c1 = yield self.make_client()
+        else:
+            if subprotocol not in FRAMINGS:
+                raise unittest.SkipTest(f"{subprotocol} library not installed")
+            f = WSFactory(self.relayurl, protocols=[subprotocol])
+            f.d = defer.Deferred()
+            reactor.connectTCP("127.0.0.1", self.rdv_ws_port, f)
+            c1 = yield f.d
+            self._clients.append(c1)
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        for bad_type in bad_types:
+            c1.send_notype(type=bad_type)
+            err = yield c1.next_non_ack()
+            self.assertEqual(err["type"], "error")
+            self.assertEqual(err["error"], "'type' must be a string")
+        # the connection is still usable
+        c1.send("allocate")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "allocated")
+
+    def test_type_not_string_json(self):
+        return self._test_type_not_string(None, [[], {}, 1, None])
+
+    def test_type_not_string_cbor(self):
+        tags = [framing.cbor2.CBORTag(4242, "x")] if framing.cbor2 else []
+        return self._test_type_not_string("wormhole.cbor", [[], {}] + tags)
+
+    def test_type_not_string_msgpack(self):
+        exts = [framing.msgpack.ExtType(1, b"x")] if framing.msgpack else []
+        return self._test_type_not_string("wormhole.msgpack", [[], {}] + exts)
+
+    @inlineCallbacks
+    def test_unknown_subprotocol(self):
+        # we don't insist on a subprotocol, so clients offering only
+        # unknown ones get JSON
+        f = WSFactory(self.relayurl, protocols=["wormhole.xml"])
+        f.d = defer.Deferred()
+        reactor.connectTCP("127.0.0.1", self.rdv_ws_port, f)
+        c1 = yield f.d
+        self._clients.append(c1)
+        self.assertEqual(c1.websocket_protocol_in_use, None)
+        welcome = yield c1.next_non_ack()
+        self.check_welcome(welcome)
+
+    @inlineCallbacks
+    def test_add_duplicate(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        c1.send("open", mailbox="mb1")
+        c2 = yield self.make_client()
+        yield c2.next_non_ack()
+        c2.send("bind", appid="appid", side="side2", features=["no-acks"])
+        c2.send("open", mailbox="mb1")
+        yield c1.sync()
+        yield c2.sync()
+        c2.strip_acks()
+
+        c2.send("add", phase="1", body="body", id="id1")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["body"], "body")
+        m = yield c2.next_event()
+        self.assertEqual(m["type"], "message")
+
+        # a retransmission is acked (even with no-acks), but not echoed
+        c2.send("add", phase="1", body="body", id="id1")
+        m = yield c2.next_event()
+        self.assertEqual(m["type"], "ack")
+        self.assertEqual(m["id"], "id1")
+        yield c1.sync()
+        self.assertEqual([e for e in c1.events if e["type"] != "ack"], [])
+        app = self._server.get_app("appid")
+        mb1 = app.open_mailbox("mb1", "side", 0)
+        self.assertEqual(len(mb1.get_messages()), 1)
+        self.assertEqual(self._server.get_counters()["duplicate_adds"], 1)
+
     @inlineCallbacks
     def test_open_crowded(self):
         c1 = yield self.make_client()
@@ -561,6 +934,141 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         self.assertEqual(err["error"], "crowded")
 
 
+    @inlineCallbacks
+    def test_batch(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("batch", commands=[{"type": "bind", "appid": "appid",
+                                    "side": "side"},
+                                   {"type": "allocate"},
+                                   {"type": "list"},
+                                   ])
+        # without "batch-responses", each response gets its own frame
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "allocated")
+        nameplate = m["nameplate"]
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "nameplates")
+        self.assertEqual(m["nameplates"], [{"id": nameplate}])
+
+    @inlineCallbacks
+    def test_batch_responses(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        app = self._server.get_app("appid")
+        mb1 = app.open_mailbox("mb1", "side2", 0)
+        mb1.add_message(SidedMessage(side="side2", phase="phase",
+                                     body="body", server_rx=0,
+                                     msg_id="msgid"))
+
+        c1.send("batch", id="batchid",
+                commands=[{"type": "bind", "appid": "appid", "side": "side",
+                           "features": ["batch-responses", 7, "unknown"]},
+                          {"type": "open", "mailbox": "mb1", "id": "o"},
+                          {"type": "add", "phase": "p2", "body": "b2",
+                           "id": "a"},
+                          ])
+        m = yield c1.next_event()
+        self.assertEqual(m["type"], "ack")
+        self.assertEqual(m["id"], "batchid")
+        m = yield c1.next_event()
+        self.assertEqual(m["type"], "batch")
+        self.assertEqual([(r["type"], r.get("id")) for r in m["messages"]],
+                         [("ack", None),
+                          ("ack", "o"),
+                          ("message", "msgid"),
+                          ("ack", "a"),
+                          ("message", "a"),
+                          ])
+        self.assertEqual(m["messages"][4]["body"], "b2")
+        for r in m["messages"]:
+            self.assertIn("server_tx", r)
+        # later messages are delivered normally
+        c1.send("close", mood="happy")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "closed")
+
+    @inlineCallbacks
+    def test_batch_errors(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+
+        c1.send("batch") # missing commands=
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "batch requires 'commands' list")
+
+        c1.send("batch", commands=[{"type": "bind", "appid": "appid",
+                                    "side": "side",
+                                    "features": ["batch-responses"]},
+                                   "not a dict",
+                                   {"type": "batch", "commands": []},
+                                   {"type": "allocate"},
+                                   ])
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "batch")
+        responses = [r for r in m["messages"] if r["type"] != "ack"]
+        self.assertEqual(responses[0]["type"], "error")
+        self.assertEqual(responses[0]["error"], "batch commands must be objects")
+        self.assertEqual(responses[0]["orig"], "not a dict")
+        self.assertEqual(responses[1]["type"], "error")
+        self.assertEqual(responses[1]["error"], "batches cannot be nested")
+        # errors don't abort the rest of the batch
+        self.assertEqual(responses[2]["type"], "allocated")
+
+    @inlineCallbacks
+    def test_no_acks(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side", features=["no-acks"])
+        m = yield c1.next_event()
+        self.assertEqual(m["type"], "ack") # bind is always acked
+
+        c1.send("claim", nameplate=np1, id="c")
+        m = yield c1.next_event()
+        self.assertEqual(m["type"], "claimed")
+        mailbox_id = m["mailbox"]
+
+        c1.send("open", mailbox=mailbox_id, id="o")
+        m = yield c1.next_event()
+        self.assertEqual((m["type"], m["id"]), ("ack", "o")) # no response
+
+        c1.send("add", phase="phase", body="body", id="a")
+        m = yield c1.next_event()
+        self.assertEqual((m["type"], m["id"]), ("message", "a"))
+
+        c1.send("claim") # errors are direct responses too
+        m = yield c1.next_event()
+        self.assertEqual(m["type"], "error")
+
+        c1.send("ping", ping=1)
+        m = yield c1.next_event()
+        self.assertEqual(m["type"], "pong")
+
+        self.assertEqual(self._server.get_counters()["acks_suppressed"], 4)
+
+        # each connection's count is logged when it closes
+        logged = []
+        observer = lambda event: logged.append(log.textFromEventDict(event))
+        log.addObserver(observer)
+        self.addCleanup(log.removeObserver, observer)
+        yield c1.close()
+        yield self.wait_for_server_disconnects()
+        self.assertIn("ws client closed: 4 acks suppressed", logged)
+
+    @inlineCallbacks
+    def test_acks_by_default(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        yield c1.next_event()
+        c1.send("allocate", id="x")
+        m = yield c1.next_event()
+        self.assertEqual((m["type"], m["id"]), ("ack", "x"))
+        m = yield c1.next_event()
+        self.assertEqual(m["type"], "allocated")
+        self.assertNotIn("acks_suppressed", self._server.get_counters())
+
     @inlineCallbacks
     def test_disconnect(self):
         c1 = yield self.make_client()
@@ -740,3 +1248,360 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         yield c.d
 
 
+
+
+class RateLimitAPI(ClientServerBase, unittest.TestCase):
+    @inlineCallbacks
+    def test_error(self):
+        yield self._setup_relay(do_listen=True,
+                                rate_limits=[("list", 0.001, 2.0)])
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        for i in range(2):
+            c1.send("list")
+            m = yield c1.next_non_ack()
+            self.assertEqual(m["type"], "nameplates")
+        c1.send("list")
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "rate limited")
+        # other command classes are not limited
+        c1.send("allocate")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "allocated")
+
+        # the bucket is shared by all connections from the same address
+        c2 = yield self.make_client()
+        yield c2.next_non_ack()
+        c2.send("bind", appid="appid", side="side2")
+        c2.send("list")
+        err = yield c2.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "rate limited")
+
+    @inlineCallbacks
+    def test_close(self):
+        yield self._setup_relay(do_listen=True,
+                                rate_limits=[("nameplate", 0.001, 1.0)],
+                                rate_limit_close=True)
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        c1.send("claim", nameplate="1")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "claimed")
+        c1.send("release")
+        ev = yield c1.next_event()
+        while not isinstance(ev, tuple):
+            self.assertEqual(ev["type"], "ack")
+            ev = yield c1.next_event()
+        (wasClean, code, reason) = ev
+        self.assertEqual(code, 1000)
+        self.assertEqual(reason, "rate limited")
+
+
+class LimitsAPI(ClientServerBase, unittest.TestCase):
+    @inlineCallbacks
+    def test_errors(self):
+        yield self._setup_relay(do_listen=True,
+                                limits=Limits(max_body=4,
+                                              max_mailbox_messages=2,
+                                              max_field_length=10))
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side"*3)
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "'side' is too long (max 10 characters)")
+        c1.send("bind", appid="appid", side="side",
+                client_version=["python", "x"*11])
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["error"],
+                         "'client_version' is too long (max 10 characters)")
+        c1.send("bind", appid="appid", side="side")
+        c1.send("open", mailbox="mb1")
+        c1.send("add", phase="1", body="00"*5)
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "body is too large (max 4 bytes)")
+        for phase in ["1", "2"]:
+            c1.send("add", phase=phase, body="00"*4)
+            m = yield c1.next_non_ack()
+            self.assertEqual(m["type"], "message")
+        c1.send("add", phase="3", body="00")
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["error"], "mailbox is full (too many messages)")
+        self.assertEqual(self._server.get_counters()["quota_rejections"], 4)
+
+    @inlineCallbacks
+    def test_max_channels(self):
+        yield self._setup_relay(do_listen=True, limits=Limits(max_channels=2))
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side", features=["channels"])
+        for handle in [1, 2, 3]:
+            c1.send("open", mailbox="mb%d" % handle, channel=handle)
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["error"], "too many channels on this connection")
+        self.assertEqual(err["orig"]["channel"], 3)
+        # the default channel doesn't count
+        c1.send("open", mailbox="mb0")
+        c1.send("close", channel=1)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "closed")
+        c1.send("open", mailbox="mb3", channel=3)
+        yield c1.sync()
+        self.assertEqual(len(c1.errors), 1)
+
+    @inlineCallbacks
+    def test_app_limits(self):
+        yield self._setup_relay(do_listen=True,
+                                limits=Limits(max_app_connections=1,
+                                              max_app_command_rate=3.0))
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side1")
+        c2 = yield self.make_client()
+        yield c2.next_non_ack()
+        c2.send("bind", appid="appid", side="side2")
+        err = yield c2.next_non_ack()
+        self.assertEqual(err["error"], "too many connections for this app")
+        # c2 is still unbound
+        c2.send("list")
+        err = yield c2.next_non_ack()
+        self.assertEqual(err["error"], "must bind first")
+        c2.send("bind", appid="appid2", side="side2")
+        yield c2.sync()
+        self.assertEqual(len(c2.errors), 2)
+
+        for i in range(5):
+            c1.send("list")
+        responses = []
+        for i in range(5):
+            responses.append((yield c1.next_non_ack())["type"])
+        self.assertEqual(responses, ["nameplates"]*3 + ["error"]*2)
+        self.assertEqual(c1.errors[0]["error"],
+                         "too many commands for this app, slow down")
+
+        # the connection is given back when it closes
+        yield c1.close()
+        while "app:appid:connections" in self._server.get_counters():
+            yield deferLater(reactor, 0.0)
+        c3 = yield self.make_client()
+        yield c3.next_non_ack()
+        c3.send("bind", appid="appid", side="side3")
+        yield c3.sync()
+        self.assertEqual(c3.errors, [])
+
+    @inlineCallbacks
+    def test_malformed_frames(self):
+        yield self._setup_relay(do_listen=True)
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        for payload in [b"garbage", b"[1, 2]", b"{not json}", b"\xff{}"]:
+            c1.sendMessage(payload, True)
+            err = yield c1.next_non_ack()
+            self.assertEqual(err["type"], "error")
+            self.assertIn(err["error"], ["frame is not an object",
+                                         "frame could not be decoded"])
+            self.assertNotIn("orig", err)
+        # the connection is still usable
+        c1.send("bind", appid="appid", side="side")
+        yield c1.sync()
+        self.assertEqual(len(c1.errors), 4)
+        counters = self._server.get_counters()
+        self.assertEqual(counters["rejected_frames_not_object"], 3)
+        self.assertEqual(counters["rejected_frames_malformed"], 1)
+
+    @inlineCallbacks
+    def test_max_message_size(self):
+        yield self._setup_relay(do_listen=True, max_message_size=1000)
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        c1.send("ping", ping=1, padding="x"*900)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "pong")
+        c1.send("ping", ping=2, padding="x"*1000)
+        (wasClean, code, reason) = yield c1.next_event()
+        self.assertEqual(code, 1009) # MESSAGE_TOO_BIG
+        yield self.wait_for_server_disconnects()
+        counters = self._server.get_counters()
+        self.assertEqual(counters["rejected_frames_too_large"], 1)
+
+    @inlineCallbacks
+    def test_draining(self):
+        yield self._setup_relay(do_listen=True)
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        c1.send("allocate")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "allocated")
+        c1.send("open", mailbox="mb1")
+
+        self._server.start_draining("ws://other.example.com/v1")
+        c2 = yield self.make_client()
+        welcome = (yield c2.next_non_ack())["welcome"]
+        self.assertIn("going down for maintenance", welcome["error"])
+        self.assertEqual(welcome["redirect"], "ws://other.example.com/v1")
+
+        # no new wormholes on existing connections either
+        c1.send("claim", nameplate="2")
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["error"], "server is draining, try again later")
+        # but the one in progress can finish
+        c1.send("add", phase="1", body="00")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "message")
+        self.assertEqual(self._server.count_live_mailboxes(), 1)
+        self.assertEqual(
+            self._server.get_counters()["draining_live_mailboxes"], 1)
+        c1.send("close", mood="happy")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "closed")
+        self.assertEqual(self._server.count_live_mailboxes(), 0)
+
+        self._server.stop_draining()
+        c3 = yield self.make_client()
+        welcome = (yield c3.next_non_ack())["welcome"]
+        self.assertNotIn("error", welcome)
+        self.assertNotIn("draining_live_mailboxes",
+                         self._server.get_counters())
+
+
+class UnixPort(ServerBase, unittest.TestCase):
+    # a --port= on a unix socket, as used behind a local reverse proxy
+    @inlineCallbacks
+    def setUp(self):
+        self._lp = None
+        self._clients = []
+        yield self._setup_relay()
+        self._site = make_web_server(self._server, log_requests=False)
+        self._server.add_port_label("proxy", self._site.ws_factory)
+        self.path = os.path.abspath(self.mktemp())
+        self._lp = reactor.listenUNIX(self.path, self._site)
+
+    def tearDown(self):
+        for c in self._clients:
+            c.transport.loseConnection()
+        return ServerBase.tearDown(self)
+
+    @inlineCallbacks
+    def make_client(self, headers=None):
+        f = WSFactory("ws://localhost/v1", headers=headers)
+        f.d = defer.Deferred()
+        reactor.connectUNIX(self.path, f)
+        c = yield f.d
+        self._clients.append(c)
+        return c
+
+    @inlineCallbacks
+    def test_unix(self):
+        c1 = yield self.make_client()
+        welcome = (yield c1.next_non_ack())["welcome"]
+        # the proxy didn't say who the client is
+        self.assertEqual(welcome["your-address"], {"port": 0})
+        c2 = yield self.make_client(headers={"X-Real-IP": "10.0.0.1",
+                                             "X-Real-Port": "1234"})
+        welcome = (yield c2.next_non_ack())["welcome"]
+        self.assertEqual(welcome["your-address"],
+                         {"ipv4": "10.0.0.1", "port": 1234})
+        counters = self._server.get_counters()
+        self.assertEqual(counters["port_proxy_connections"], 2)
+
+
+class CompressionAPI(ClientServerBase, unittest.TestCase):
+    def client_factory(self, url):
+        f = WSFactory(url)
+        f.setProtocolOptions(
+            perMessageCompressionOffers=[PerMessageDeflateOffer()],
+            perMessageCompressionAccept=PerMessageDeflateResponseAccept)
+        return f
+
+    @inlineCallbacks
+    def _exchange(self):
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        c1.send("bind", appid="appid", side="side")
+        c1.send("open", mailbox="mb1")
+        c1.send("add", phase="1", body="00"*2000)
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["body"], "00"*2000)
+        yield c1.close()
+        yield self.wait_for_server_disconnects()
+        return c1
+
+    @inlineCallbacks
+    def test_compressed(self):
+        yield self._setup_relay(do_listen=True,
+                                compression=Compression("on", min_size=100))
+        c1 = yield self._exchange()
+        self.assertEqual(len(c1.websocket_extensions_in_use), 1)
+        c = self._server.get_counters()
+        self.assertEqual(c["deflate_connections"], 1)
+        # the big add and its echo were compressed
+        self.assertLess(c["deflate_in_wire"], c["deflate_in_app"] / 10)
+        self.assertLess(c["deflate_out_wire"], c["deflate_out_app"] / 10)
+        # the acks were too small to bother
+        self.assertGreater(c["deflate_skipped"], 0)
+        self.assertGreaterEqual(c["deflate_cpu"], 0.0)
+
+    @inlineCallbacks
+    def test_off(self):
+        # by default we refuse the offer
+        yield self._setup_relay(do_listen=True)
+        c1 = yield self._exchange()
+        self.assertEqual(c1.websocket_extensions_in_use, [])
+        self.assertNotIn("deflate_connections", self._server.get_counters())
+
+
+class OverloadAPI(ClientServerBase, unittest.TestCase):
+    @inlineCallbacks
+    def test_max_connections(self):
+        yield self._setup_relay(do_listen=True, max_connections=1)
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+        rows = self._server._store.get_connections()
+        self.assertEqual(len(rows), 1)
+
+        with self.assertRaises(WSError):
+            yield self.make_client()
+        self.assertEqual(self._server.get_counters()["shed_connections"], 1)
+        # the refused connection never reached the connection table
+        rows = self._server._store.get_connections()
+        self.assertEqual(len(rows), 1)
+
+        # the established connection keeps working
+        c1.send("bind", appid="appid", side="side")
+        c1.send("allocate")
+        m = yield c1.next_non_ack()
+        self.assertEqual(m["type"], "allocated")
+
+    @inlineCallbacks
+    def test_max_connections_all_ports(self):
+        # the limit is for the whole server, not for each --port=
+        yield self._setup_relay(do_listen=True, max_connections=1)
+        site2 = make_web_server(self._server, log_requests=False)
+        lp2 = yield endpoints.TCP4ServerEndpoint(
+            reactor, 0, interface="127.0.0.1").listen(site2)
+        self.addCleanup(lp2.stopListening)
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
+
+        with self.assertRaises(WSError):
+            yield self.make_client(port=lp2.getHost().port)
+        self.assertEqual(self._server.get_counters()["shed_connections"], 1)
+        self.assertEqual(self._server.count_open_connections(), 1)
+
+    @inlineCallbacks
+    def test_lag(self):
+        yield self._setup_relay(do_listen=True, max_lag=0.5)
+        self._server._governor.lag = 2.0
+        with self.assertRaises(WSError):
+            yield self.make_client()
+        self.assertEqual(self._server.get_counters()["shed_lag"], 1)
+        self._server._governor.lag = 0.0
+        c1 = yield self.make_client()
+        yield c1.next_non_ack()
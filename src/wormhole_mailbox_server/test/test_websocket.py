@@ -28,6 +28,12 @@ class FakeServer:
     def get_address_id(self, peer_type, peer_host):
         return None
 
+    def count_open_connections(self):
+        return 1
+
+    def check_admission(self, open_connections):
+        return None
+
     def connection_established(self, address_id, now):
         c = self._connection_table.established(address_id, now)
         return c
@@ -0,0 +1,41 @@
+import os
+from twisted.trial import unittest
+from twisted.internet import reactor, protocol
+from twisted.internet.defer import inlineCallbacks
+from ..workers import (ReusePortEndpoint, parse_tcp_port, worker_path,
+                       worker_socket)
+
+class Paths(unittest.TestCase):
+    def test_worker_path(self):
+        self.assertEqual(worker_path("relay.sqlite", 0), "relay-0.sqlite")
+        self.assertEqual(worker_path("/var/db/usage.sqlite", 3),
+                         "/var/db/usage-3.sqlite")
+        self.assertEqual(worker_path("relay", 1), "relay-1")
+        self.assertEqual(worker_path(":memory:", 1), ":memory:")
+
+    def test_worker_socket(self):
+        self.assertEqual(worker_socket("/run/mailbox", 1),
+                         os.path.join("/run/mailbox", "worker-1.sock"))
+
+    def test_parse_tcp_port(self):
+        self.assertEqual(parse_tcp_port("tcp:4000"), (4000, "", 50))
+        self.assertEqual(parse_tcp_port("tcp:4000:interface=127.0.0.1"),
+                         (4000, "127.0.0.1", 50))
+        self.assertEqual(parse_tcp_port("tcp:4000:interface=\\:\\:1:backlog=9"),
+                         (4000, "::1", 9))
+        for bad in ["unix:/tmp/sock", "tcp", "tcp:http", "tcp:4000:bogus=1",
+                    "tcp:4000:extra"]:
+            with self.assertRaises(ValueError):
+                parse_tcp_port(bad)
+
+class ReusePort(unittest.TestCase):
+    @inlineCallbacks
+    def test_listen_twice(self):
+        f = protocol.Factory.forProtocol(protocol.Protocol)
+        lp1 = yield ReusePortEndpoint(reactor, 0, "127.0.0.1").listen(f)
+        self.addCleanup(lp1.stopListening)
+        port = lp1.getHost().port
+        # a second process (here, a second listener) can share the port
+        lp2 = yield ReusePortEndpoint(reactor, port, "127.0.0.1").listen(f)
+        self.addCleanup(lp2.stopListening)
+        self.assertEqual(lp2.getHost().port, port)
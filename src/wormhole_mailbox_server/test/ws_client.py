@@ -1,7 +1,8 @@
-import json, itertools
+import itertools
 from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks
 from autobahn.twisted import websocket
+from ..framing import JSON, FRAMINGS
 
 class WSError(Exception):
     pass
@@ -14,14 +15,17 @@ class WSClient(websocket.WebSocketClientProtocol):
         self.d = None
         self._opened = False
         self.ping_counter = itertools.count(0)
+        self.framing = JSON
     def onOpen(self):
         # server side errors will prevent this from being called, so
         # the test would hang, but autobahn does call onClose
         self._opened = True
+        if self.websocket_protocol_in_use:
+            self.framing = FRAMINGS[self.websocket_protocol_in_use]
         self.factory.d.callback(self)
     def onMessage(self, payload, isBinary):
-        assert not isBinary
-        event = json.loads(payload.decode("utf-8"))
+        assert isBinary == self.framing.is_binary
+        event = self.framing.decode(payload)
         if event["type"] == "error":
             self.errors.append(event)
         if self.d:
@@ -66,12 +70,11 @@ class WSClient(websocket.WebSocketClientProtocol):
 
     def send(self, mtype, **kwargs):
         kwargs["type"] = mtype
-        payload = json.dumps(kwargs).encode("utf-8")
-        self.sendMessage(payload, False)
+        self.send_notype(**kwargs)
 
     def send_notype(self, **kwargs):
-        payload = json.dumps(kwargs).encode("utf-8")
-        self.sendMessage(payload, False)
+        payload = self.framing.encode(kwargs)
+        self.sendMessage(payload, self.framing.is_binary)
 
     @inlineCallbacks
     def sync(self):
@@ -16,10 +16,16 @@ class PrivacyEnhancedSite(server.Site):
             return server.Site.log(self, request)
 
 
-def make_web_server(server, log_requests, websocket_protocol_options=()):
+def make_web_server(server, log_requests, websocket_protocol_options=(),
+                    compression=None, max_message_size=None, router=None):
+    # 'router' is for the public listener of a node which shares the work
+    # with others: the internal listener (where other nodes forward
+    # commands) must handle everything it receives itself
     root = Root()
-    wsrf = WebSocketServerFactory(None, server)
+    wsrf = WebSocketServerFactory(None, server, compression, max_message_size,
+                                  router)
     wsrf.setProtocolOptions(**dict(websocket_protocol_options))
+    server.add_ws_factory(wsrf)
     root.putChild(b"v1", WebSocketResource(wsrf))
 
     site = PrivacyEnhancedSite(root)
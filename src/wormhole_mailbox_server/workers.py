@@ -0,0 +1,123 @@
+import os, re, socket, sys
+from zope.interface import implementer
+from twisted.internet import defer, protocol
+from twisted.internet.interfaces import IStreamServerEndpoint
+from twisted.application import service
+from twisted.python import log
+
+# With --workers=N, the server runs as N processes, which all accept
+# connections on the same port (the kernel spreads new connections among
+# them, thanks to SO_REUSEPORT). Each worker keeps its own databases, and
+# owns a share of the nameplates and mailboxes (see routing.py); workers
+# reach each other through UNIX sockets in --worker-socket-dir=. The process
+# started by the operator is worker 0, and starts the others.
+
+RESTART_DELAY = 1.0
+
+def worker_name(index):
+    return f"worker-{index}"
+
+def worker_socket(socket_dir, index):
+    return os.path.join(socket_dir, f"{worker_name(index)}.sock")
+
+def worker_path(path, index):
+    """Each worker needs its own database files: relay.sqlite becomes
+    relay-2.sqlite for worker 2."""
+    if path == ":memory:":
+        return path
+    base, ext = os.path.splitext(path)
+    return f"{base}-{index}{ext}"
+
+def parse_tcp_port(description):
+    """Parse a 'tcp:PORT[:interface=ADDR][:backlog=N]' endpoint string (with
+    colons in ADDR escaped as \\:) into (port, interface, backlog). Raises
+    ValueError for anything else."""
+    parts = [p.replace("\\:", ":") for p in re.split(r"(?<!\\):", description)]
+    if parts[0] != "tcp" or len(parts) < 2:
+        raise ValueError("--workers= needs a tcp: --port=")
+    port = int(parts[1])
+    kwargs = dict(p.split("=", 1) for p in parts[2:] if "=" in p)
+    unknown = set(kwargs) - {"interface", "backlog"}
+    if unknown or len(kwargs) != len(parts) - 2:
+        raise ValueError(f"unsupported --port= for --workers=: {description}")
+    return port, kwargs.get("interface", ""), int(kwargs.get("backlog", 50))
+
+@implementer(IStreamServerEndpoint)
+class ReusePortEndpoint(object):
+    """Listen on a TCP port which other processes are listening on too."""
+    def __init__(self, reactor, port, interface="", backlog=50):
+        self._reactor = reactor
+        self._port = port
+        self._interface = interface
+        self._backlog = backlog
+
+    def listen(self, factory):
+        family = socket.AF_INET6 if ":" in self._interface else socket.AF_INET
+        s = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            s.bind((self._interface, self._port))
+            s.listen(self._backlog)
+            s.setblocking(False)
+            port = self._reactor.adoptStreamPort(s.fileno(), family, factory)
+        except Exception:
+            return defer.fail()
+        finally:
+            s.close() # adoptStreamPort() made its own copy
+        return defer.succeed(port)
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    def __init__(self, pool, index):
+        self._pool = pool
+        self._index = index
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        self._pool._ended(self._index, reason)
+
+class WorkerPool(service.Service):
+    """I run workers 1..N-1 as child processes, with the same options as
+    this one, and restart any which exit until I am stopped."""
+    def __init__(self, reactor, workers, args):
+        self._reactor = reactor
+        self._workers = workers
+        self._args = list(args)
+        self._processes = {} # index -> (IProcessTransport, _WorkerProtocol)
+
+    def startService(self):
+        service.Service.startService(self)
+        for index in range(1, self._workers):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        if not self.running:
+            return
+        argv = ([sys.executable, "-m", "twisted", "wormhole-mailbox"]
+                + self._args + [f"--worker-index={index}"])
+        p = _WorkerProtocol(self, index)
+        transport = self._reactor.spawnProcess(p, sys.executable, argv,
+                                               env=os.environ,
+                                               childFDs={0: "w", 1: 1, 2: 2})
+        self._processes[index] = (transport, p)
+
+    def _ended(self, index, reason):
+        self._processes.pop(index, None)
+        if self.running:
+            log.msg(f"{worker_name(index)} exited ({reason.value}),"
+                    f" restarting in {RESTART_DELAY}s")
+            self._reactor.callLater(RESTART_DELAY, self._spawn, index)
+
+    def signal_workers(self, signum):
+        for (transport, p) in self._processes.values():
+            transport.signalProcess(signum)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        ended = []
+        for (transport, p) in self._processes.values():
+            transport.signalProcess("TERM")
+            ended.append(p.ended)
+        return defer.DeferredList(ended)